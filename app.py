@@ -1,43 +1,248 @@
-import streamlit as st
-import chromadb
-from openai import OpenAI
 import json
+import os
+import shutil
 
-# OpenAI初期化
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+import streamlit as st
+from embedders import BACKEND_OPENAI
+from filters import make_filters
+from flat_index import DTYPE_INT8
+from formats import iter_conversations
+from ingest import SNIPPET_CHARS, run_import
+from jobs import CANCELLED, DONE, QUEUED, RUNNING, JobManager
+from journal import fingerprint
+from metrics import JsonLinesLog, metrics, trace
+from query_cache import make_key
+from rerank import DEFAULT_DIVERSITY, DEFAULT_RECENCY, make_rerank
+from search import (MODE_HYBRID, MODE_KEYWORD, MODE_VECTOR, attach_related, fetch_documents, rank_conversations,
+                    rank_depth)
+from store import VECTOR_ENGINE_CHROMA, EmbedderMismatch, bind_embedder, load_full_text, make_embedder, reset_store
+from tenants import DEFAULT_MEMORY_BUDGET_MB, DEFAULT_TENANT, MAX_OPEN_TENANTS, TenantPool, tenant_id
 
-# ChromaDB初期化（embedding_function明示的にNone）
+# Embedder初期化 + Embeddingキャッシュ（再実行のたびに作り直さないようにcache_resource）
+# secrets.toml の EMBEDDER = "local" でローカルモデル（オフライン・APIキー不要）を使う
 @st.cache_resource
-def init_chromadb():
-    chroma_client = chromadb.PersistentClient(path="./chroma_db")
-    
-    # 既存のコレクションを削除（デバッグ用）
-    try:
-        chroma_client.delete_collection("conversations")
-    except:
-        pass
-    
-    # 新しいコレクション作成（embedding_function=None）
-    collection = chroma_client.create_collection(
-        name="conversations",
-        metadata={"hnsw:space": "cosine"}
+def init_embedder():
+    return make_embedder(
+        st.secrets.get("OPENAI_API_KEY"),
+        backend=st.secrets.get("EMBEDDER", BACKEND_OPENAI),
+        model=st.secrets.get("EMBEDDING_MODEL"),
+        threads=st.secrets.get("EMBEDDING_THREADS"),
+        runtime=st.secrets.get("EMBEDDING_RUNTIME", "torch"),
+    )
+
+embed_fn = init_embedder()
+
+# ユーザー（テナント）ごとのストア一式。最初に使われたときに開き、使われていないものからメモリを手放す
+# secrets.toml の MEMORY_BUDGET_MB がメモリの予算（ChromaDBのHNSWと、総当たりの索引・重複の索引のそれぞれの上限）
+# VECTOR_ENGINE = "flat" で、HNSWの代わりに量子化した総当たりの索引を使う
+# （VECTOR_DTYPE = "int8" / "float16"、VECTOR_DIMENSIONS で先頭の次元だけ使う）
+@st.cache_resource
+def init_tenant_pool():
+    dimensions = st.secrets.get("VECTOR_DIMENSIONS")
+    return TenantPool(
+        memory_budget_bytes=int(st.secrets.get("MEMORY_BUDGET_MB", DEFAULT_MEMORY_BUDGET_MB)) * 1024 * 1024,
+        max_open=int(st.secrets.get("MAX_OPEN_TENANTS", MAX_OPEN_TENANTS)),
+        vector_engine=st.secrets.get("VECTOR_ENGINE", VECTOR_ENGINE_CHROMA),
+        vector_dtype=st.secrets.get("VECTOR_DTYPE", DTYPE_INT8),
+        vector_dimensions=int(dimensions) if dimensions else None,
     )
-    return collection
 
-collection = init_chromadb()
+tenant_pool = init_tenant_pool()
+
+# 今のユーザー: secrets.toml の TENANT_HEADER（認証プロキシが付けるユーザー名のヘッダー）か、
+# Streamlitのログイン（st.user）のメールアドレス。どちらもなければユーザーを分けない（./chroma_db 直下）
+def current_user():
+    header = st.secrets.get("TENANT_HEADER")
+    if header:
+        user = st.context.headers.get(header)
+        if not user:
+            st.error(f"ユーザーが分かりません（{header} ヘッダーがありません）")
+            st.stop()
+        return user
+    if hasattr(st, 'user') and st.user.get('is_logged_in'):
+        return st.user.get('email')
+    return None
+
+tenant = tenant_pool.get(tenant_id(current_user()))
+
+# コレクション（既存のデータはそのまま使う。再インポートは差分だけEmbeddingする）と付随するストア
+# 全文は圧縮して別に保存し、近い重複はEmbeddingせずに検索結果で1件にまとめる
+# 検索結果キャッシュとタイトル絞り込み用の会話一覧は、インポート/リセットでバージョンが上がると読み直す
+collection = tenant.collection
+document_store = tenant.document_store
+duplicate_index = tenant.duplicate_index
+keyword_index = tenant.keyword_index
+vector_index = tenant.vector_index
+related_index = tenant.related_index
+meta = tenant.meta
+query_cache = tenant.query_cache
+title_catalog = tenant.title_catalog
+journal = tenant.journal
+
+# 検索ごとの処理時間の内訳をJSON Linesで残す（secrets.toml の METRICS_LOG にパスを書いたときだけ）
+@st.cache_resource
+def init_metrics_log():
+    path = st.secrets.get("METRICS_LOG")
+    return JsonLinesLog(path) if path else None
+
+metrics_log = init_metrics_log()
+
+# コレクションを作ったモデルと今のEmbedderが違えば、ベクトル検索とインポートを止める（リセットで切り替え）
+try:
+    bind_embedder(meta, collection, embed_fn)
+    embedder_error = None
+except EmbedderMismatch as e:
+    embedder_error = str(e)
+
+# バックグラウンドのインポートジョブ（プロセスに1つ。ブラウザを閉じても実行は続く。画面には自分のジョブだけ出す）
+@st.cache_resource
+def init_job_manager():
+    return JobManager()
+
+job_manager = init_job_manager()
+
+# アップロードしたファイルをジョブ用に置いておく場所（テナントごと）と、ジョブ状況を再描画する間隔
+UPLOAD_DIR = tenant.upload_dir
+JOB_POLL_SECONDS = 2
+JOBS_SHOWN = 5
+
+# 処理時間パネルでの表示名（metrics のタイマー名 -> 表示名）
+TIMING_LABELS = {
+    'embed_query': "クエリのEmbedding",
+    'embed_api': "　└ Embedding API",
+    'chroma_query': "ChromaDB query",
+    'flat_query': "総当たりのベクトル検索",
+    'chroma_filter': "ChromaDB 絞り込み",
+    'keyword_search': "BM25検索",
+    'chroma_get': "ChromaDB get",
+    'collapse_duplicates': "近い重複のまとめ",
+    'related_get': "関連する会話の読み込み",
+    'rerank': "並べ替え（MMR・新しさ）",
+    'render': "結果の描画",
+    'docstore_get': "　└ 全文の読み込み",
+    'other': "その他",
+}
 
 # タイトル
 st.title("🔍 会話履歴検索ツール - Memory Layer MVP")
 
+if embedder_error:
+    st.warning(f"⚠️ {embedder_error}（キーワード検索は使えます）")
+
 # サイドバー - データ管理
 st.sidebar.header("📁 データ管理")
 
 # データベース統計
 try:
     total_docs = collection.count()
-    st.sidebar.metric("保存済み会話数", total_docs)
+    st.sidebar.metric("保存済みチャンク数", total_docs)
 except:
-    st.sidebar.metric("保存済み会話数", 0)
+    st.sidebar.metric("保存済みチャンク数", 0)
+
+# Embeddingキャッシュ統計
+with st.sidebar.expander("🧠 Embeddingキャッシュ"):
+    cache_stats = embed_fn.stats()
+    st.text(f"モデル: {embed_fn.model}（{embed_fn.dimension}次元）")
+    st.metric("ヒット率", f"{cache_stats['hit_rate']:.1%}")
+    st.text(f"ヒット: {cache_stats['hits']} / ミス: {cache_stats['misses']}")
+    st.text(f"保存件数: {cache_stats['entries']} ({cache_stats['bytes'] / 1024 / 1024:.1f} MB)")
+    st.text(f"節約: 約{cache_stats['estimated_saved_seconds']:.1f}秒 / 約{cache_stats['saved_tokens']:,} tokens")
+
+# ユーザーごとに分けているときは、開いているワークスペースの数とメモリの使い方
+if tenant.id != DEFAULT_TENANT:
+    with st.sidebar.expander("👥 ワークスペース"):
+        pool_stats = tenant_pool.stats()
+        st.text(f"ワークスペース: {tenant.id}")
+        st.text(f"開いている数: {pool_stats['open']}（開いた回数 {pool_stats['opens']} / 手放した回数 {pool_stats['evictions']}）")
+        st.text(f"メモリ（HNSW以外）: {pool_stats['resident_bytes'] / 1024 / 1024:.1f} MB / 予算 {pool_stats['budget_bytes'] / 1024 / 1024:.0f} MB")
+
+# 全文ストア統計
+with st.sidebar.expander("📚 全文ストア"):
+    doc_stats = document_store.stats()
+    st.text(f"会話数: {doc_stats['documents']}")
+    st.text(f"サイズ: {doc_stats['stored_bytes'] / 1024 / 1024:.1f} MB（圧縮前 {doc_stats['raw_bytes'] / 1024 / 1024:.1f} MB）")
+    dup_stats = duplicate_index.stats()
+    st.text(f"近い重複: {dup_stats['duplicates']} 件（{dup_stats['clusters']} まとまり）")
+
+# 総当たりのベクトル索引の統計（VECTOR_ENGINE = "flat" のときだけ）
+if vector_index is not None:
+    with st.sidebar.expander("🧮 ベクトル索引"):
+        flat_stats = vector_index.stats()
+        st.text(f"ベクトル数: {flat_stats['vectors']}（{flat_stats['dtype']}・{flat_stats['dimension']}次元）")
+        st.text(f"サイズ: {flat_stats['vector_bytes'] / 1024 / 1024:.1f} MB（float32なら {flat_stats['float32_bytes'] / 1024 / 1024:.1f} MB）")
+
+# アップロードされたエクスポートの会話数・メッセージ数（再実行のたびに数え直さないようにキャッシュ）
+@st.cache_data(show_spinner="会話を数えています...")
+def count_export(file_id, _uploaded_file):
+    _uploaded_file.seek(0)
+    total_conversations = 0
+    total_messages = 0
+    for conv in iter_conversations(_uploaded_file):
+        total_conversations += 1
+        total_messages += len(conv.messages)
+    # 中断したインポートを再開するためのファイルの指紋
+    job_key = fingerprint(_uploaded_file)
+    return total_conversations, total_messages, job_key
+
+# 検索結果キャッシュ統計
+with st.sidebar.expander("⚡ 検索結果キャッシュ"):
+    qc_stats = query_cache.stats()
+    st.metric("ヒット率", f"{qc_stats['hit_rate']:.1%}")
+    st.text(f"ヒット: {qc_stats['hits']} / ミス: {qc_stats['misses']}")
+    st.text(f"節約: 約{qc_stats['saved_seconds']:.2f}秒 / バージョン: {meta.collection_version()}")
+
+# インポート結果の表示
+def show_import_result(stats):
+    st.success(f"✅ インポート完了: {stats.success_count} 件（{stats.chunks} チャンク）")
+    st.info(
+        f"🆕 新規: {stats.new_count} 件 / 🔄 更新: {stats.updated_count} 件 / "
+        f"⏸️ 変更なし: {stats.unchanged_count} 件 / 🗑️ 削除: {stats.removed_count} 件"
+    )
+    if stats.resumed_count > 0:
+        st.info(f"⏯️ 前回完了済みのため読み飛ばし: {stats.resumed_count} 件")
+    if stats.skipped_count > 0:
+        st.info(f"ℹ️ スキップ: {stats.skipped_count} 件（空の会話）")
+    if stats.migrated_count > 0:
+        st.info(f"🧰 保存形式の書き直し: {stats.migrated_count} 件（Embeddingはそのまま）")
+    if stats.duplicate_count > 0:
+        st.info(f"🔁 近い重複: {stats.duplicate_count} 件（Embeddingせず代表の会話にまとめました）")
+    if stats.error_count > 0:
+        st.warning(f"⚠️ エラー: {stats.error_count} 件")
+    st.caption(
+        f"⏱️ {stats.elapsed:.1f}秒 / {stats.conversations_per_sec:.1f} 件/秒 / "
+        f"{stats.tokens_per_sec:,.0f} tokens/秒 / リクエスト {stats.requests} 回（リトライ {stats.retries} 回）"
+    )
+    
+    # エラーログとスキップログを表示
+    if len(stats.error_logs) > 0:
+        with st.expander("🔍 エラー詳細を表示"):
+            for log in stats.error_logs:
+                st.text(log)
+
+# アップロードされたファイルをジョブ用に保存する（ジョブはスクリプトの再実行と関係なく読み続けるため）
+def save_upload(uploaded_file, job_key):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_DIR, f"{job_key}.json")
+    uploaded_file.seek(0)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(uploaded_file, f, 1024 * 1024)
+    return path
+
+# バックグラウンドで動くインポート本体（st.* は呼ばない）
+# 実行中はテナントを lease して、ほかのユーザーが来てもメモリから手放されないようにする
+def import_job(job, path, checkpoint, delete_missing):
+    try:
+        with tenant_pool.lease(job.owner) as target, open(path, 'rb') as fp:
+            return run_import(iter_conversations(fp), target.collection, embed_fn,
+                              on_progress=lambda done, total, stats: job.update(done, total, stats),
+                              delete_missing=delete_missing, total=job.total,
+                              keyword_index=target.keyword_index, on_write=target.meta.bump_version,
+                              checkpoint=checkpoint, document_store=target.document_store,
+                              duplicate_index=target.duplicate_index, vector_index=target.vector_index,
+                              related_index=target.related_index, **embed_fn.import_options())
+    finally:
+        # 途中で止まっても進み具合はチェックポイントに残るので、一時ファイルは消してよい
+        os.remove(path)
 
 # JSONファイルアップロード
 st.sidebar.subheader("📤 会話履歴インポート")
@@ -45,143 +250,80 @@ uploaded_file = st.sidebar.file_uploader("conversations.json", type=['json'])
 
 if uploaded_file:
     try:
-        # JSONを読み込み
-        conversations = json.load(uploaded_file)
+        # JSONを1会話ずつ読みながら件数を数える（ファイル全体をオブジェクトにしない）
+        total_conversations, total_messages, job_key = count_export(uploaded_file.file_id, uploaded_file)
         
-        st.sidebar.success(f"✅ {len(conversations)} 件の会話を検出")
+        st.sidebar.success(f"✅ {total_conversations} 件の会話を検出")
         
         # 統計情報
-        total_messages = sum(len(conv.get('chat_messages', [])) for conv in conversations)
         st.sidebar.info(f"📊 総メッセージ数: {total_messages} 件")
         
-        # インポートボタン
-        if st.sidebar.button("🚀 データベースにインポート", type="primary"):
-            
-            progress_bar = st.sidebar.progress(0)
-            status_text = st.sidebar.empty()
-            
-            success_count = 0
-            error_count = 0
-            skipped_count = 0
-            error_logs = []
-            
-            for idx, conv in enumerate(conversations):
-                try:
-                    # 基本情報
-                    chat_id = conv.get('uuid', f"unknown_{idx}")
-                    title = conv.get('name', '(無題)')
-                    created_at = conv.get('created_at', '')
-                    chat_messages = conv.get('chat_messages', [])
-                    
-                    # メッセージがない会話はスキップ
-                    if not chat_messages:
-                        skipped_count += 1
-                        error_logs.append(f"スキップ{idx}: タイトル='{title}', ID={chat_id[:20]} - メッセージ0件")
-                        continue
-                    
-                    # メッセージからテキストを抽出
-                    full_text_parts = []
-                    
-                    for msg in chat_messages:
-                        sender = msg.get('sender', 'unknown')
-                        
-                        # content配列からtype="text"のみを抽出
-                        content_array = msg.get('content', [])
-                        text_parts = []
-                        
-                        for content_item in content_array:
-                            if content_item.get('type') == 'text':
-                                text = content_item.get('text', '').strip()
-                                if text:
-                                    text_parts.append(text)
-                        
-                        # contentから抽出したテキストを結合
-                        if text_parts:
-                            combined_text = ' '.join(text_parts)
-                            full_text_parts.append(f"[{sender}]: {combined_text}")
-                    
-                    full_text = '\n'.join(full_text_parts)
-                    
-                    # テキストを切り詰める（OpenAI Embeddingsの制限対策）
-                    MAX_CHARS = 5000
-                    if len(full_text) > MAX_CHARS:
-                        full_text = full_text[:MAX_CHARS] + "\n...(以下省略)"
-
-                    # 空のテキストの場合はスキップ
-                    if not full_text.strip():
-                        skipped_count += 1
-                        msg_count = len(chat_messages)
-
-                        #デバッグ：最初のメッセージのcontent構造を確認
-                        debug_info = ""
-                        if chat_messages and len(chat_messages) > 0:
-                            first_msg = chat_messages[0]
-                            content = first_msg.get('content',[])
-                            debug_info = f", content配列長={len(content)}"
-                            if content:
-                                types = [c.get('type') for c in content]
-                                debug_info += f", type={type}"
-                        error_logs.append(f"スキップ{idx}: タイトル='{title}', {msg_count}msg, ID={chat_id[:20]}... - テキスト抽出0文字(contentが空?)")
-                        continue
-                    
-                    # OpenAIでEmbedding作成
-                    response = client.embeddings.create(
-                        model="text-embedding-3-small",
-                        input=full_text
-                    )
-                    embedding = response.data[0].embedding
-                    
-                    # ChromaDBに追加（embeddingを明示的に渡す）
-                    collection.add(
-                        documents=[full_text],
-                        embeddings=[embedding],
-                        ids=[chat_id],
-                        metadatas=[{
-                            'chat_id': chat_id,
-                            'title': title,
-                            'created_at': created_at,
-                            'message_count': len(chat_messages)
-                        }]
-                    )
-                    
-                    success_count += 1
-                    
-                except Exception as e:
-                    error_count += 1
-                    title_preview = conv.get('name', '(無題)')[:30]
-                    messages = conv.get('chat_messages', [])
-                    error_msg = f"会話{idx}: {title_preview} ({len(messages)}msg) - {str(e)[:150]}"
-                    error_logs.append(error_msg)  # ← ログを保存
-                
-                # プログレスバー更新
-                progress_bar.progress((idx + 1) / len(conversations))
-                status_text.text(f"処理中: {idx + 1}/{len(conversations)}")
-            
-            progress_bar.empty()
-            status_text.empty()
-            
-            # 結果表示
-            st.sidebar.success(f"✅ インポート完了: {success_count} 件")
-            if skipped_count > 0:
-                st.sidebar.info(f"ℹ️ スキップ: {skipped_count} 件（空の会話）")
-            if error_count > 0:
-                st.sidebar.warning(f"⚠️ エラー: {error_count} 件")
-            
-            # エラーログとスキップログを表示
-            if len(error_logs) > 0:
-                with st.sidebar.expander("🔍 エラー詳細を表示"):
-                    for log in error_logs:
-                        st.text(log)
-            
-            #st.rerun()
+        delete_missing = st.sidebar.checkbox("エクスポートにない会話を削除", value=True)
+        
+        running = job_manager.find_active(job_key, owner=tenant.id)
+        
+        # 前回のインポートが途中で止まっていれば、その続きから再開する
+        resumable = journal.progress(job_key)
+        if resumable > 0 and running is None:
+            st.sidebar.info(f"⏯️ 前回のインポートの続きから再開します（{resumable}/{total_conversations} 件完了済み）")
+        
+        # インポートボタン（バックグラウンドのジョブとして投入し、画面はすぐに戻る）
+        if st.sidebar.button("🚀 データベースにインポート", type="primary",
+                             disabled=running is not None or embedder_error is not None):
+            checkpoint = journal.open(job_key, uploaded_file.name, total_conversations)
+            path = save_upload(uploaded_file, job_key)
+            job_manager.submit(
+                uploaded_file.name,
+                lambda job: import_job(job, path, checkpoint, delete_missing),
+                total=total_conversations, key=job_key, owner=tenant.id,
+            )
+            st.rerun()
             
     except Exception as e:
         st.sidebar.error(f"ファイル読み込みエラー: {str(e)}")
 
-# データベースリセット
-if st.sidebar.button("🗑️ データベースリセット"):
+# インポートジョブの状況（実行中は数秒おきにこの部分だけ再描画する。検索はその間も使える）
+def show_jobs():
+    jobs = job_manager.jobs(owner=tenant.id)
+    active_ids = {job.id for job in jobs if job.active}
+    # 見ていたジョブが終わったら、件数表示などを更新するためにページ全体を再実行する
+    if st.session_state.get('active_jobs', set()) - active_ids:
+        st.session_state['active_jobs'] = active_ids
+        st.rerun()
+    st.session_state['active_jobs'] = active_ids
+    
+    for job in jobs[:JOBS_SHOWN]:
+        if job.status == QUEUED:
+            st.caption(f"⏳ {job.name}: 待機中")
+        elif job.status == RUNNING:
+            st.progress(job.fraction, text=f"📥 {job.name}: {job.processed}/{job.total or '?'}")
+            eta = f" / 残り約{job.eta:.0f}秒" if job.eta is not None else ""
+            chunks = f" / {job.stats.chunks} チャンク" if job.stats else ""
+            st.caption(f"{job.rate:.1f} 件/秒{chunks}{eta}")
+            if st.button("⏹️ 中止", key=f"cancel_job_{job.id}"):
+                job.cancel()
+        elif job.status == DONE:
+            with st.expander(f"✅ {job.name}（{job.elapsed:.0f}秒）", expanded=(job is jobs[0])):
+                show_import_result(job.result)
+        elif job.status == CANCELLED:
+            st.caption(f"⏹️ {job.name}: 中止しました（{job.processed} 件まで完了。同じファイルで続きから再開できます）")
+        else:
+            st.error(f"❌ {job.name}: {job.error}")
+
+if job_manager.jobs(owner=tenant.id):
+    with st.sidebar:
+        st.subheader("📋 インポートジョブ")
+        if hasattr(st, 'fragment'):
+            st.fragment(show_jobs, run_every=JOB_POLL_SECONDS if job_manager.has_active(owner=tenant.id) else None)()
+        else:
+            show_jobs()
+            if job_manager.has_active(owner=tenant.id):
+                st.button("🔄 状況を更新")
+
+# データベースリセット（インポート中は押せない）
+if st.sidebar.button("🗑️ データベースリセット", disabled=job_manager.has_active(owner=tenant.id)):
     try:
-        collection.delete(where={})
+        reset_store(collection, keyword_index, meta, document_store, duplicate_index, vector_index, related_index)
         st.sidebar.success("✅ データベースをリセットしました")
         st.rerun()
     except Exception as e:
@@ -192,65 +334,164 @@ st.header("🔍 検索")
 
 query = st.text_input("検索キーワードを入力", placeholder="例: マイクロ波、実験、Python")
 
+SEARCH_MODES = {
+    "ハイブリッド": MODE_HYBRID,
+    "ベクトル": MODE_VECTOR,
+    "キーワードのみ（高速・API不要）": MODE_KEYWORD,
+}
+search_mode = st.radio("検索モード", list(SEARCH_MODES), horizontal=True)
+
+# 絞り込み（ChromaDBの where に変換して検索と同時に絞る）
+with st.expander("🔎 絞り込み"):
+    col_from, col_to = st.columns(2)
+    date_from = col_from.date_input("開始日", value=None)
+    date_to = col_to.date_input("終了日", value=None)
+    title_filter = st.text_input("タイトルに含む", placeholder="例: Python")
+    col_min, col_max = st.columns(2)
+    min_messages = col_min.number_input("メッセージ数（以上）", min_value=0, value=None, step=1)
+    max_messages = col_max.number_input("メッセージ数（以下）", min_value=0, value=None, step=1)
+filters = make_filters(date_from, date_to, title_filter, min_messages, max_messages)
+
+# 並べ替え（上位50件の中で、似た会話を後ろに回す・新しい会話を前に出す）
+with st.expander("🎛️ 並べ替え"):
+    diversity = st.slider("多様性（似た会話を後ろに回す）", 0.0, 1.0, DEFAULT_DIVERSITY, 0.1)
+    recency = st.slider("新しさ（新しい会話を前に出す）", 0.0, 1.0, DEFAULT_RECENCY, 0.1)
+rerank = make_rerank(diversity, recency)
+
+# 1ページの表示件数（検索条件が変わったら1ページ目に戻す）
+PAGE_SIZES = [5, 10, 20, 50]
+page_size = st.selectbox("表示件数", PAGE_SIZES)
+search_signature = (query, search_mode, json.dumps(filters, sort_keys=True), json.dumps(rerank, sort_keys=True), page_size)
+if st.session_state.get('search_signature') != search_signature:
+    st.session_state['search_signature'] = search_signature
+    st.session_state['page'] = 0
+
+def move_page(delta):
+    st.session_state['page'] = max(0, st.session_state['page'] + delta)
+
 if query:
     try:
-        # OpenAI Embeddingsでクエリをベクトル化
-        response = client.embeddings.create(
-            input=query,
-            model="text-embedding-3-small"
-        )
-        query_embedding = response.data[0].embedding
+        # 会話単位の順位だけを付けてキャッシュし、表示するページの分だけ本文を取ってくる
+        # （ハイブリッドはベクトルとBM25をRRFで融合。同じ条件の検索・ページ送りは検索し直さない）
+        # 順位付け・本文の取得・描画の時間を計って、サイドバーに内訳を出す
+        with trace('search', log=metrics_log) as search_trace:
+            st.session_state['last_trace'] = search_trace
+            mode = SEARCH_MODES[search_mode]
+            if embedder_error and mode != MODE_KEYWORD:
+                raise EmbedderMismatch(embedder_error)
+            offset = st.session_state['page'] * page_size
+            depth = rank_depth(offset, page_size, rerank)
+            cache_key = make_key(query, depth, mode, filters, meta.collection_version(), rerank)
+            (ranked, results), cache_hit = query_cache.get_or_compute(
+                cache_key,
+                lambda: rank_conversations(collection, embed_fn, query, depth, mode=mode, keyword_index=keyword_index,
+                                           filters=filters, catalog=title_catalog, duplicates=duplicate_index,
+                                           rerank=rerank, vector_index=vector_index)
+            )
+            hits = attach_related(fetch_documents(collection, ranked[offset:offset + page_size]), related_index)
+            has_next = len(ranked) > offset + page_size
         
-        # ChromaDBで検索
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=5
-        )
+            search_trace.attrs.update(mode=mode, cache_hit=cache_hit, offset=offset, results=len(hits))
         
-        st.subheader(f"検索結果: {len(results['documents'][0])} 件")
+            # Streamlitの要素を組み立てる時間（ブラウザでの描画は含まない）
+            with metrics.timer('render'):
+                if hits:
+                    st.subheader(f"検索結果: {offset + 1}〜{offset + len(hits)} 件目")
+                else:
+                    st.subheader("検索結果: 0 件")
+                if cache_hit:
+                    st.caption("⚡ キャッシュから表示しています")
         
-        # 結果がない場合
-        if len(results['documents'][0]) == 0:
-            st.info("🔍 検索結果が見つかりませんでした")
-        else:
-            # 結果表示
-            for i, (doc, metadata, distance) in enumerate(zip(
-                results['documents'][0],
-                results['metadatas'][0],
-                results['distances'][0]
-            )):
-                # タイトルと日付
-                title = metadata.get('title', '(無題)')
-                created_at = metadata.get('created_at', 'N/A')
-                if created_at != 'N/A' and len(created_at) >= 10:
-                    date_str = created_at[:10]
+                # 結果がない場合
+                if len(hits) == 0:
+                    st.info("🔍 検索結果が見つかりませんでした")
                 else:
-                    date_str = 'N/A'
+                    # 結果表示
+                    for i, hit in enumerate(hits, start=offset):
+                        # タイトルと日付
+                        title = hit['title']
+                        created_at = hit['created_at'] or 'N/A'
+                        if created_at != 'N/A' and len(created_at) >= 10:
+                            date_str = created_at[:10]
+                        else:
+                            date_str = 'N/A'
                 
-                # 類似度スコア
-                similarity = 1 - distance
+                        # 類似度スコア（キーワード/ハイブリッドはBM25・RRFのスコア）
+                        if hit['similarity'] is not None and mode == MODE_VECTOR:
+                            score_str = f"類似度: {hit['similarity']:.3f}"
+                        else:
+                            score_str = f"スコア: {hit['score']:.3f}"
+                        doc = hit['document']
+                        similar = hit.get('similar') or []
+                        similar_str = f" 🔁 似た会話 {len(similar)} 件" if similar else ""
                 
-                with st.expander(f"📄 {i+1}. {title} - {date_str} (類似度: {similarity:.3f})", expanded=(i==0)):
-                    st.markdown(f"**メッセージ数:** {metadata.get('message_count', 'N/A')} 件")
-                    st.markdown(f"**チャットID:** `{metadata.get('chat_id', 'N/A')}`")
-                    st.divider()
+                        with st.expander(f"📄 {i+1}. {title} - {date_str} ({score_str}){similar_str}", expanded=(i==offset)):
+                            st.markdown(f"**メッセージ数:** {hit['message_count'] or 'N/A'} 件")
+                            st.markdown(f"**チャットID:** `{hit['chat_id']}`")
+                            if hit['msg_start'] is not None:
+                                st.markdown(
+                                    f"**ヒット箇所:** メッセージ {hit['msg_start'] + 1}〜{hit['msg_end'] + 1} "
+                                    f"（チャンク {hit['chunk_index'] + 1}/{hit['chunk_count']}、一致チャンク {hit['matched_chunks']} 件）"
+                                )
+                            st.divider()
                     
-                    # 内容プレビュー
-                    st.markdown("**内容プレビュー:**")
-                    if len(doc) > 500:
-                        st.text(doc[:500] + "...")
-                        # 全文表示ボタン
-                        if st.button(f"全文を表示", key=f"show_full_{i}"):
-                            st.text(doc)
-                    else:
-                        st.text(doc)
+                            # 内容プレビュー（ヒットしたチャンクのスニペット）
+                            st.markdown("**内容プレビュー:**")
+                            # スニペットは SNIPPET_CHARS 文字で切ってある。それより短ければ切れていない
+                            # （古い形式ではチャンク全体が入っているので、ここで切る）
+                            st.text(doc[:SNIPPET_CHARS] + "..." if len(doc) >= SNIPPET_CHARS else doc)
+                            # 全文表示ボタン（押されたときだけ全文を読み込む）
+                            if st.button(f"全文を表示", key=f"show_full_{hit['chat_id']}"):
+                                st.text(load_full_text(collection, document_store, hit['chat_id']))
+                            
+                            # 近い重複（フォーク・再生成した会話）。全文は重複の分も保存してある
+                            if similar:
+                                st.divider()
+                                st.markdown(f"**🔁 似た会話 {len(similar)} 件:**")
+                                for similar_id, similar_title in similar:
+                                    st.markdown(f"- {similar_title} `{similar_id}`")
+                                    if st.button("全文を表示", key=f"show_full_{hit['chat_id']}_{similar_id}"):
+                                        st.text(load_full_text(collection, document_store, similar_id))
+                            
+                            # 関連する会話（インポート時に作ったグラフから。検索し直さない）
+                            related = hit.get('related') or []
+                            if related:
+                                st.divider()
+                                st.markdown(f"**🔗 関連する会話 {len(related)} 件:**")
+                                for related_id, related_title, related_score in related:
+                                    st.markdown(f"- {related_title}（類似度: {related_score:.3f}） `{related_id}`")
+                                    if st.button("全文を表示", key=f"show_related_{hit['chat_id']}_{related_id}"):
+                                        st.text(load_full_text(collection, document_store, related_id))
         
-        # デバッグ情報
-        with st.expander("🔍 デバッグ情報（開発用）"):
+        # ページ送り
+        col_prev, col_next = st.columns(2)
+        col_prev.button("◀ 前へ", on_click=move_page, args=(-1,), disabled=offset == 0)
+        col_next.button("次へ ▶", on_click=move_page, args=(1,), disabled=not has_next)
+        
+        # デバッグ情報（チェックしたときだけ生の結果を送る）
+        if st.checkbox("🔍 デバッグ情報（開発用）を表示"):
             st.write("results の構造:")
-            st.json(results)
-            st.write(f"documents の長さ: `{len(results['documents'][0])}`")
-            st.write(f"metadatas の長さ: `{len(results['metadatas'][0])}`")
+            st.json(results, expanded=False)
+            if 'vector' in results:
+                st.write(f"ベクトル検索のチャンク数: `{len(results['vector']['ids'][0])}`")
+            if 'keyword' in results:
+                st.write(f"キーワード検索のチャンク数: `{len(results['keyword']['ids'])}`")
             
     except Exception as e:
-        st.error(f"検索エラー: {str(e)}")
\ No newline at end of file
+        st.error(f"検索エラー: {str(e)}")
+
+# 処理時間の内訳（直近の検索）と、Prometheus形式のメトリクス
+# 検索のあとに描画するので、サイドバーの一番下に出る
+with st.sidebar.expander("⏱️ 処理時間"):
+    last_trace = st.session_state.get('last_trace')
+    if last_trace is None:
+        st.caption("検索すると、直近の検索の内訳を表示します")
+    else:
+        st.metric("直近の検索", f"{last_trace.total * 1000:.0f} ms")
+        if last_trace.attrs.get('cache_hit'):
+            st.caption("⚡ 順位付けは検索結果キャッシュから")
+        for name, count, ms in last_trace.breakdown():
+            times = f"（{count}回）" if count > 1 else ""
+            st.text(f"{TIMING_LABELS.get(name, name)}: {ms:.1f} ms{times}")
+    st.download_button("📈 メトリクスをダウンロード", metrics.to_prometheus(),
+                       file_name="memory_layer.prom", mime="text/plain")
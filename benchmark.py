@@ -0,0 +1,561 @@
+"""合成したエクスポートでインポートと検索の性能を測るベンチマーク
+
+    python benchmark.py --conversations 10000 --output bench_10k.json
+    python benchmark.py --conversations 10000 --baseline bench_10k.json   # 前回の結果と比べる
+
+EmbeddingはAPIを呼ばない決定的な HashingEmbedder を使うので、何度実行しても同じデータ・同じ結果になる。
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from dedup import DuplicateIndex
+from docstore import DocumentStore
+from embedders import FAKE_DIMENSION, HashingEmbedder
+from embedding_cache import CachedEmbedder, EmbeddingCache
+from flat_index import DTYPE_FLOAT16, DTYPE_INT8, FlatIndex
+from formats import iter_conversations
+from ingest import run_import
+from keyword_index import KeywordIndex
+from metastore import MetaStore
+from metrics import metrics
+from query_cache import normalize_query
+from related import RelatedIndex
+from rerank import DEFAULT_DIVERSITY, make_rerank
+from search import MODE_HYBRID, MODE_KEYWORD, MODE_VECTOR, search
+from store import open_collection
+from tenants import TenantPool
+
+# 既定の規模と検索回数
+DEFAULT_CONVERSATIONS = 1000
+DEFAULT_QUERIES = 200
+WARMUP_QUERIES = 10
+# HTTP APIのウォームアップ用の検索語を作るときのシード
+WARMUP_SEED = -1
+
+# メッセージの長さ（文字数）は対数正規分布: 中央値と広がり
+DEFAULT_MEDIAN_CHARS = 300
+DEFAULT_SIGMA = 1.0
+
+# 1会話あたりのメッセージ数の範囲
+DEFAULT_MIN_MESSAGES = 2
+DEFAULT_MAX_MESSAGES = 40
+
+# ベクトル索引の比較で取るチャンク数（recall@k の k）
+VECTOR_RECALL_K = 50
+
+# HTTP APIの検索の目標（p95、ミリ秒）と、まとめて検索で1回に送るクエリ数
+DEFAULT_SLO_P95_MS = 100.0
+SERVER_BATCH_SIZE = 20
+
+# 直前の会話をフォークして最後の返答だけ作り直した会話の割合（近い重複の検出を測る）
+DEFAULT_FORK_RATIO = 0.0
+
+# 話題ごとの語彙（日本語, 英語）。同じ話題の会話と検索語は語を共有する
+TOPICS = [
+    ("Python ベクトル 検索 埋め込み 類似度 インデックス 近傍 次元",
+     "python vector search embedding similarity index neighbor dimension"),
+    ("料理 レシピ 味噌汁 出汁 醤油 砂糖 焼き魚 献立",
+     "cooking recipe soup broth soy sugar grilled menu"),
+    ("マイクロ波 実験 共振器 周波数 測定 アンテナ 損失 回路",
+     "microwave experiment resonator frequency measurement antenna loss circuit"),
+    ("旅行 京都 新幹線 ホテル 予約 観光 温泉 紅葉",
+     "travel kyoto train hotel booking sightseeing onsen autumn"),
+    ("機械学習 モデル 学習 損失関数 勾配 過学習 検証 精度",
+     "machine learning model training loss gradient overfitting validation accuracy"),
+    ("投資 株式 配当 積立 リスク 分散 為替 金利",
+     "investing stocks dividend savings risk diversification currency interest"),
+    ("健康 睡眠 運動 ランニング 食事 体重 ストレッチ 習慣",
+     "health sleep exercise running diet weight stretching habit"),
+    ("データベース SQL インデックス トランザクション 結合 クエリ 正規化 バックアップ",
+     "database sql index transaction join query normalization backup"),
+    ("音楽 ギター コード 練習 作曲 録音 リズム 演奏",
+     "music guitar chord practice composing recording rhythm performance"),
+    ("育児 保育園 離乳食 絵本 昼寝 予防接種 おむつ 散歩",
+     "parenting daycare baby food picture book nap vaccination diaper walk"),
+]
+COMMON_JA = "について 教えて ください これ それ 方法 理由 場合 例えば 確認 説明 問題 結果 考え 次に".split()
+COMMON_EN = "about please explain this that method reason case example check result problem idea next how".split()
+JA_PARTICLES = ["の", "を", "は", "で", "と", "に", "が"]
+
+
+def _topic_words(topic, lang):
+    ja, en = TOPICS[topic]
+    return (ja if lang == 'ja' else en).split()
+
+
+def make_text(rng, topic, lang, n_chars):
+    """話題の語と一般的な語を混ぜた、だいたい n_chars 文字のテキスト"""
+    words = _topic_words(topic, lang)
+    common = COMMON_JA if lang == 'ja' else COMMON_EN
+    parts = []
+    length = 0
+    while length < n_chars:
+        sentence = []
+        for _ in range(rng.randint(4, 10)):
+            sentence.append(rng.choice(words) if rng.random() < 0.5 else rng.choice(common))
+            if lang == 'ja':
+                sentence.append(rng.choice(JA_PARTICLES))
+        text = ''.join(sentence) + '。' if lang == 'ja' else ' '.join(sentence).capitalize() + '.'
+        parts.append(text)
+        length += len(text)
+    return ('' if lang == 'ja' else ' ').join(parts)
+
+
+def generate_export(path, n_conversations, seed=0, ja_ratio=0.5, median_chars=DEFAULT_MEDIAN_CHARS,
+                    sigma=DEFAULT_SIGMA, min_messages=DEFAULT_MIN_MESSAGES, max_messages=DEFAULT_MAX_MESSAGES,
+                    fork_ratio=DEFAULT_FORK_RATIO):
+    """Claude.ai形式の conversations.json を書き出す（1会話ずつ書くので件数が多くてもメモリは増えない）
+
+    fork_ratio の割合で、直前の会話のメッセージをコピーして最後のメッセージだけ作り直した会話を混ぜる。
+    """
+    rng = random.Random(seed)
+    started = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    total_messages = 0
+    forks = 0
+    previous = None  # (話題, 言語, 作成日時, メッセージ)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[\n')
+        for i in range(n_conversations):
+            if previous is not None and len(previous[3]) >= 2 and rng.random() < fork_ratio:
+                # フォーク・再生成：最後のメッセージ以外は同じ
+                topic, lang, created, base = previous
+                last = dict(base[-1], uuid=f"msg-{i}-{len(base) - 1}")
+                n_chars = max(10, int(rng.lognormvariate(math.log(median_chars), sigma)))
+                last['content'] = [{'type': 'text', 'text': make_text(rng, topic, lang, n_chars)}]
+                messages = [dict(m, uuid=f"msg-{i}-{j}") for j, m in enumerate(base[:-1])] + [last]
+                forks += 1
+            else:
+                topic = rng.randrange(len(TOPICS))
+                lang = 'ja' if rng.random() < ja_ratio else 'en'
+                created = started + timedelta(minutes=rng.randrange(2 * 365 * 24 * 60))
+                messages = []
+                for j in range(rng.randint(min_messages, max_messages)):
+                    n_chars = max(10, int(rng.lognormvariate(math.log(median_chars), sigma)))
+                    ts = (created + timedelta(minutes=j)).isoformat().replace('+00:00', 'Z')
+                    messages.append({
+                        'uuid': f"msg-{i}-{j}",
+                        'sender': 'human' if j % 2 == 0 else 'assistant',
+                        'created_at': ts,
+                        'content': [{'type': 'text', 'text': make_text(rng, topic, lang, n_chars)}],
+                    })
+                previous = (topic, lang, created, messages)
+            total_messages += len(messages)
+            conversation = {
+                'uuid': f"bench-{seed}-{i:06d}",
+                'name': f"{_topic_words(topic, lang)[0]} {i}",
+                'created_at': created.isoformat().replace('+00:00', 'Z'),
+                'updated_at': messages[-1]['created_at'],
+                'chat_messages': messages,
+            }
+            if i:
+                f.write(',\n')
+            json.dump(conversation, f, ensure_ascii=False)
+        f.write('\n]\n')
+    return {'conversations': n_conversations, 'messages': total_messages, 'forks': forks,
+            'bytes': os.path.getsize(path)}
+
+
+def make_queries(n_queries, seed=0, ja_ratio=0.5):
+    """話題の語を2〜3個並べた検索語"""
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(n_queries):
+        lang = 'ja' if rng.random() < ja_ratio else 'en'
+        words = rng.sample(_topic_words(rng.randrange(len(TOPICS)), lang), rng.randint(2, 3))
+        queries.append(' '.join(words))
+    return queries
+
+
+def make_warmup_queries(queries, n=WARMUP_QUERIES):
+    """queries と重ならないウォームアップ用の検索語（同じ語で温めると、計測する検索が検索結果キャッシュに当たる）"""
+    measured = {normalize_query(query) for query in queries}
+    candidates = make_queries(n * 20, WARMUP_SEED)
+    return [query for query in dict.fromkeys(candidates) if normalize_query(query) not in measured][:n]
+
+
+def percentile(values, p):
+    """線形補間したパーセンタイル（values はソート済み）"""
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lower = math.floor(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def latency_summary(latencies_ms, elapsed):
+    latencies_ms = sorted(latencies_ms)
+    return {
+        'queries': len(latencies_ms),
+        'qps': round(len(latencies_ms) / elapsed, 2) if elapsed > 0 else None,
+        'mean_ms': round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else None,
+        'p50_ms': round(percentile(latencies_ms, 50), 3) if latencies_ms else None,
+        'p95_ms': round(percentile(latencies_ms, 95), 3) if latencies_ms else None,
+        'p99_ms': round(percentile(latencies_ms, 99), 3) if latencies_ms else None,
+        'max_ms': round(latencies_ms[-1], 3) if latencies_ms else None,
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss はLinuxではKB、macOSではバイト
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024, 1)
+
+
+def disk_size(path):
+    """ファイル（SQLiteならWALなども含む）かディレクトリの合計バイト数"""
+    if os.path.isfile(path):
+        return sum(os.path.getsize(p) for p in (path, path + '-wal', path + '-shm') if os.path.exists(p))
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class BenchStore:
+    """ベンチマーク用の作業ディレクトリに置いたストア一式"""
+
+    def __init__(self, workdir, dimension=FAKE_DIMENSION, latency=0.0):
+        self.workdir = workdir
+        self.chroma_path = os.path.join(workdir, 'chroma_db')
+        self.collection = open_collection(path=self.chroma_path)
+        # 大きさを別々に測れるよう、ChromaDB以外のストアはChromaDBのディレクトリの外に置く
+        self.keyword_index = KeywordIndex(os.path.join(workdir, 'keyword_index.sqlite'))
+        self.document_store = DocumentStore(os.path.join(workdir, 'documents.sqlite'))
+        self.meta = MetaStore(os.path.join(workdir, 'meta.sqlite'))
+        self.duplicate_index = DuplicateIndex(os.path.join(workdir, 'duplicates.sqlite'))
+        self.related_index = RelatedIndex(os.path.join(workdir, 'related.sqlite'))
+        self.cache_path = os.path.join(workdir, 'embedding_cache.sqlite')
+        embedder = HashingEmbedder(dimension, latency)
+        self.embed_fn = CachedEmbedder(embedder, EmbeddingCache(self.cache_path), embedder.model_id)
+
+    def run_import(self, export_path):
+        started = time.perf_counter()
+        with open(export_path, 'rb') as fp:
+            stats = run_import(
+                iter_conversations(fp), self.collection, self.embed_fn,
+                keyword_index=self.keyword_index, document_store=self.document_store,
+                duplicate_index=self.duplicate_index, related_index=self.related_index,
+                on_write=self.meta.bump_version, **self.embed_fn.import_options()
+            )
+        elapsed = time.perf_counter() - started
+        result = stats.to_dict()
+        result['wall_sec'] = round(elapsed, 3)
+        result['chunks_per_sec'] = round(stats.chunks / elapsed, 1) if elapsed > 0 else None
+        result['errors'] = stats.error_count
+        return result
+
+    def run_queries(self, queries, mode, n_results, rerank=None):
+        for query in queries[:WARMUP_QUERIES]:
+            search(self.collection, self.embed_fn, query, n_results=n_results, mode=mode,
+                   keyword_index=self.keyword_index, duplicates=self.duplicate_index, rerank=rerank)
+        latencies = []
+        started = time.perf_counter()
+        for query in queries:
+            t = time.perf_counter()
+            search(self.collection, self.embed_fn, query, n_results=n_results, mode=mode,
+                   keyword_index=self.keyword_index, duplicates=self.duplicate_index, rerank=rerank)
+            latencies.append((time.perf_counter() - t) * 1000)
+        return latency_summary(latencies, time.perf_counter() - started)
+
+    def compare_vector_indexes(self, queries, k=VECTOR_RECALL_K, flat_dimensions=None):
+        """ChromaDBのHNSWと総当たりの FlatIndex（float16・int8、指定があれば次元を切り詰めたint8）を比べる
+
+        float32の全ベクトルとの正確な上位k件を正解として recall@k、検索の時間、ベクトルの大きさを出す。
+        """
+        records = self.collection.get(include=['embeddings'])
+        ids = np.array(records['ids'])
+        matrix = np.asarray(records['embeddings'], dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        query_embeddings = self.embed_fn(queries)
+        truth = []
+        for embedding in query_embeddings:
+            scores = matrix @ np.asarray(embedding, dtype=np.float32)
+            truth.append(set(ids[np.argsort(-scores, kind='stable')[:k]]))
+
+        def measure(query_fn):
+            found, latencies = [], []
+            started = time.perf_counter()
+            for embedding in query_embeddings:
+                t = time.perf_counter()
+                found.append(query_fn(embedding))
+                latencies.append((time.perf_counter() - t) * 1000)
+            summary = latency_summary(latencies, time.perf_counter() - started)
+            hits = sum(len(expected & set(result)) for expected, result in zip(truth, found))
+            summary['recall'] = round(hits / max(sum(len(expected) for expected in truth), 1), 4)
+            return summary
+
+        results = {'k': k, 'vectors': len(ids)}
+        results['hnsw'] = measure(lambda e: self.collection.query(query_embeddings=[e], n_results=k, include=[])['ids'][0])
+        results['hnsw']['vector_mb'] = round(matrix.nbytes / 1024 / 1024, 2)
+        configs = [(DTYPE_FLOAT16, None), (DTYPE_INT8, None)]
+        if flat_dimensions:
+            configs.append((DTYPE_INT8, flat_dimensions))
+        for dtype, dimensions in configs:
+            name = f"flat_{dtype}" + (f"_{dimensions}d" if dimensions else "")
+            flat = FlatIndex(os.path.join(self.workdir, name), dtype=dtype, dimensions=dimensions)
+            flat.rebuild_from_collection(self.collection)
+            results[name] = measure(lambda e: flat.query([e], k)['ids'][0])
+            results[name]['vector_mb'] = round(flat.stats()['vector_bytes'] / 1024 / 1024, 2)
+        return results
+
+    def disk(self):
+        sizes = {
+            'chroma': disk_size(self.chroma_path),
+            'keyword_index': disk_size(self.keyword_index.path),
+            'documents': disk_size(self.document_store.path),
+            'duplicates': disk_size(self.duplicate_index.path),
+            'related': disk_size(self.related_index.path),
+            'embedding_cache': disk_size(self.cache_path),
+        }
+        sizes['total'] = sum(sizes.values())
+        return {key: round(value / 1024 / 1024, 2) for key, value in sizes.items()}
+
+
+def run_server_benchmark(export_path, queries, modes, n_results, embed_fn, workdir, slo_p95_ms):
+    """server.py のHTTP APIを同じプロセスで立て、インポート・検索・まとめて検索の時間を測る
+
+    EmbeddingはAPIを呼ばない embed_fn を使い、HTTPは1つのクライアントで接続を使い回す（エージェントからの使い方と同じ）。
+    検索のp95が slo_p95_ms 以下なら slo_met が true になる。
+    """
+    try:
+        import httpx
+        import uvicorn
+        from server import create_app
+    except (ImportError, RuntimeError) as e:
+        return {'error': str(e)}
+    pool = TenantPool(root=os.path.join(workdir, 'server'))
+    server = uvicorn.Server(uvicorn.Config(create_app(pool, embed_fn), host='127.0.0.1', port=0, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            return {'error': "サーバーを起動できませんでした"}
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    result = {'slo_p95_ms': slo_p95_ms}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=600) as client:
+            started = time.perf_counter()
+            with open(export_path, 'rb') as f:
+                job = client.post('/import', content=f).raise_for_status().json()
+            while job['status'] in ('queued', 'running'):
+                time.sleep(0.1)
+                job = client.get(f"/jobs/{job['job_id']}").json()
+            result['import'] = {'status': job['status'], 'wall_sec': round(time.perf_counter() - started, 3)}
+
+            warmup = make_warmup_queries(queries)
+            for mode in modes:
+                body = {'n': n_results, 'mode': mode}
+                for query in warmup:
+                    client.post('/search', json=dict(body, query=query)).raise_for_status()
+                latencies = []
+                cache_hits = 0
+                started = time.perf_counter()
+                for query in queries:
+                    t = time.perf_counter()
+                    response = client.post('/search', json=dict(body, query=query)).raise_for_status().json()
+                    latencies.append((time.perf_counter() - t) * 1000)
+                    cache_hits += response['cache_hit']
+                summary = latency_summary(latencies, time.perf_counter() - started)
+                summary['cache_hits'] = cache_hits
+                summary['slo_met'] = summary['p95_ms'] is not None and summary['p95_ms'] <= slo_p95_ms
+                result[f"search_{mode}"] = summary
+
+                latencies = []
+                started = time.perf_counter()
+                for start in range(0, len(queries), SERVER_BATCH_SIZE):
+                    t = time.perf_counter()
+                    client.post('/search/batch', json=dict(body, queries=queries[start:start + SERVER_BATCH_SIZE])).raise_for_status()
+                    latencies.append((time.perf_counter() - t) * 1000)
+                summary = latency_summary(latencies, time.perf_counter() - started)
+                summary['queries_per_batch'] = SERVER_BATCH_SIZE
+                result[f"batch_{mode}"] = summary
+    finally:
+        server.should_exit = True
+        thread.join()
+    return result
+
+
+def run_benchmark(args, workdir):
+    result = {
+        'config': {
+            'conversations': args.conversations,
+            'queries': args.queries,
+            'n_results': args.n,
+            'modes': args.modes,
+            'ja_ratio': args.ja_ratio,
+            'median_chars': args.median_chars,
+            'sigma': args.sigma,
+            'messages': [args.min_messages, args.max_messages],
+            'dimension': args.dimension,
+            'embed_latency_ms': args.embed_latency * 1000,
+            'seed': args.seed,
+            'export': args.export,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+        },
+    }
+
+    export_path = args.export
+    if export_path is None:
+        export_path = os.path.join(workdir, 'conversations.json')
+        log(f"エクスポートを生成中: {args.conversations} 件")
+        started = time.perf_counter()
+        result['generate'] = generate_export(
+            export_path, args.conversations, args.seed, args.ja_ratio, args.median_chars, args.sigma,
+            args.min_messages, args.max_messages, args.fork_ratio,
+        )
+        result['generate']['sec'] = round(time.perf_counter() - started, 3)
+
+    store = BenchStore(workdir, args.dimension, args.embed_latency)
+    log("インポート中")
+    result['import'] = store.run_import(export_path)
+    result['peak_rss_mb_after_import'] = peak_rss_mb()
+    # 2回目は変更なしの差分検知だけ（Embeddingも書き込みも起きない）
+    log("再インポート中（変更なし）")
+    result['reimport'] = store.run_import(export_path)
+
+    queries = make_queries(args.queries, args.seed, args.ja_ratio)
+    result['search'] = {}
+    for mode in args.modes:
+        log(f"検索中: {mode}")
+        result['search'][mode] = store.run_queries(queries, mode, args.n, make_rerank(args.diversity))
+
+    if args.server:
+        log("HTTP APIを計測中")
+        result['server'] = run_server_benchmark(export_path, queries, args.modes, args.n, store.embed_fn, workdir,
+                                                args.slo_p95_ms)
+
+    if args.vector_index:
+        log("ベクトル索引を比較中")
+        result['vector_index'] = store.compare_vector_indexes(queries, flat_dimensions=args.flat_dimensions)
+
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['disk_mb'] = store.disk()
+    # 処理ごとの時間（抽出・Embedding・ChromaDBの読み書き・BM25など、インポートと検索の合計）
+    result['timings'] = metrics.snapshot()['timers']
+    return result
+
+
+# 前回の結果と比べる指標（キーのパス, 大きいほど良いか）
+COMPARED_METRICS = [
+    (('import', 'conversations_per_sec'), True),
+    (('import', 'chunks_per_sec'), True),
+    (('reimport', 'wall_sec'), False),
+    (('peak_rss_mb',), False),
+    (('disk_mb', 'total'), False),
+]
+
+
+def compare(result, baseline):
+    """前回の結果との差を表にする（悪化したものに ! を付ける）"""
+    compared = list(COMPARED_METRICS)
+    for mode in result.get('search', {}):
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            compared.append((('search', mode, key), False))
+    for name, summary in result.get('vector_index', {}).items():
+        if isinstance(summary, dict):
+            compared.append((('vector_index', name, 'recall'), True))
+            compared.append((('vector_index', name, 'p50_ms'), False))
+    for name, summary in result.get('server', {}).items():
+        if isinstance(summary, dict):
+            compared.append((('server', name, 'p95_ms'), False))
+    lines = []
+    for path, higher_is_better in compared:
+        current, previous = result, baseline
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+        if not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or previous == 0:
+            continue
+        change = (current - previous) / previous
+        worse = change < 0 if higher_is_better else change > 0
+        mark = '!' if worse and abs(change) > 0.1 else ' '
+        lines.append(f"{mark} {'.'.join(path):32} {previous:>12.3f} -> {current:>12.3f} ({change:+.1%})")
+    return '\n'.join(lines)
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成エクスポートでインポートと検索のベンチマークを取る")
+    parser.add_argument('--conversations', type=int, default=DEFAULT_CONVERSATIONS, help="生成する会話数")
+    parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES, help="モードごとの検索回数")
+    parser.add_argument('-n', type=int, default=5, help="1回の検索で返す会話数")
+    parser.add_argument('--diversity', type=float, default=DEFAULT_DIVERSITY, help="MMRの多様性（0で並べ替えなし）")
+    parser.add_argument('--modes', nargs='+', default=[MODE_VECTOR, MODE_KEYWORD, MODE_HYBRID],
+                        choices=[MODE_VECTOR, MODE_KEYWORD, MODE_HYBRID])
+    parser.add_argument('--ja-ratio', type=float, default=0.5, help="日本語の会話の割合")
+    parser.add_argument('--median-chars', type=int, default=DEFAULT_MEDIAN_CHARS, help="メッセージの長さの中央値（文字）")
+    parser.add_argument('--sigma', type=float, default=DEFAULT_SIGMA, help="メッセージの長さの広がり（対数正規分布）")
+    parser.add_argument('--min-messages', type=int, default=DEFAULT_MIN_MESSAGES)
+    parser.add_argument('--max-messages', type=int, default=DEFAULT_MAX_MESSAGES)
+    parser.add_argument('--fork-ratio', type=float, default=DEFAULT_FORK_RATIO,
+                        help="直前の会話をフォーク・再生成した会話の割合（近い重複の検出を測る）")
+    parser.add_argument('--dimension', type=int, default=FAKE_DIMENSION, help="Embeddingの次元数")
+    parser.add_argument('--embed-latency', type=float, default=0.0, help="Embedding1回あたりに待つ秒数（APIの待ち時間の代わり）")
+    parser.add_argument('--server', action='store_true',
+                        help="server.py のHTTP APIのインポート・検索の時間を測る（fastapi・uvicornが必要）")
+    parser.add_argument('--slo-p95-ms', type=float, default=DEFAULT_SLO_P95_MS, help="HTTP APIの検索のp95の目標（ミリ秒）")
+    parser.add_argument('--vector-index', action='store_true',
+                        help="HNSWと総当たりの索引（float16・int8）の recall・検索時間・大きさを比べる")
+    parser.add_argument('--flat-dimensions', type=int, help="--vector-index で、先頭の次元だけ使うint8の索引も比べる")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--export', help="生成せずにこのエクスポートを使う")
+    parser.add_argument('--workdir', help="作業ディレクトリ（省略時は一時ディレクトリを作って最後に消す）")
+    parser.add_argument('--output', help="結果のJSONの保存先")
+    parser.add_argument('--baseline', help="比べる前回の結果のJSON")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='memory_layer_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        result = run_benchmark(args, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            log(compare(result, json.load(f)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,34 @@
-import json
+import heapq
+import sys
 
-file_path = "/Users/hayato/Downloads/claude_chat_data/conversations.json"
+from json_stream import open_array
+
+# python check_claude_data.py [conversations.json のパス]
+file_path = sys.argv[1] if len(sys.argv) > 1 else "/Users/hayato/Downloads/claude_chat_data/conversations.json"
 
 print("読み込み中...")
-with open(file_path, 'r', encoding='utf-8') as f:
-    data = json.load(f)
 
-print(f"\n=== 会話数: {len(data)} 件 ===\n")
+# 1会話ずつ読み、メッセージ数が多い上位3件だけを手元に残す
+total_count = 0
+with_messages_count = 0
+top = []
+for idx, conv in enumerate(open_array(file_path)):
+    total_count += 1
+    message_count = len(conv.get('chat_messages') or [])
+    if message_count > 0:
+        with_messages_count += 1
+        item = (message_count, -idx, conv)
+        if len(top) < 3:
+            heapq.heappush(top, item)
+        else:
+            heapq.heappushpop(top, item)
+
+print(f"\n=== 会話数: {total_count} 件 ===\n")
 
 # メッセージ数でソート
-conversations_with_messages = [
-    conv for conv in data 
-    if conv.get('chat_messages') and len(conv['chat_messages']) > 0
-]
-conversations_with_messages.sort(key=lambda x: len(x['chat_messages']), reverse=True)
+conversations_with_messages = [conv for _, _, conv in sorted(top, key=lambda x: (x[0], x[1]), reverse=True)]
 
-print(f"メッセージがある会話: {len(conversations_with_messages)} 件\n")
+print(f"メッセージがある会話: {with_messages_count} 件\n")
 
 # 上位3件を表示
 print("=== メッセージ数が多い会話 Top 3 ===")
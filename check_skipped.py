@@ -1,16 +1,18 @@
-import json
+import sys
 
-file_path = "/Users/hayato/Downloads/claude_chat_data/conversations.json"
+from json_stream import open_array
 
-with open(file_path, 'r', encoding='utf-8') as f:
-    data = json.load(f)
+# python check_skipped.py [conversations.json のパス]
+file_path = sys.argv[1] if len(sys.argv) > 1 else "/Users/hayato/Downloads/claude_chat_data/conversations.json"
 
 # スキップされた会話を調査（インデックス1, 2, 3, 4, 5, 6, 11, 28）
 skip_indices = [1, 2, 3, 4, 5, 6, 11, 28]
 
-for idx in skip_indices:
-    if idx < len(data):
-        conv = data[idx]
+# 1会話ずつ読み、対象のインデックスだけを見る
+for idx, conv in enumerate(open_array(file_path)):
+    if idx > max(skip_indices):
+        break
+    if idx in skip_indices:
         title = conv.get('name', '(無題)')
         messages = conv.get('chat_messages', [])
         
@@ -0,0 +1,113 @@
+# チャンクの大きさ（トークン数）と、前のチャンクと重ねるトークン数
+CHUNK_MAX_TOKENS = 1000
+CHUNK_OVERLAP_TOKENS = 150
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+
+def estimate_tokens(text):
+    """テキストのトークン数を見積もる（tiktokenがなければ文字種から概算）"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # ASCIIは約4文字で1トークン、日本語などは1文字1トークン強として多めに見積もる
+    ascii_count = len(text.encode('ascii', 'ignore'))
+    return (len(text) - ascii_count) * 3 // 2 + ascii_count // 4 + 1
+
+
+def _split_long_text(text, tokens, max_tokens):
+    # 1メッセージだけで上限を超える場合は文字数で等分する
+    n_parts = tokens // max_tokens + 1
+    size = len(text) // n_parts + 1
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def chunk_messages(lines, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """メッセージ単位の行リストを、メッセージの境界で区切ったチャンクに分ける
+
+    lines は (メッセージ番号, "[sender]: text") のリスト（1要素 = 1メッセージ）。
+    各チャンクは max_tokens 以内に収め、直前のチャンク末尾のメッセージを
+    overlap_tokens ぶんまで重ねて持たせる。
+    戻り値は {'text', 'tokens', 'msg_start', 'msg_end'} のリスト（msg_endは含む）。
+    """
+    # (メッセージ番号, テキスト, トークン数) の列にする。長すぎるメッセージは分割する
+    pieces = []
+    for msg_idx, line in lines:
+        tokens = estimate_tokens(line)
+        if tokens > max_tokens:
+            for part in _split_long_text(line, tokens, max_tokens):
+                pieces.append((msg_idx, part, estimate_tokens(part)))
+        else:
+            pieces.append((msg_idx, line, tokens))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def emit():
+        chunks.append({
+            'text': '\n'.join(p[1] for p in current),
+            'tokens': current_tokens,
+            'msg_start': current[0][0],
+            'msg_end': current[-1][0],
+        })
+
+    for piece in pieces:
+        if current and current_tokens + piece[2] > max_tokens:
+            emit()
+            # 末尾から overlap_tokens に収まるぶんだけ次のチャンクに持ち越す
+            carried = []
+            carried_tokens = 0
+            for prev in reversed(current):
+                if carried_tokens + prev[2] > overlap_tokens or carried_tokens + prev[2] + piece[2] > max_tokens:
+                    break
+                carried.insert(0, prev)
+                carried_tokens += prev[2]
+            current = carried
+            current_tokens = carried_tokens
+        current.append(piece)
+        current_tokens += piece[2]
+
+    if current:
+        emit()
+    return chunks
+
+
+def _overlap_length(text, chunk_text):
+    # chunk_text の先頭の何行かが text の末尾の何行かと同じなら、その長さ（重なりがなければ0）
+    cuts = [i for i, c in enumerate(chunk_text) if c == '\n'] + [len(chunk_text)]
+    for cut in reversed(cuts):
+        if cut > len(text):
+            continue
+        if cut < len(text) and text[-cut - 1] != '\n':
+            continue
+        if text.endswith(chunk_text[:cut]):
+            return cut
+    return 0
+
+
+def join_chunks(chunks):
+    """chunk_messages で分けたチャンクを、重ねた部分を除いて1つのテキストに戻す
+
+    chunks は (msg_start, msg_end, text) のチャンク順のリスト。
+    前のチャンクと同じメッセージから始まるチャンクだけ、先頭の重なりを探して取り除く。
+    重なりがなければ、長すぎて分割したメッセージの続きなので改行を挟まずにつなげる。
+    """
+    text = ''
+    prev_end = None
+    for msg_start, msg_end, chunk_text in chunks:
+        chunk_text = chunk_text or ''
+        separator = '\n'
+        if prev_end is not None and msg_start is not None and msg_start <= prev_end:
+            cut = _overlap_length(text, chunk_text)
+            if cut:
+                chunk_text = chunk_text[cut + 1:]
+            else:
+                separator = ''
+        if chunk_text:
+            text = f"{text}{separator}{chunk_text}" if text else chunk_text
+        prev_end = msg_end
+    return text
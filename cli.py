@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from embedders import BACKEND_OPENAI, BACKENDS
+from filters import make_filters
+from flat_index import DTYPE_INT8
+from formats import ADAPTERS, iter_conversations
+from ingest import run_import
+from journal import fingerprint
+from metrics import JsonLinesLog, metrics, trace
+from rerank import DEFAULT_DIVERSITY, DEFAULT_RECENCY, make_rerank
+from search import MODE_HYBRID, MODE_KEYWORD, MODE_VECTOR, attach_related, search, search_batch
+from store import VECTOR_ENGINE_CHROMA, EmbedderMismatch, bind_embedder, make_embedder
+from tenants import Tenant, tenant_id
+
+SECRETS_PATH = ".streamlit/secrets.toml"
+
+
+def load_setting(name, default=None):
+    """環境変数、なければStreamlitと同じ secrets.toml から設定を読む"""
+    value = os.environ.get(name)
+    if value:
+        return value
+    if os.path.exists(SECRETS_PATH):
+        import tomllib
+        with open(SECRETS_PATH, 'rb') as f:
+            value = tomllib.load(f).get(name)
+    return value if value else default
+
+
+def load_api_key():
+    api_key = load_setting("OPENAI_API_KEY")
+    if not api_key:
+        sys.exit("OPENAI_API_KEY が設定されていません（環境変数か .streamlit/secrets.toml）")
+    return api_key
+
+
+def load_embedder(args, collection, meta):
+    """--embedder などの指定（なければ EMBEDDER などの設定）からEmbedderを作り、コレクションと照合する"""
+    backend = args.embedder or load_setting("EMBEDDER", BACKEND_OPENAI)
+    threads = args.threads or load_setting("EMBEDDING_THREADS")
+    embed_fn = make_embedder(
+        load_api_key() if backend == BACKEND_OPENAI else None,
+        backend=backend,
+        model=args.embedding_model or load_setting("EMBEDDING_MODEL"),
+        threads=int(threads) if threads else None,
+        runtime=load_setting("EMBEDDING_RUNTIME", "torch"),
+    )
+    try:
+        bind_embedder(meta, collection, embed_fn)
+    except EmbedderMismatch as e:
+        sys.exit(str(e))
+    return embed_fn
+
+
+class ProgressBar:
+    """標準エラーに出す簡単なプログレスバー"""
+
+    def __init__(self, stream=sys.stderr, width=30):
+        self.stream = stream
+        self.width = width
+        self._last = 0.0
+
+    def __call__(self, done, total, stats):
+        now = time.monotonic()
+        # 描画しすぎないように0.2秒おき（最後は必ず描く）
+        if now - self._last < 0.2 and done != total:
+            return
+        self._last = now
+        rate = stats.processed / stats.elapsed if stats.elapsed > 0 else 0.0
+        if total:
+            filled = int(self.width * done / total)
+            bar = '#' * filled + '.' * (self.width - filled)
+            eta = (total - done) / rate if rate > 0 else 0
+            line = f"[{bar}] {done}/{total} {rate:.1f}件/秒 残り{eta:.0f}秒"
+        else:
+            line = f"{done}件 {rate:.1f}件/秒"
+        self.stream.write(f"\r{line} (新規 {stats.new_count} / 更新 {stats.updated_count} / エラー {stats.error_count})")
+        self.stream.flush()
+
+    def close(self):
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+def load_tenant(args):
+    """--workspace（なければ設定 WORKSPACE）のストア一式を開く。どちらもなければ ./chroma_db 直下
+
+    設定 VECTOR_ENGINE=flat なら量子化した総当たりの索引も開く（VECTOR_DTYPE・VECTOR_DIMENSIONS）。
+    """
+    dimensions = load_setting("VECTOR_DIMENSIONS")
+    return Tenant(
+        tenant_id(args.workspace or load_setting("WORKSPACE")),
+        vector_engine=load_setting("VECTOR_ENGINE", VECTOR_ENGINE_CHROMA),
+        vector_dtype=load_setting("VECTOR_DTYPE", DTYPE_INT8),
+        vector_dimensions=int(dimensions) if dimensions else None,
+    )
+
+
+def open_metrics_log(args):
+    """--metrics-log（なければ設定 METRICS_LOG）にトレースをJSON Linesで追記する"""
+    path = args.metrics_log or load_setting("METRICS_LOG")
+    return JsonLinesLog(path) if path else None
+
+
+def print_timings(current, stream=sys.stderr):
+    print(f"処理時間: {current.total * 1000:.1f} ms", file=stream)
+    for name, count, ms in current.breakdown():
+        times = f" ({count}回)" if count > 1 else ""
+        print(f"  {name}: {ms:.1f} ms{times}", file=stream)
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日付は YYYY-MM-DD で指定してください: {value}")
+
+
+def count_conversations(path, format=None):
+    with open(path, 'rb') as fp:
+        return sum(1 for _ in iter_conversations(fp, format))
+
+
+def cmd_import(args):
+    tenant = load_tenant(args)
+    collection = tenant.collection
+    meta = tenant.meta
+    embed_fn = load_embedder(args, collection, meta)
+
+    total = None if args.no_count else count_conversations(args.path, args.format)
+    progress = None if args.quiet else ProgressBar()
+
+    # バッチサイズ・並列数・レート制限はEmbedderの既定値を使う（--concurrency で上書き）
+    options = embed_fn.import_options()
+    if args.concurrency:
+        options['concurrency'] = args.concurrency
+
+    # 同じファイルのインポートが途中で止まっていれば、完了済みの会話を飛ばして続きから再開する
+    journal = tenant.journal
+    with open(args.path, 'rb') as fp:
+        job_key = fingerprint(fp)
+        if args.restart:
+            journal.discard(job_key)
+        checkpoint = journal.open(job_key, os.path.abspath(args.path), total)
+        if checkpoint.resumed and not args.quiet:
+            print(f"前回の続きから再開します（{checkpoint.resumed} 件完了済み）", file=sys.stderr)
+        with trace('import', log=open_metrics_log(args)):
+            stats = run_import(
+                iter_conversations(fp, args.format), collection, embed_fn,
+                on_progress=progress, delete_missing=not args.keep_missing, total=total,
+                keyword_index=tenant.keyword_index, on_write=meta.bump_version,
+                checkpoint=checkpoint, document_store=tenant.document_store,
+                duplicate_index=tenant.duplicate_index, vector_index=tenant.vector_index,
+                related_index=tenant.related_index, **options,
+            )
+    if progress:
+        progress.close()
+
+    summary = stats.to_dict()
+    summary['source'] = os.path.abspath(args.path)
+    summary['collection_count'] = collection.count()
+    summary['cache'] = embed_fn.stats()
+    # 抽出・Embedding・書き込みなどの処理ごとの時間（Embeddingは並列なので合計は経過時間を超える）
+    summary['timings'] = metrics.snapshot()['timers']
+    summary['error_logs'] = stats.error_logs
+    if args.metrics_out:
+        with open(args.metrics_out, 'w', encoding='utf-8') as f:
+            f.write(metrics.to_prometheus())
+    output = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+    return 1 if stats.error_count else 0
+
+
+def cmd_search(args):
+    tenant = load_tenant(args)
+    collection = tenant.collection
+    meta = tenant.meta
+    # キーワード検索はEmbeddingを使わないのでキーもモデルも不要
+    embed_fn = load_embedder(args, collection, meta) if args.mode != MODE_KEYWORD else None
+
+    filters = make_filters(args.date_from, args.date_to, args.title, args.min_messages, args.max_messages)
+    with trace('search', log=open_metrics_log(args)) as current:
+        hits, _ = search(collection, embed_fn, args.query, n_results=args.n, mode=args.mode,
+                         keyword_index=tenant.keyword_index, filters=filters, catalog=tenant.title_catalog,
+                         offset=args.offset, duplicates=tenant.duplicate_index,
+                         rerank=make_rerank(args.diversity, args.recency), vector_index=tenant.vector_index)
+        hits = attach_related(hits, tenant.related_index)
+    if args.timings:
+        print_timings(current)
+    if args.json:
+        print(json.dumps(hits, ensure_ascii=False, indent=2))
+        return 0
+    if not hits:
+        print("検索結果が見つかりませんでした")
+    for i, hit in enumerate(hits, start=args.offset):
+        score = f"類似度 {hit['similarity']:.3f}" if args.mode == MODE_VECTOR else f"スコア {hit['score']:.3f}"
+        print(f"{i + 1}. {hit['title']} - {(hit['created_at'] or 'N/A')[:10]} ({score}) [{hit['chat_id']}]")
+        preview = hit['document'].replace('\n', ' ')
+        print(f"   {preview[:200]}")
+        if hit.get('similar'):
+            print(f"   似た会話 {len(hit['similar'])} 件: " + ', '.join(title for _, title in hit['similar'][:3]))
+        if hit.get('related'):
+            print("   関連する会話: " + ', '.join(title for _, title, _ in hit['related'][:3]))
+    return 0
+
+
+def read_queries(path):
+    """1行1クエリ（空行は飛ばす）"""
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def cmd_batch_search(args):
+    tenant = load_tenant(args)
+    collection = tenant.collection
+    meta = tenant.meta
+    embed_fn = load_embedder(args, collection, meta) if args.mode != MODE_KEYWORD else None
+    queries = read_queries(args.path)
+
+    filters = make_filters(args.date_from, args.date_to, args.title, args.min_messages, args.max_messages)
+    with trace('batch_search', log=open_metrics_log(args)) as current:
+        results = search_batch(collection, embed_fn, queries, n_results=args.n, mode=args.mode,
+                               keyword_index=tenant.keyword_index, filters=filters, catalog=tenant.title_catalog,
+                               duplicates=tenant.duplicate_index, rerank=make_rerank(args.diversity, args.recency),
+                               vector_index=tenant.vector_index)
+        current.attrs.update(mode=args.mode, queries=len(queries))
+    if args.timings:
+        print_timings(current)
+    for query, hits in zip(queries, results):
+        print(json.dumps({'query': query, 'results': hits}, ensure_ascii=False))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="会話履歴のインポートと検索（Streamlitなしで実行）")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    # ワークスペース・Embedder・メトリクスの指定（importとsearchで共通）
+    embedder_options = argparse.ArgumentParser(add_help=False)
+    embedder_options.add_argument('--embedder', choices=BACKENDS, help="Embeddingのバックエンド（省略時は設定 EMBEDDER、なければopenai）")
+    embedder_options.add_argument('--embedding-model', help="Embeddingモデル名（省略時はバックエンドの既定モデル）")
+    embedder_options.add_argument('--threads', type=int, help="ローカルモデルの推論スレッド数")
+    embedder_options.add_argument('--workspace', help="ユーザー・ワークスペース名（省略時は設定 WORKSPACE、なければ分けない）")
+    embedder_options.add_argument('--metrics-log', help="処理時間の内訳をJSON Linesで追記するファイル（省略時は設定 METRICS_LOG）")
+
+    p = sub.add_parser('import', parents=[embedder_options], help="エクスポートファイルをインポートする")
+    p.add_argument('path', help="conversations.json のパス")
+    p.add_argument('--format', choices=[a.name for a in ADAPTERS], help="形式（省略時は自動判定）")
+    p.add_argument('--concurrency', type=int, help="同時に投げるEmbeddingリクエスト数（省略時はEmbedderの既定値）")
+    p.add_argument('--keep-missing', action='store_true', help="エクスポートにない会話を削除しない")
+    p.add_argument('--no-count', action='store_true', help="事前に件数を数えない（ETAは出ない）")
+    p.add_argument('--restart', action='store_true', help="途中経過を捨てて最初からやり直す")
+    p.add_argument('--summary', help="JSONサマリーの保存先")
+    p.add_argument('--quiet', action='store_true', help="プログレスバーを出さない")
+    p.add_argument('--metrics-out', help="メトリクスをPrometheusのテキスト形式で書き出すファイル（node_exporterのtextfile collector向け）")
+    p.set_defaults(func=cmd_import)
+
+    # 検索の条件（searchとbatch-searchで共通）
+    search_options = argparse.ArgumentParser(add_help=False)
+    search_options.add_argument('-n', type=int, default=5, help="表示する会話数")
+    search_options.add_argument('--mode', choices=[MODE_HYBRID, MODE_VECTOR, MODE_KEYWORD], default=MODE_HYBRID)
+    search_options.add_argument('--timings', action='store_true', help="処理時間の内訳を標準エラーに出す")
+    search_options.add_argument('--from', dest='date_from', type=parse_date, help="この日以降に作成された会話（YYYY-MM-DD）")
+    search_options.add_argument('--to', dest='date_to', type=parse_date, help="この日までに作成された会話（YYYY-MM-DD）")
+    search_options.add_argument('--title', help="タイトルに含む文字列")
+    search_options.add_argument('--min-messages', type=int, help="メッセージ数の下限")
+    search_options.add_argument('--max-messages', type=int, help="メッセージ数の上限")
+    search_options.add_argument('--diversity', type=float, default=DEFAULT_DIVERSITY, help="似た会話を後ろに回す強さ（0〜1、0で元の順位）")
+    search_options.add_argument('--recency', type=float, default=DEFAULT_RECENCY, help="新しい会話を前に出す強さ（0〜1）")
+
+    p = sub.add_parser('search', parents=[embedder_options, search_options], help="検索する")
+    p.add_argument('query')
+    p.add_argument('--offset', type=int, default=0, help="何件目から表示するか（ページ送り用）")
+    p.add_argument('--json', action='store_true', help="JSONで出力する")
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser('batch-search', parents=[embedder_options, search_options],
+                       help="1行1クエリのファイルをまとめて検索し、結果をJSON Linesで出す")
+    p.add_argument('path', help="クエリのファイル（1行1クエリ。- で標準入力）")
+    p.set_defaults(func=cmd_batch_search)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
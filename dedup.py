@@ -0,0 +1,286 @@
+import os
+import sqlite3
+import threading
+import zlib
+
+import numpy as np
+
+from keyword_index import tokenize
+
+# 近い重複の索引の保存先
+DUPLICATES_PATH = "./chroma_db/duplicates.sqlite"
+
+# MinHashの長さと、LSHのバンド数（16バンド×4行。推定Jaccardが0.5前後から候補になる）
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+
+# 何語ずつをひとまとまり（shingle）として比べるか
+SHINGLE_SIZE = 3
+
+# shingleがこれより少ない短い会話は比べない（あいさつだけの会話などが全部まとまってしまうため）
+MIN_SHINGLES = 20
+
+# 推定Jaccard類似度がこれ以上なら近い重複とみなす（フォーク・再生成した会話）
+DUPLICATE_THRESHOLD = 0.8
+
+# LSHのバケットに入れた代表1件が使うメモリのおおよその大きさ（署名と16個のバンドのキー。実測で約6KB）
+RESIDENT_BYTES_PER_SIGNATURE = 6 * 1024
+
+# 一度に置換するshingle数（64×この数の行列を作る）
+SHINGLE_BLOCK = 4096
+
+# ハッシュの係数（乱数の種を固定して、署名がプロセスをまたいでも同じになるようにする）
+# 置換は multiply-shift: ((a*x + b) mod 2^64) の上位32ビット（a は奇数）
+_rng = np.random.RandomState(20240501)
+_A = _rng.randint(0, 2 ** 63, size=MINHASH_PERMUTATIONS, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+_B = _rng.randint(0, 2 ** 63, size=MINHASH_PERMUTATIONS, dtype=np.int64).astype(np.uint64)
+# shingle内の位置ごとの係数（語のハッシュを位置つきで混ぜる）
+_MIX = _rng.randint(0, 2 ** 63, size=SHINGLE_SIZE, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+_SHIFT = np.uint64(32)
+
+
+def shingles(text):
+    """keyword_index.tokenize の語を SHINGLE_SIZE 個ずつ並べたもののハッシュ値（uint64・重複なし）"""
+    tokens = tokenize(text)
+    if len(tokens) < SHINGLE_SIZE:
+        return np.empty(0, dtype=np.uint64)
+    # 同じ語は何度も出てくるので、語ごとに1回だけハッシュする
+    codes = {}
+    ids = np.fromiter((codes.setdefault(t, len(codes)) for t in tokens), dtype=np.int64, count=len(tokens))
+    token_hashes = np.fromiter((zlib.crc32(t.encode('utf-8')) for t in codes), dtype=np.uint64, count=len(codes))
+    hashed = token_hashes[ids]
+    n = len(tokens) - SHINGLE_SIZE + 1
+    combined = np.zeros(n, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        combined += hashed[offset:offset + n] * _MIX[offset]
+    return np.unique(combined >> _SHIFT)
+
+
+def minhash(text):
+    """テキストのMinHash署名（uint32 × MINHASH_PERMUTATIONS）。短すぎるテキストはNone"""
+    values = shingles(text)
+    if len(values) < MIN_SHINGLES:
+        return None
+    signature = np.full(MINHASH_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(values), SHINGLE_BLOCK):
+        block = values[start:start + SHINGLE_BLOCK]
+        # uint64 の掛け算・足し算は 2^64 で折り返す（multiply-shift ハッシュ）
+        permuted = (_A[:, None] * block[None, :] + _B[:, None]) >> _SHIFT
+        np.minimum(signature, permuted.min(axis=1), out=signature)
+    return signature.astype(np.uint32)
+
+
+def similarity(a, b):
+    """2つの署名から推定したJaccard類似度"""
+    return float(np.mean(a == b))
+
+
+def _bands(signature):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(LSH_BANDS)]
+
+
+class DuplicateIndex:
+    """会話のMinHash署名と、近い重複の代表（canonical）へのリンクをSQLiteに保存する
+
+    代表の会話だけをLSHのバケットに入れるので、まとまりは「代表1件＋重複」の形になる。
+    バケットはインポートの前に load() でメモリに読み込む。検索時のまとめ（clusters）は毎回SQLiteから読む。
+    複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, path=DUPLICATES_PATH, threshold=DUPLICATE_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS signatures (
+                chat_id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                canonical_id TEXT
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS signatures_canonical ON signatures (canonical_id);
+        """)
+        self._conn.commit()
+        self._signatures = {}  # 代表の会話ID -> 署名
+        self._buckets = {}  # (バンド, バンドの値) -> 代表の会話IDの集合
+        self._loaded = False
+
+    def load(self):
+        """代表の会話の署名をLSHのバケットに読み込む（別プロセスのインポートの結果も反映する）"""
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, signature FROM signatures WHERE canonical_id IS NULL").fetchall()
+            self._signatures = {}
+            self._buckets = {}
+            for chat_id, blob in rows:
+                self._index(chat_id, np.frombuffer(blob, dtype=np.uint32))
+            self._loaded = True
+
+    def _index(self, chat_id, signature):
+        self._signatures[chat_id] = signature
+        for key in _bands(signature):
+            self._buckets.setdefault(key, set()).add(chat_id)
+
+    def _unindex(self, chat_id):
+        signature = self._signatures.pop(chat_id, None)
+        if signature is None:
+            return
+        for key in _bands(signature):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(chat_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def lookup(self, chat_id):
+        """登録済みなら (content_hash, 代表の会話ID or None) を返す（なければNone）"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT content_hash, canonical_id FROM signatures WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+
+    def find(self, signature, exclude=None):
+        """一番近い代表の会話IDと推定類似度（しきい値未満ならNone, 0.0）"""
+        if not self._loaded:
+            self.load()
+        with self._lock:
+            candidates = set()
+            for key in _bands(signature):
+                candidates.update(self._buckets.get(key, ()))
+            candidates.discard(exclude)
+            best_id, best = None, 0.0
+            # 同じ類似度なら会話IDの順（インポートのたびに結果が変わらないように）
+            for chat_id in sorted(candidates):
+                score = similarity(signature, self._signatures[chat_id])
+                if score > best:
+                    best_id, best = chat_id, score
+        if best < self.threshold:
+            return None, 0.0
+        return best_id, best
+
+    def register(self, chat_id, title, content_hash, signature):
+        """署名を登録して、近い代表があればリンクする。リンク先の会話IDを返す（代表になったときはNone）
+
+        重複を持っている代表は、ほかの会話の重複にはしない。
+        """
+        canonical_id, _ = self.find(signature, exclude=chat_id)
+        with self._lock:
+            if canonical_id is not None:
+                has_members = self._conn.execute(
+                    "SELECT 1 FROM signatures WHERE canonical_id = ? LIMIT 1", (chat_id,)
+                ).fetchone()
+                if has_members:
+                    canonical_id = None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO signatures (chat_id, title, content_hash, signature, canonical_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (chat_id, title, content_hash, signature.tobytes(), canonical_id),
+            )
+            self._conn.commit()
+            self._unindex(chat_id)
+            if canonical_id is None:
+                self._index(chat_id, signature)
+        return canonical_id
+
+    def retain(self, chat_ids):
+        """chat_ids にない会話を消して、(消した会話IDのリスト, 代表が消えて孤立した会話IDのリスト) を返す
+
+        孤立した会話（chat_ids にある重複で、リンク先の代表が消えたもの）は消さずに残す。
+        呼び出し側で relink して代表を選び直す（代表になったものはEmbeddingする）。
+        """
+        keep = set(chat_ids)
+        with self._lock:
+            rows = self._conn.execute("SELECT chat_id, canonical_id FROM signatures").fetchall()
+            removed = sorted(chat_id for chat_id, _ in rows if chat_id not in keep)
+            gone = set(removed)
+            orphaned = sorted(chat_id for chat_id, canonical_id in rows if canonical_id in gone and chat_id in keep)
+            for start in range(0, len(removed), 500):
+                part = removed[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                self._conn.execute(f"DELETE FROM signatures WHERE chat_id IN ({placeholders})", part)
+            self._conn.commit()
+            for chat_id in removed:
+                self._unindex(chat_id)
+        return removed, orphaned
+
+    def members(self, canonical_ids):
+        """canonical_ids の代表にリンクしている重複の会話ID"""
+        canonical_ids = list(canonical_ids)
+        members = []
+        with self._lock:
+            for start in range(0, len(canonical_ids), 500):
+                part = canonical_ids[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                members.extend(chat_id for (chat_id,) in self._conn.execute(
+                    f"SELECT chat_id FROM signatures WHERE canonical_id IN ({placeholders}) ORDER BY chat_id", part
+                ))
+        return members
+
+    def relink(self, chat_id):
+        """登録済みの会話の代表を、保存済みの署名で選び直す（代表が消えた・代表の内容が変わったとき）
+
+        リンク先の会話IDを返す（代表になったとき・登録されていないときはNone）。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT title, content_hash, signature FROM signatures WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        title, digest, blob = row
+        return self.register(chat_id, title, digest, np.frombuffer(blob, dtype=np.uint32))
+
+    def clusters(self, chat_ids):
+        """chat_ids それぞれの代表の会話IDと、代表ごとのまとまり [(会話ID, タイトル)]（代表が先頭）
+
+        まとまりのない会話は返さない。
+        """
+        chat_ids = list(chat_ids)
+        canonical = {}
+        with self._lock:
+            for start in range(0, len(chat_ids), 500):
+                part = chat_ids[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                for chat_id, canonical_id in self._conn.execute(
+                    f"SELECT chat_id, canonical_id FROM signatures WHERE chat_id IN ({placeholders})", part
+                ):
+                    canonical[chat_id] = canonical_id or chat_id
+            heads = sorted(set(canonical.values()))
+            members = {}
+            for start in range(0, len(heads), 500):
+                part = heads[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                for chat_id, title, canonical_id in self._conn.execute(
+                    f"SELECT chat_id, title, canonical_id FROM signatures "
+                    f"WHERE chat_id IN ({placeholders}) OR canonical_id IN ({placeholders}) "
+                    f"ORDER BY canonical_id IS NOT NULL, chat_id",
+                    part + part,
+                ):
+                    members.setdefault(canonical_id or chat_id, []).append((chat_id, title))
+        members = {head: cluster for head, cluster in members.items() if len(cluster) > 1}
+        canonical = {chat_id: head for chat_id, head in canonical.items() if head in members}
+        return canonical, members
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM signatures")
+            self._conn.commit()
+            self._signatures = {}
+            self._buckets = {}
+
+    def resident_bytes(self):
+        """load() でメモリに読み込んだ署名とバケットのおおよその大きさ"""
+        with self._lock:
+            return len(self._signatures) * RESIDENT_BYTES_PER_SIGNATURE
+
+    def stats(self):
+        with self._lock:
+            total, duplicates, clusters = self._conn.execute(
+                "SELECT COUNT(*), COUNT(canonical_id), COUNT(DISTINCT canonical_id) FROM signatures"
+            ).fetchone()
+        return {'conversations': total, 'duplicates': duplicates, 'clusters': clusters}
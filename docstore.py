@@ -0,0 +1,121 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 会話本文の保存先
+DOCSTORE_PATH = "./chroma_db/documents.sqlite"
+
+# 圧縮レベル（zstd / zlib）
+ZSTD_LEVEL = 9
+ZLIB_LEVEL = 6
+
+CODEC_ZSTD = 'zstd'
+CODEC_ZLIB = 'zlib'
+
+
+def _compress(data):
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return CODEC_ZLIB, zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompress(codec, blob):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("zstdで圧縮された本文を読むには zstandard が必要です（pip install zstandard）")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+
+def format_conversation(body):
+    """本文を "[sender]: text" の行にして返す（空のメッセージは飛ばす）"""
+    return '\n'.join(f"[{sender}]: {text}" for sender, text, _ in body['messages'] if text)
+
+
+def message_range_text(body, msg_start, msg_end):
+    """メッセージ番号 msg_start〜msg_end（含む）のテキスト（チャンクの本文の作り直し用）"""
+    return '\n'.join(
+        f"[{sender}]: {text}" for sender, text, _ in body['messages'][msg_start:msg_end + 1] if text
+    )
+
+
+class DocumentStore:
+    """会話の全文（メッセージ単位・切り詰めなし）を chat_id ごとに圧縮して保存する（SQLite）
+
+    ChromaDBには検索用の短いスニペットだけを置き、全文は表示するときにここから読む。
+    zstandard が入っていればzstd、なければzlibで圧縮する（行ごとに方式を記録するので混在してよい）。
+    複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, path=DOCSTORE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                chat_id TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                body BLOB NOT NULL,
+                raw_size INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def put_many(self, items):
+        """items: (chat_id, 本文) のリスト。本文は {'title', 'created_at', 'updated_at', 'messages': [(sender, text, ts)]}"""
+        rows = []
+        for chat_id, body in items:
+            data = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            codec, blob = _compress(data)
+            rows.append((chat_id, codec, blob, len(data)))
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO documents (chat_id, codec, body, raw_size) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+
+    def get(self, chat_id):
+        """本文を返す（なければNone）"""
+        with self._lock:
+            row = self._conn.execute("SELECT codec, body FROM documents WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(_decompress(*row))
+
+    def delete(self, chat_ids):
+        chat_ids = list(chat_ids)
+        with self._lock:
+            for start in range(0, len(chat_ids), 500):
+                part = chat_ids[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                self._conn.execute(f"DELETE FROM documents WHERE chat_id IN ({placeholders})", part)
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM documents")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            count, raw, stored = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(LENGTH(body)), 0) FROM documents"
+            ).fetchone()
+        return {
+            'documents': count,
+            'raw_bytes': raw,
+            'stored_bytes': stored,
+            'ratio': round(stored / raw, 3) if raw else 0.0,
+        }
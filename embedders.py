@@ -0,0 +1,193 @@
+import time
+import zlib
+
+import numpy as np
+
+from chunking import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+from ingest import (EMBEDDING_CONCURRENCY, EMBEDDING_MODEL, EMBEDDING_RPM, EMBEDDING_TPM,
+                    MAX_ITEMS_PER_REQUEST, TARGET_TOKENS_PER_REQUEST, make_openai_embed_fn)
+from keyword_index import tokenize
+from ratelimit import NoLimit, TokenBucket
+
+# Embeddingのバックエンド
+BACKEND_OPENAI = 'openai'
+BACKEND_LOCAL = 'local'
+BACKEND_FAKE = 'fake'
+BACKENDS = (BACKEND_OPENAI, BACKEND_LOCAL, BACKEND_FAKE)
+
+# OpenAIのモデルごとの次元数（ここにないモデルは1回Embeddingして調べる）
+OPENAI_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+# ローカル（CPU）で動かすモデル。日本語も扱える多言語モデル（384次元・最大512トークン）
+LOCAL_MODEL = "intfloat/multilingual-e5-small"
+
+# e5系は入力の先頭に "query: " を付ける（会話・検索語の両方に付ける対称的な使い方）
+LOCAL_PREFIXES = {
+    "intfloat/multilingual-e5-small": "query: ",
+    "intfloat/multilingual-e5-base": "query: ",
+    "intfloat/multilingual-e5-large": "query: ",
+}
+
+# ローカルモデルで1回に推論する件数と、run_import が1回に渡す件数
+LOCAL_BATCH_SIZE = 32
+LOCAL_ITEMS_PER_CALL = 256
+
+# ベンチマーク・テスト用の決定的なEmbeddingの次元数
+FAKE_DIMENSION = 256
+
+
+class OpenAIEmbedder:
+    """OpenAI Embeddings API のバックエンド。embedder(texts) -> ベクトルのリスト"""
+
+    backend = BACKEND_OPENAI
+
+    def __init__(self, api_key, model=EMBEDDING_MODEL):
+        from openai import OpenAI
+        # リトライは呼び出し側（インポートは ingest、検索は search）でバックオフ付きで行うので、クライアントの自動リトライは切る
+        self.model = model
+        self._embed = make_openai_embed_fn(OpenAI(api_key=api_key, max_retries=0), model)
+        self._dimension = OPENAI_DIMENSIONS.get(model)
+
+    @property
+    def model_id(self):
+        # 導入前から使っているキャッシュ・コレクションと揃えるため、OpenAIはモデル名そのまま
+        return self.model
+
+    @property
+    def dimension(self):
+        if self._dimension is None:
+            self._dimension = len(self._embed(["dimension"])[0])
+        return self._dimension
+
+    def __call__(self, texts):
+        return self._embed(texts)
+
+    def import_options(self):
+        """run_import に渡すバッチ・並列数・レート制限の設定"""
+        return {
+            'max_items': MAX_ITEMS_PER_REQUEST,
+            'max_tokens': TARGET_TOKENS_PER_REQUEST,
+            'concurrency': EMBEDDING_CONCURRENCY,
+            'rate_limiter': TokenBucket(EMBEDDING_RPM, EMBEDDING_TPM),
+        }
+
+
+class LocalEmbedder:
+    """sentence-transformers でCPU上で推論するバックエンド（APIキー・ネットワーク不要）
+
+    runtime='onnx' にするとONNX Runtimeで推論する（sentence-transformers 3.2以降）。
+    threads は推論に使うスレッド数（torch.set_num_threads はプロセス全体に効く）。
+    """
+
+    backend = BACKEND_LOCAL
+
+    def __init__(self, model=LOCAL_MODEL, threads=None, batch_size=LOCAL_BATCH_SIZE, runtime='torch', device='cpu'):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError("ローカルEmbeddingには sentence-transformers が必要です（pip install sentence-transformers）")
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        self.model = model
+        self.batch_size = batch_size
+        self.prefix = LOCAL_PREFIXES.get(model, "")
+        if runtime == 'torch':
+            self._model = SentenceTransformer(model, device=device)
+        else:
+            self._model = SentenceTransformer(model, device=device, backend=runtime)
+        self.dimension = self._model.get_sentence_embedding_dimension()
+        self.max_seq_length = self._model.max_seq_length
+
+    @property
+    def model_id(self):
+        return f"{BACKEND_LOCAL}:{self.model}"
+
+    def __call__(self, texts):
+        vectors = self._model.encode(
+            [self.prefix + t for t in texts],
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return vectors.tolist()
+
+    def import_options(self):
+        # 推論はモデル側がスレッドを使うので1本ずつ。APIではないのでレート制限もしない
+        # モデルの最大長を超えた部分は切り捨てられるので、チャンクもその長さに揃える
+        chunk_max_tokens = min(CHUNK_MAX_TOKENS, self.max_seq_length)
+        return {
+            'max_items': LOCAL_ITEMS_PER_CALL,
+            'max_tokens': LOCAL_ITEMS_PER_CALL * chunk_max_tokens,
+            'concurrency': 1,
+            'rate_limiter': NoLimit(),
+            'chunk_max_tokens': chunk_max_tokens,
+            'chunk_overlap_tokens': min(CHUNK_OVERLAP_TOKENS, chunk_max_tokens // 5),
+        }
+
+
+class HashingEmbedder:
+    """ベンチマーク・テスト用の決定的なEmbedding（APIもモデルも不要）
+
+    keyword_index.tokenize の語を次元に振り分けて数える（feature hashing）ので、
+    同じ語を含むテキストほど近いベクトルになる。latency 秒だけ待ってAPIの待ち時間を真似られる。
+    """
+
+    backend = BACKEND_FAKE
+
+    def __init__(self, dimension=FAKE_DIMENSION, latency=0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.model = f"hashing-{dimension}"
+        self._buckets = {}  # 語 -> (次元, 符号)
+
+    @property
+    def model_id(self):
+        return f"{BACKEND_FAKE}:{self.model}"
+
+    def _bucket(self, token):
+        bucket = self._buckets.get(token)
+        if bucket is None:
+            h = zlib.crc32(token.encode('utf-8'))
+            bucket = self._buckets[token] = (h % self.dimension, 1.0 if h & 0x80000000 else -1.0)
+        return bucket
+
+    def __call__(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                index, sign = self._bucket(token)
+                vectors[row, index] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        # 語が1つもないテキストは適当な単位ベクトルにする（ゼロベクトルはコサイン距離が定義できない）
+        vectors[norms[:, 0] == 0, 0] = 1.0
+        norms[norms == 0] = 1.0
+        return (vectors / norms).tolist()
+
+    def import_options(self):
+        return {
+            'max_items': MAX_ITEMS_PER_REQUEST,
+            'max_tokens': TARGET_TOKENS_PER_REQUEST,
+            'concurrency': EMBEDDING_CONCURRENCY,
+            'rate_limiter': NoLimit(),
+        }
+
+
+def create_embedder(backend=BACKEND_OPENAI, api_key=None, model=None, threads=None, runtime='torch'):
+    """バックエンド名からEmbedderを作る（model省略時は各バックエンドの既定モデル）"""
+    if backend == BACKEND_OPENAI:
+        if not api_key:
+            raise ValueError("OpenAIのEmbeddingには OPENAI_API_KEY が必要です")
+        return OpenAIEmbedder(api_key, model or EMBEDDING_MODEL)
+    if backend == BACKEND_LOCAL:
+        return LocalEmbedder(model or LOCAL_MODEL, threads=threads, runtime=runtime)
+    if backend == BACKEND_FAKE:
+        return HashingEmbedder()
+    raise ValueError(f"不明なEmbeddingバックエンド: {backend}")
@@ -0,0 +1,201 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+
+from chunking import estimate_tokens
+from metrics import metrics
+
+# キャッシュの保存先と容量の上限（ベクトル本体のバイト数）
+CACHE_PATH = "./embedding_cache.sqlite"
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    """(モデル名, テキストのsha256) をキーにしたEmbeddingのディスクキャッシュ
+
+    ベクトルはfloat32のBLOBでSQLiteに保存し、容量を超えたら最後に使われた時刻が古いものから捨てる（LRU）。
+    複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash BLOB NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        count, size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self.entries = count
+        self.bytes = size
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model, hashes):
+        """見つかったものだけ {hash: ベクトル} で返す"""
+        found = {}
+        with self._lock:
+            # SQLiteの変数上限に引っかからないよう分割して引く
+            for start in range(0, len(hashes), 500):
+                part = hashes[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for h, blob in rows:
+                    found[bytes(h)] = array('f', blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, h) for h in found],
+                )
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(set(hashes)) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        """items: (hash, ベクトル) のリスト"""
+        now = time.time()
+        rows = [(model, h, array('f', vector).tobytes(), now) for h, vector in items]
+        with self._lock:
+            for _, h, blob, _ in rows:
+                old = self._conn.execute(
+                    "SELECT LENGTH(vector) FROM embeddings WHERE model = ? AND text_hash = ?", (model, h)
+                ).fetchone()
+                if old:
+                    self.bytes -= old[0]
+                    self.entries -= 1
+                self.bytes += len(blob)
+                self.entries += 1
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # 上限を超えていたら古いものから1割多めに捨てる（毎回のevictを避ける）
+        if self.bytes <= self.max_bytes or self.entries == 0:
+            return
+        target = self.max_bytes * 0.9
+        avg = self.bytes / self.entries
+        n = max(1, int((self.bytes - target) / avg) + 1)
+        removed = self._conn.execute("""
+            SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings
+            WHERE (model, text_hash) IN (SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)
+        """, (n,)).fetchone()
+        self._conn.execute("""
+            DELETE FROM embeddings
+            WHERE (model, text_hash) IN (SELECT model, text_hash FROM embeddings ORDER BY last_used LIMIT ?)
+        """, (n,))
+        self.entries -= removed[0]
+        self.bytes -= removed[1]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self.entries = 0
+            self.bytes = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class CachedEmbedder:
+    """embed_fn(texts) をキャッシュ経由にするラッパー。未キャッシュのテキストだけAPIに投げる"""
+
+    def __init__(self, embed_fn, cache, model):
+        self.embed_fn = embed_fn
+        self.cache = cache
+        self.model = model
+        self._lock = threading.Lock()
+        self.api_calls = 0
+        self.api_seconds = 0.0
+        self.api_texts = 0
+        self.cached_texts = 0
+        self.saved_tokens = 0
+
+    def __call__(self, texts):
+        hashes = [text_hash(t) for t in texts]
+        found = self.cache.get_many(self.model, hashes)
+
+        # 未キャッシュのテキスト（同じテキストの重複は1回だけ投げる）
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+
+        if missing:
+            started = time.perf_counter()
+            vectors = self.embed_fn(list(missing.values()))
+            elapsed = time.perf_counter() - started
+            metrics.observe('embed_api', elapsed)
+            new_items = list(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model, new_items)
+            found.update(new_items)
+            with self._lock:
+                self.api_calls += 1
+                self.api_seconds += elapsed
+                self.api_texts += len(missing)
+
+        saved = sum(estimate_tokens(t) for h, t in zip(hashes, texts) if h not in missing)
+        with self._lock:
+            self.cached_texts += len(texts) - len(missing)
+            self.saved_tokens += saved
+        metrics.inc('embed_cache_hits', len(texts) - len(missing))
+        metrics.inc('embed_cache_misses', len(missing))
+        return [found[h] for h in hashes]
+
+    @property
+    def dimension(self):
+        return self.embed_fn.dimension
+
+    def import_options(self):
+        """中身のEmbedderが決める run_import の設定（バッチサイズ・並列数・レート制限など）"""
+        import_options = getattr(self.embed_fn, 'import_options', None)
+        return import_options() if import_options else {}
+
+    @property
+    def estimated_saved_seconds(self):
+        """キャッシュから返したテキスト数 × APIの1テキストあたり平均時間"""
+        if not self.api_texts:
+            return 0.0
+        return self.cached_texts * self.api_seconds / self.api_texts
+
+    def stats(self):
+        return {
+            'hits': self.cache.hits,
+            'misses': self.cache.misses,
+            'hit_rate': round(self.cache.hit_rate, 3),
+            'entries': self.cache.entries,
+            'bytes': self.cache.bytes,
+            'api_calls': self.api_calls,
+            'api_seconds': round(self.api_seconds, 3),
+            'estimated_saved_seconds': round(self.estimated_saved_seconds, 3),
+            'saved_tokens': self.saved_tokens,
+        }
@@ -0,0 +1,107 @@
+import threading
+from datetime import date, datetime, timezone
+
+from query_cache import normalize_query
+
+# タイトル一覧を読み込むときの1回あたりの件数
+CATALOG_BATCH_SIZE = 5000
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+def make_filters(date_from=None, date_to=None, title=None, min_messages=None, max_messages=None):
+    """検索条件の絞り込みを辞書にまとめる（指定のないものは入れない。検索結果キャッシュのキーにも使う）
+
+    date_from / date_to は 'YYYY-MM-DD' か date（どちらもその日を含む、UTC）。
+    """
+    filters = {
+        'date_from': _date_str(date_from),
+        'date_to': _date_str(date_to),
+        'title': title.strip() if title else None,
+        'min_messages': min_messages,
+        'max_messages': max_messages,
+    }
+    return {key: value for key, value in filters.items() if value not in (None, '')}
+
+
+def _date_str(value):
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+def _day_start(value):
+    day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return day.timestamp()
+
+
+class NoMatch(Exception):
+    """絞り込みに当てはまる会話が1件もない"""
+
+
+def build_where(filters, catalog=None, collection=None):
+    """make_filters の辞書をChromaDBの where に変換する（絞り込みがなければNone）
+
+    タイトルの部分一致はChromaDBのメタデータ条件では書けないので、catalog(TitleCatalog) で
+    該当する会話IDに解決して chat_id の $in にする。1件も当てはまらなければ NoMatch を送出する。
+    """
+    if not filters:
+        return None
+    conditions = []
+    if 'date_from' in filters:
+        conditions.append({'created_ts': {'$gte': _day_start(filters['date_from'])}})
+    if 'date_to' in filters:
+        conditions.append({'created_ts': {'$lt': _day_start(filters['date_to']) + DAY_SECONDS}})
+    if 'min_messages' in filters:
+        conditions.append({'message_count': {'$gte': int(filters['min_messages'])}})
+    if 'max_messages' in filters:
+        conditions.append({'message_count': {'$lte': int(filters['max_messages'])}})
+    if 'title' in filters:
+        if catalog is None or collection is None:
+            raise ValueError("タイトルでの絞り込みにはcatalogとcollectionが必要です")
+        chat_ids = catalog.match(collection, filters['title'])
+        if not chat_ids:
+            raise NoMatch()
+        conditions.append({'chat_id': {'$in': chat_ids}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+
+class TitleCatalog:
+    """会話IDとタイトルの一覧（タイトルの部分一致 → 会話ID の解決用）
+
+    各会話の先頭チャンクのメタデータだけを読んでメモリに持つ。
+    コレクションのバージョンが上がったら読み直す。
+    """
+
+    def __init__(self, meta):
+        self.meta = meta
+        self._lock = threading.Lock()
+        self._version = None
+        self._titles = {}  # chat_id -> 正規化したタイトル
+
+    def _load(self, collection):
+        titles = {}
+        offset = 0
+        while True:
+            page = collection.get(where={'chunk_index': 0}, include=['metadatas'],
+                                  limit=CATALOG_BATCH_SIZE, offset=offset)
+            for metadata in page['metadatas']:
+                metadata = metadata or {}
+                if 'chat_id' in metadata:
+                    titles[metadata['chat_id']] = normalize_query(metadata.get('title') or '')
+            if len(page['ids']) < CATALOG_BATCH_SIZE:
+                return titles
+            offset += len(page['ids'])
+
+    def match(self, collection, text):
+        """タイトルに text を含む会話IDのリスト（全角/半角・大文字/小文字は区別しない）"""
+        version = self.meta.collection_version()
+        with self._lock:
+            if self._version != version:
+                self._titles = self._load(collection)
+                self._version = version
+            titles = self._titles
+        needle = normalize_query(text)
+        return sorted(chat_id for chat_id, title in titles.items() if needle in title)
@@ -0,0 +1,335 @@
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# ベクトルの保存先（ディレクトリ）
+FLAT_INDEX_PATH = "./chroma_db/flat_index"
+
+# ベクトルの持ち方: float16（2バイト/次元）か int8（1バイト/次元 + 行ごとのスケール）
+DTYPE_FLOAT16 = 'float16'
+DTYPE_INT8 = 'int8'
+FLAT_DTYPES = (DTYPE_FLOAT16, DTYPE_INT8)
+
+# 最初に確保する行数（足りなくなったら倍にする）
+INITIAL_CAPACITY = 1024
+
+# スコアを計算するときに一度にfloat32に戻す行数。戻した行列がCPUキャッシュに載る大きさにする
+# （100k×1536のint8で 256行: 約60ms / 16384行: 約150ms）
+SCORE_BLOCK_ROWS = 256
+
+# メタデータを読むときにSQLiteに一度に渡す行数
+ROW_BATCH_SIZE = 500
+
+
+class FlatIndex:
+    """全ベクトルを1つの連続した行列（memmap）に量子化して持つ、総当たりのベクトル索引
+
+    ChromaDBのHNSWの代わりに、小〜中規模（数十万チャンクまで）のコレクションを
+    行列×ベクトルの積1回と argpartition で正確に上位k件を求める。
+    ベクトルはコサイン距離用に正規化して float16 か int8（行ごとのスケール付き）で保存する。
+    dimensions を指定すると先頭の次元だけ使う（text-embedding-3 系の Matryoshka 表現向け。切ったあと正規化し直す）。
+    レコードIDとメタデータは同じディレクトリのSQLiteに持つ。ChromaDBは正本のまま残し、
+    設定を変えたときは rebuild_from_collection で作り直す。複数スレッドから呼んでよい。
+    ほかのプロセス（CLIのインポートなど）が書き込んだら、次に使うときに行の対応を読み直す。
+    行の割り当てはSQLiteの書き込みロック（BEGIN IMMEDIATE）の中で行うので、プロセスどうしで同じ行を使わない。
+    """
+
+    def __init__(self, path=FLAT_INDEX_PATH, dtype=DTYPE_INT8, dimensions=None):
+        if dtype not in FLAT_DTYPES:
+            raise ValueError(f"不明なベクトルの型: {dtype}（{', '.join(FLAT_DTYPES)}）")
+        self.path = path
+        self.dtype = dtype
+        self.dimensions = int(dimensions) if dimensions else None
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(path, 'rows.sqlite'), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS rows (
+                row INTEGER PRIMARY KEY,
+                record_id TEXT UNIQUE NOT NULL,
+                chat_id TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+        """)
+        self._conn.commit()
+        config = dict(self._conn.execute("SELECT key, value FROM config"))
+        if config and not self._same_settings(config):
+            # 型や次元の設定が変わったら中身は使えないので空にする（呼び出し側で作り直す）
+            self.clear()
+        self._data_version = None
+        self._refresh_if_changed()
+
+    # --- 内部 ---
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _same_settings(self, config):
+        return config.get('dtype') == self.dtype and config.get('dimensions') == str(self.dimensions or '')
+
+    def _save_config(self):
+        self._conn.executemany("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", [
+            ('dtype', self.dtype),
+            ('dimensions', str(self.dimensions or '')),
+            ('dimension', str(self.dimension)),
+            ('source_dimension', str(self.source_dimension)),
+        ])
+
+    def _refresh_if_changed(self):
+        """ほかのプロセスが書き込んでいたら（data_version が変わる）設定・行の対応・memmapを読み直す"""
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return
+        config = dict(self._conn.execute("SELECT key, value FROM config"))
+        if config and not self._same_settings(config):
+            raise ValueError("ほかのプロセスが索引の型や次元の設定を変えました。開き直してください")
+        self.dimension = int(config['dimension']) if config.get('dimension') else None
+        self.source_dimension = int(config['source_dimension']) if config.get('source_dimension') else None
+        self._load()
+        self._data_version = version
+
+    def _write(self, fn):
+        """書き込みロックを取り、最新の状態を読み直してから fn を実行してコミットする"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh_if_changed()
+                fn()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                # メモリ上の行の対応はロールバックした内容とずれるので、次に使うときに読み直す
+                self._data_version = None
+                raise
+
+    def _map(self, capacity):
+        """ベクトル（とint8のスケール）のファイルを capacity 行に広げてmemmapし直す"""
+        itemsize = np.dtype(self.dtype).itemsize
+        for name, row_bytes in (('vectors.bin', self.dimension * itemsize), ('scales.bin', 4)):
+            if name == 'scales.bin' and self.dtype != DTYPE_INT8:
+                continue
+            with open(self._file(name), 'ab') as f:
+                if f.tell() < capacity * row_bytes:
+                    f.truncate(capacity * row_bytes)
+        self._vectors = np.memmap(self._file('vectors.bin'), dtype=self.dtype, mode='r+',
+                                  shape=(capacity, self.dimension))
+        self._scales = None
+        if self.dtype == DTYPE_INT8:
+            self._scales = np.memmap(self._file('scales.bin'), dtype=np.float32, mode='r+', shape=(capacity,))
+        chat_codes = np.full(capacity, -1, dtype=np.int32)
+        if getattr(self, '_chat_codes', None) is not None:
+            chat_codes[:len(self._chat_codes)] = self._chat_codes
+        self._chat_codes = chat_codes
+        self._capacity = capacity
+
+    def _load(self):
+        self._vectors = None
+        self._scales = None
+        self._chat_codes = None
+        self._capacity = 0
+        self._row_of = {}  # レコードID -> 行
+        self._code_of = {}  # 会話ID -> 番号（絞り込み用）
+        self._free = []  # 削除して空いた行
+        self._size = 0  # 使ったことのある行数
+        rows = self._conn.execute("SELECT row, record_id, chat_id FROM rows").fetchall()
+        if self.dimension is None:
+            return
+        size = max((row for row, _, _ in rows), default=-1) + 1
+        self._map(max(INITIAL_CAPACITY, size))
+        for row, record_id, chat_id in rows:
+            self._row_of[record_id] = row
+            self._chat_codes[row] = self._code_of.setdefault(chat_id, len(self._code_of))
+        self._size = size
+        used = set(self._row_of.values())
+        self._free = [row for row in range(size) if row not in used]
+
+    def _prepare(self, embeddings):
+        """切り詰め・正規化したfloat32の行列"""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        if self.dimensions:
+            vectors = vectors[:, :self.dimensions]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        if self._size >= self._capacity:
+            self._map(self._capacity * 2)
+        self._size += 1
+        return self._size - 1
+
+    # --- 公開API ---
+
+    def upsert(self, ids, embeddings, metadatas):
+        """ChromaDBの collection.upsert と同じ形で追加・上書きする"""
+        if not ids:
+            return
+        source_dimension = len(embeddings[0])
+        vectors = self._prepare(embeddings)
+
+        def write():
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                self.source_dimension = source_dimension
+                self._save_config()
+                self._map(INITIAL_CAPACITY)
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"ベクトルの次元が違います（索引: {self.dimension}, 追加: {vectors.shape[1]}）")
+            rows = []
+            sql_rows = []
+            for record_id, metadata in zip(ids, metadatas):
+                row = self._row_of.get(record_id)
+                if row is None:
+                    row = self._row_of[record_id] = self._allocate()
+                chat_id = (metadata or {}).get('chat_id', record_id.rsplit('#', 1)[0])
+                self._chat_codes[row] = self._code_of.setdefault(chat_id, len(self._code_of))
+                rows.append(row)
+                sql_rows.append((row, record_id, chat_id, json.dumps(metadata or {}, ensure_ascii=False)))
+            rows = np.array(rows)
+            if self.dtype == DTYPE_INT8:
+                # 行ごとに最大の絶対値を127に合わせる（スコアを出すときにスケールを掛けて戻す）
+                scales = np.abs(vectors).max(axis=1) / 127.0
+                scales[scales == 0] = 1.0
+                self._vectors[rows] = np.round(vectors / scales[:, None]).astype(np.int8)
+                self._scales[rows] = scales
+                self._scales.flush()
+            else:
+                self._vectors[rows] = vectors.astype(np.float16)
+            self._vectors.flush()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO rows (row, record_id, chat_id, metadata) VALUES (?, ?, ?, ?)", sql_rows
+            )
+
+        self._write(write)
+
+    def delete(self, ids):
+        def write():
+            rows = [self._row_of.pop(record_id) for record_id in ids if record_id in self._row_of]
+            if not rows:
+                return
+            self._chat_codes[rows] = -1
+            self._free.extend(rows)
+            for start in range(0, len(rows), ROW_BATCH_SIZE):
+                part = rows[start:start + ROW_BATCH_SIZE]
+                self._conn.execute(f"DELETE FROM rows WHERE row IN ({','.join('?' * len(part))})", part)
+
+        self._write(write)
+
+    def scores(self, query_embeddings, chat_ids=None):
+        """全行とのコサイン類似度（クエリ数×行数。削除済み・chat_ids にない行は -inf）
+
+        クエリが複数でも行列を読むのは1回だけ（ブロックごとに全クエリとの積を取る）。
+        """
+        queries = self._prepare(query_embeddings)
+        with self._lock:
+            self._refresh_if_changed()
+            size = self._size
+            scores = np.full((len(queries), size), -np.inf, dtype=np.float32)
+            if size == 0:
+                return scores
+            codes = self._chat_codes[:size]
+            if chat_ids is None:
+                live = codes >= 0
+            else:
+                allowed = [self._code_of[c] for c in chat_ids if c in self._code_of]
+                live = np.isin(codes, np.array(allowed, dtype=np.int32))
+            # 同じバッファにfloat32で戻しながら、ブロックごとに行列×ベクトルの積を取る
+            buffer = np.empty((SCORE_BLOCK_ROWS, self.dimension), dtype=np.float32)
+            block_scores = np.empty((SCORE_BLOCK_ROWS, len(queries)), dtype=np.float32)
+            for start in range(0, size, SCORE_BLOCK_ROWS):
+                end = min(start + SCORE_BLOCK_ROWS, size)
+                block = buffer[:end - start]
+                block[...] = self._vectors[start:end]
+                out = block_scores[:end - start]
+                np.dot(block, queries.T, out=out)
+                scores[:, start:end] = out.T
+            if self._scales is not None:
+                scores *= self._scales[:size]
+            scores[:, ~live] = -np.inf
+        return scores
+
+    def query(self, query_embeddings, n_results, chat_ids=None):
+        """クエリごとの上位 n_results 件
+
+        ChromaDBの collection.query と同じく、ids/metadatas/distances をクエリごとのリストで返す（距離は 1 - コサイン類似度）。
+        """
+        scores = self.scores(query_embeddings, chat_ids)
+        tops = []
+        for row_scores in scores:
+            k = min(n_results, int(np.isfinite(row_scores).sum()))
+            top = np.argpartition(-row_scores, k - 1)[:k] if k else np.empty(0, dtype=np.int64)
+            tops.append([int(row) for row in top[np.argsort(-row_scores[top], kind='stable')]])
+        with self._lock:
+            found = {}
+            rows = sorted({row for top in tops for row in top})
+            for start in range(0, len(rows), ROW_BATCH_SIZE):
+                part = rows[start:start + ROW_BATCH_SIZE]
+                for row, record_id, metadata in self._conn.execute(
+                    f"SELECT row, record_id, metadata FROM rows WHERE row IN ({','.join('?' * len(part))})", part
+                ):
+                    found[row] = (record_id, json.loads(metadata))
+        results = {'ids': [], 'metadatas': [], 'distances': []}
+        for row_scores, top in zip(scores, tops):
+            top = [row for row in top if row in found]
+            results['ids'].append([found[row][0] for row in top])
+            results['metadatas'].append([found[row][1] for row in top])
+            results['distances'].append([float(1.0 - row_scores[row]) for row in top])
+        return results
+
+    def count(self):
+        with self._lock:
+            self._refresh_if_changed()
+            return len(self._row_of)
+
+    def clear(self):
+        with self._lock:
+            self._vectors = None
+            self._scales = None
+            self._chat_codes = None
+            for name in ('vectors.bin', 'scales.bin'):
+                if os.path.exists(self._file(name)):
+                    os.remove(self._file(name))
+            self._conn.execute("DELETE FROM rows")
+            self._conn.execute("DELETE FROM config")
+            self._conn.commit()
+            self.dimension = None
+            self.source_dimension = None
+            self._load()
+
+    def stats(self):
+        with self._lock:
+            self._refresh_if_changed()
+            vector_bytes = 0
+            if self.dimension:
+                itemsize = np.dtype(self.dtype).itemsize
+                vector_bytes = len(self._row_of) * (self.dimension * itemsize + (4 if self.dtype == DTYPE_INT8 else 0))
+            return {
+                'vectors': len(self._row_of),
+                'dtype': self.dtype,
+                'dimension': self.dimension,
+                'vector_bytes': vector_bytes,
+                # 同じ本数を float32・切り詰めなしで持った場合の大きさ（比べる用）
+                'float32_bytes': len(self._row_of) * (self.source_dimension or 0) * 4,
+            }
+
+    def rebuild_from_collection(self, collection, batch_size=1000):
+        """ChromaDBに保存済みのベクトルから作り直す（導入前のデータ・設定を変えたとき用）"""
+        self.clear()
+        offset = 0
+        while True:
+            page = collection.get(include=['embeddings', 'metadatas'], limit=batch_size, offset=offset)
+            if len(page['ids']):
+                self.upsert(page['ids'], page['embeddings'], page['metadatas'])
+            if len(page['ids']) < batch_size:
+                return
+            offset += len(page['ids'])
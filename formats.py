@@ -0,0 +1,198 @@
+from datetime import datetime, timezone
+
+from json_stream import iter_array
+
+
+class Conversation:
+    """エクスポート形式によらない会話レコード
+
+    messages は (sender, text, ts) のタプルのリスト。テキスト抽出は読み込み時に1回だけ行う。
+    text が空のメッセージも番号を保つために残す。
+    error は読み込みに失敗した場合のメッセージ（成功時はNone）。
+    """
+
+    __slots__ = ('id', 'title', 'created_at', 'updated_at', 'messages', 'error')
+
+    def __init__(self, id, title, created_at='', updated_at='', messages=(), error=None):
+        self.id = id
+        self.title = title
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.messages = messages
+        self.error = error
+
+    def lines(self):
+        """テキストのあるメッセージを (メッセージ番号, "[sender]: text") で返す"""
+        return [(i, f"[{sender}]: {text}") for i, (sender, text, _) in enumerate(self.messages) if text]
+
+
+def _epoch_to_iso(value):
+    """エクスポートの日時（ISO文字列かUNIX秒）を文字列にそろえる。それ以外の値（null・配列など）は日時なし"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return datetime.fromtimestamp(value, timezone.utc).isoformat()
+        except (OverflowError, OSError, ValueError):
+            return ''
+    return ''
+
+
+def to_epoch(value):
+    """ISO 8601の日時文字列をUNIX秒に変換する（タイムゾーンがなければUTC扱い、読めなければNone）"""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class ClaudeAdapter:
+    """Claude.ai のエクスポート: [{uuid, name, created_at, chat_messages: [{sender, content: [{type, text}]}]}]"""
+
+    name = 'claude'
+    array_key = None
+
+    def matches(self, first):
+        return isinstance(first, dict) and 'chat_messages' in first
+
+    def raw_id(self, raw, idx):
+        return raw.get('uuid', f"unknown_{idx}")
+
+    def normalize(self, raw, idx):
+        messages = []
+        for msg in raw.get('chat_messages') or []:
+            # content配列からtype="text"のみを抽出（content がない古い形式は text を使う）
+            if 'content' in msg:
+                parts = [item.get('text', '').strip() for item in msg.get('content') or [] if item.get('type') == 'text']
+                text = ' '.join(p for p in parts if p)
+            else:
+                text = (msg.get('text') or '').strip()
+            messages.append((msg.get('sender', 'unknown'), text, msg.get('created_at', '')))
+        return Conversation(
+            id=self.raw_id(raw, idx),
+            title=raw.get('name') or '(無題)',
+            created_at=_epoch_to_iso(raw.get('created_at')),
+            updated_at=_epoch_to_iso(raw.get('updated_at')),
+            messages=messages,
+        )
+
+
+class ChatGPTAdapter:
+    """ChatGPT のエクスポート: [{id, title, create_time, mapping: {node_id: {message, parent}}, current_node}]"""
+
+    name = 'chatgpt'
+    array_key = None
+
+    def matches(self, first):
+        return isinstance(first, dict) and 'mapping' in first
+
+    def raw_id(self, raw, idx):
+        return raw.get('conversation_id') or raw.get('id') or f"unknown_{idx}"
+
+    def normalize(self, raw, idx):
+        mapping = raw.get('mapping') or {}
+        # current_node から親をたどって、表示されている分岐だけを取り出す
+        node_id = raw.get('current_node')
+        if node_id not in mapping:
+            node_id = next((k for k, v in mapping.items() if not v.get('children')), None)
+        path = []
+        while node_id in mapping:
+            path.append(mapping[node_id])
+            node_id = mapping[node_id].get('parent')
+
+        messages = []
+        for node in reversed(path):
+            message = node.get('message')
+            if not message:
+                continue
+            content = message.get('content') or {}
+            parts = [p.strip() for p in content.get('parts') or [] if isinstance(p, str) and p.strip()]
+            role = (message.get('author') or {}).get('role', 'unknown')
+            messages.append((role, ' '.join(parts), _epoch_to_iso(message.get('create_time'))))
+        return Conversation(
+            id=self.raw_id(raw, idx),
+            title=raw.get('title') or '(無題)',
+            created_at=_epoch_to_iso(raw.get('create_time')),
+            updated_at=_epoch_to_iso(raw.get('update_time')),
+            messages=messages,
+        )
+
+
+class SimpleAdapter:
+    """シンプルな形式（smaple_data）: {"conversations": [{id, title, messages: [{role, content, timestamp}]}]}"""
+
+    name = 'simple'
+    array_key = 'conversations'
+
+    def matches(self, first):
+        return isinstance(first, dict) and 'messages' in first
+
+    def raw_id(self, raw, idx):
+        return raw.get('id', f"unknown_{idx}")
+
+    def normalize(self, raw, idx):
+        messages = [
+            (msg.get('role', 'unknown'), (msg.get('content') or '').strip(), msg.get('timestamp', ''))
+            for msg in raw.get('messages') or []
+        ]
+        return Conversation(
+            id=self.raw_id(raw, idx),
+            title=raw.get('title') or '(無題)',
+            created_at=_epoch_to_iso(raw.get('created_at')),
+            updated_at=_epoch_to_iso(raw.get('updated_at')),
+            messages=messages,
+        )
+
+
+# 新しい形式はアダプタを作ってここに足す（先頭から順に判定する）
+ADAPTERS = [ClaudeAdapter(), ChatGPTAdapter(), SimpleAdapter()]
+
+
+def get_adapter(name):
+    for adapter in ADAPTERS:
+        if adapter.name == name:
+            return adapter
+    raise ValueError(f"未対応の形式です: {name}")
+
+
+def _first_char(fp):
+    # 先頭の空白/BOMを飛ばした1文字目を見て、ファイル位置は戻しておく
+    head = fp.read(1024)
+    fp.seek(0)
+    if isinstance(head, bytes):
+        head = head.decode('utf-8', 'ignore')
+    head = head.lstrip('\ufeff \t\r\n')
+    return head[:1]
+
+
+def iter_conversations(fp, format=None):
+    """エクスポートファイルを1会話ずつ Conversation にして返すジェネレータ
+
+    format を省略すると、トップレベルの形と最初の会話のキーから形式を判定する。
+    fp はシーク可能なファイル（バイナリ/テキストどちらでも）。
+    """
+    if _first_char(fp) == '{':
+        # {"conversations": [...]} のようにオブジェクトで包まれている形式
+        candidates = [a for a in ADAPTERS if a.array_key]
+    else:
+        candidates = [a for a in ADAPTERS if not a.array_key]
+    if format is not None:
+        candidates = [get_adapter(format)]
+
+    adapter = None
+    for idx, raw in enumerate(iter_array(fp, candidates[0].array_key)):
+        if adapter is None:
+            adapter = next((a for a in candidates if a.matches(raw)), candidates[0])
+        try:
+            yield adapter.normalize(raw, idx)
+        except Exception as e:
+            try:
+                raw_id = adapter.raw_id(raw, idx)
+            except Exception:
+                raw_id = f"unknown_{idx}"
+            yield Conversation(id=raw_id, title='(読み込み失敗)', error=str(e))
@@ -0,0 +1,630 @@
+import hashlib
+import time
+from itertools import chain
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from chunking import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, chunk_messages
+from dedup import minhash
+from formats import Conversation, to_epoch
+from metrics import metrics
+from ratelimit import TokenBucket, call_with_retry
+from related import add_chunks, conversation_vectors
+
+# Embeddingモデルと1リクエストあたりの上限（OpenAI Embeddings APIの制限）
+EMBEDDING_MODEL = "text-embedding-3-small"
+MAX_ITEMS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300000
+MAX_TOKENS_PER_INPUT = 8191
+
+# 1リクエストに詰めるトークン数の目安（上限ぎりぎりまで詰めるとレスポンスが重くなる）
+TARGET_TOKENS_PER_REQUEST = 100000
+
+# collection.add 1回あたりの件数
+ADD_BATCH_SIZE = 1000
+
+# 同時に投げるEmbeddingリクエスト数と、レート制限の予算（text-embedding-3-small Tier1相当）
+EMBEDDING_CONCURRENCY = 4
+EMBEDDING_RPM = 3000
+EMBEDDING_TPM = 1000000
+
+# 既存ハッシュの読み込み・削除をまとめて行う件数
+GET_BATCH_SIZE = 5000
+
+# ChromaDBに置くスニペットの文字数（全文は docstore.DocumentStore に置く）
+SNIPPET_CHARS = 300
+
+# 保存形式のバージョン（チャンクのメタデータの store_format に書く）。形式が違う保存済みの会話は、
+# 内容が同じなら次のインポートで collection.update でドキュメントとメタデータだけ書き直す（Embeddingし直さない）
+STORE_FORMAT_VERSION = 2
+# document_store なしで、ChromaDBにチャンク全体を置く形式（store_format がない会話もこれ）
+LEGACY_STORE_FORMAT = 1
+
+def make_openai_embed_fn(client, model=EMBEDDING_MODEL):
+    """OpenAIクライアントから embed_fn(texts) -> ベクトルのリスト を作る"""
+    def embed(texts):
+        response = client.embeddings.create(model=model, input=texts)
+        # indexの順に並べ直して入力順と揃える
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+    return embed
+
+
+def content_hash(chat_id, updated_at, text, chunk_config=''):
+    """変更検知用のハッシュ（uuid + updated_at + 抽出テキスト + チャンク設定）"""
+    h = hashlib.sha256()
+    for part in (chat_id, updated_at, text, chunk_config):
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def load_existing(collection, batch_size=GET_BATCH_SIZE):
+    """保存済みの会話を {chat_id: {'hash', 'ids', 'complete', 'format'}} で返す（メタデータのみ読む）
+
+    complete は全チャンクが同じハッシュで揃っているか。途中で失敗した会話は再インポートの対象にする。
+    format は保存形式（チャンクごとに違えばNone）。
+    """
+    existing = {}
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=batch_size, offset=offset)
+        ids = page['ids']
+        for record_id, metadata in zip(ids, page['metadatas']):
+            metadata = metadata or {}
+            entry = existing.setdefault(metadata.get('chat_id', record_id),
+                                        {'hashes': set(), 'formats': set(), 'ids': set(), 'chunk_count': None})
+            entry['hashes'].add(metadata.get('content_hash'))
+            entry['formats'].add(metadata.get('store_format', LEGACY_STORE_FORMAT))
+            entry['ids'].add(record_id)
+            entry['chunk_count'] = metadata.get('chunk_count')
+        if len(ids) < batch_size:
+            break
+        offset += len(ids)
+
+    for entry in existing.values():
+        hashes = entry.pop('hashes')
+        entry['hash'] = hashes.pop() if len(hashes) == 1 else None
+        formats = entry.pop('formats')
+        entry['format'] = formats.pop() if len(formats) == 1 else None
+        entry['complete'] = entry['hash'] is not None and entry.pop('chunk_count') == len(entry['ids'])
+    return existing
+
+
+def extract_conversation(conv, idx, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS,
+                         store_format=STORE_FORMAT_VERSION):
+    """会話1件(formats.Conversation)をメッセージ境界でチャンクに分け、インポート用の会話レコードを作る
+
+    スキップ時は (None, 理由) を返す。
+    """
+    chat_id = conv.id
+    title = conv.title
+
+    # メッセージがない会話はスキップ
+    if not conv.messages:
+        return None, f"スキップ{idx}: タイトル='{title}', ID={chat_id[:20]} - メッセージ0件"
+
+    lines = conv.lines()
+
+    # 空のテキストの場合はスキップ
+    if not lines:
+        return None, f"スキップ{idx}: タイトル='{title}', {len(conv.messages)}msg, ID={chat_id[:20]}... - テキスト抽出0文字(contentが空?)"
+
+    full_text = '\n'.join(line for _, line in lines)
+    # 保存形式のバージョンは含めない（形式を変えても、内容とチャンク設定が同じならEmbeddingし直さない）
+    digest = content_hash(chat_id, conv.updated_at, full_text, f"{max_tokens}/{overlap_tokens}")
+    chunks = chunk_messages(lines, max_tokens, overlap_tokens)
+
+    # 日付での絞り込み用に作成日時をUNIX秒でも持つ（読めない日時ならキーごと持たない）
+    created_ts = to_epoch(conv.created_at)
+
+    records = []
+    for chunk_index, chunk in enumerate(chunks):
+        metadata = {
+            'chat_id': chat_id,
+            'title': title,
+            'created_at': conv.created_at,
+            'message_count': len(conv.messages),
+            'content_hash': digest,
+            'chunk_index': chunk_index,
+            'chunk_count': len(chunks),
+            'msg_start': chunk['msg_start'],
+            'msg_end': chunk['msg_end'],
+            'store_format': store_format,
+        }
+        if created_ts is not None:
+            metadata['created_ts'] = created_ts
+        records.append({
+            'id': f"{chat_id}#{chunk_index}",
+            'chat_id': chat_id,
+            'text': chunk['text'],
+            'document': chunk['text'][:SNIPPET_CHARS],
+            'tokens': chunk['tokens'],
+            'metadata': metadata,
+        })
+
+    conversation = {
+        'id': chat_id,
+        'title': title,
+        'content_hash': digest,
+        'records': records,
+        # 近い重複の判定用（dedup.minhash）
+        'full_text': full_text,
+        # DocumentStore に保存する全文（メッセージ単位・切り詰めなし）
+        'body': {
+            'title': title,
+            'created_at': conv.created_at,
+            'updated_at': conv.updated_at,
+            'messages': list(conv.messages),
+        },
+    }
+    return conversation, None
+
+
+class ImportStats:
+    """インポート結果とスループット"""
+
+    def __init__(self):
+        self.success_count = 0
+        self.new_count = 0
+        self.updated_count = 0
+        self.unchanged_count = 0
+        self.removed_count = 0
+        self.skipped_count = 0
+        self.resumed_count = 0
+        self.error_count = 0
+        self.duplicate_count = 0
+        self.relinked_count = 0  # 代表が消えて（内容が変わって）代表になり、Embeddingし直した重複
+        self.migrated_count = 0  # 変更なしのうち、保存形式だけ書き直した会話
+        self.error_logs = []
+        self.processed = 0
+        self.chunks = 0
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+
+    def tick(self):
+        self.elapsed = time.perf_counter() - self.started_at
+
+    @property
+    def conversations_per_sec(self):
+        return self.success_count / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def tokens_per_sec(self):
+        return self.tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'success': self.success_count,
+            'new': self.new_count,
+            'updated': self.updated_count,
+            'unchanged': self.unchanged_count,
+            'removed': self.removed_count,
+            'skipped': self.skipped_count,
+            'resumed': self.resumed_count,
+            'errors': self.error_count,
+            'duplicates': self.duplicate_count,
+            'relinked': self.relinked_count,
+            'migrated': self.migrated_count,
+            'processed': self.processed,
+            'chunks': self.chunks,
+            'tokens': self.tokens,
+            'requests': self.requests,
+            'retries': self.retries,
+            'elapsed_sec': round(self.elapsed, 3),
+            'conversations_per_sec': round(self.conversations_per_sec, 2),
+            'tokens_per_sec': round(self.tokens_per_sec, 1),
+        }
+
+
+def iter_request_batches(records, max_items=MAX_ITEMS_PER_REQUEST, max_tokens=TARGET_TOKENS_PER_REQUEST):
+    """レコードを件数・トークン数の上限内に収まるEmbeddingリクエスト単位にまとめる"""
+    batch = []
+    batch_tokens = 0
+    for record in records:
+        if batch and (len(batch) >= max_items or batch_tokens + record['tokens'] > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(record)
+        batch_tokens += record['tokens']
+    if batch:
+        yield batch
+
+
+def run_import(conversations, collection, embed_fn, on_progress=None,
+               max_items=MAX_ITEMS_PER_REQUEST, max_tokens=TARGET_TOKENS_PER_REQUEST,
+               add_batch_size=ADD_BATCH_SIZE, concurrency=EMBEDDING_CONCURRENCY,
+               rate_limiter=None, delete_missing=True,
+               chunk_max_tokens=CHUNK_MAX_TOKENS, chunk_overlap_tokens=CHUNK_OVERLAP_TOKENS,
+               total=None, keyword_index=None, on_write=None, checkpoint=None, document_store=None,
+               duplicate_index=None, vector_index=None, related_index=None):
+    """会話を抽出→チャンク分割→まとめてEmbedding→まとめてcollection.upsert するバッチパイプライン
+
+    1チャンク = 1レコード（ID は "{chat_id}#{チャンク番号}"）として保存する。
+    保存済みの content_hash と比較し、変わっていない会話はEmbeddingせずにスキップする。
+    delete_missing=True ならエクスポートに含まれない保存済みの会話を削除する。
+    keyword_index(KeywordIndex) を渡すと、同じチャンクをBM25インデックスにも反映する。
+    vector_index(flat_index.FlatIndex) を渡すと、同じベクトルをそこにも書き込む。
+    related_index(related.RelatedIndex) を渡すと、最後に追加・更新・削除した会話の分だけ関連する会話のグラフを更新する。
+    on_write() はコレクションを書き換えるたびに呼ばれる（検索結果キャッシュの無効化用）。
+    checkpoint(journal.Checkpoint) を渡すと完了した会話を記録し、前回完了済みの会話は読み飛ばす。
+    document_store(docstore.DocumentStore) を渡すと会話の全文をそこに保存する（ChromaDBにはスニペットだけ置く）。
+    変更のない会話でも保存形式が違えば、Embeddingはそのままでドキュメント・メタデータ・全文だけ書き直す。
+    duplicate_index(dedup.DuplicateIndex) と document_store を渡すと、保存済みでない会話がほかの会話の
+    近い重複なら代表の会話にリンクするだけでEmbeddingしない（全文は document_store に置く）。
+    保存済みの会話は重複でもリンクだけして残す（検索結果では代表と1件にまとまる）。
+    代表が消えたり内容が変わったりした重複は、同じインポートの最後に代表を選び直し、
+    代表になったものは document_store の全文からEmbeddingする。
+
+    embed_fn はテキストのリストを受け取りベクトルのリストを返す関数。
+    Embeddingはワーカースレッドで最大 concurrency 件まで並行して投げ、
+    rate_limiter(TokenBucket) でRPM/TPMを守る。429/5xxはバックオフしてリトライする。
+    conversations は formats.Conversation のリストかジェネレータ（formats.iter_conversations など）。
+    on_progress(処理済み件数, 総件数, stats) は呼び出し元スレッドから呼ばれる。
+    総件数は total で渡すか len() から取り、どちらも無ければNone。
+    """
+    stats = ImportStats()
+    if total is None:
+        try:
+            total = len(conversations)
+        except TypeError:
+            pass
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(EMBEDDING_RPM, EMBEDDING_TPM)
+    # 1チャンクは1入力の上限を超えないようにする
+    chunk_max_tokens = min(chunk_max_tokens, MAX_TOKENS_PER_INPUT)
+
+    # 全文を別に保存するときはChromaDBにスニペットだけ、そうでなければチャンク全体を置く
+    store_format = STORE_FORMAT_VERSION if document_store is not None else LEGACY_STORE_FORMAT
+    existing = load_existing(collection)
+    if duplicate_index is not None:
+        duplicate_index.load()
+    duplicates_changed = False
+    changed_canonicals = []  # 今回内容が変わって代表になった会話（リンクしている重複を選び直す）
+    dropped = []  # 近い重複の索引から消した会話
+    seen_ids = set()
+    in_progress = {}  # chat_id -> {'remaining', 'failed', 'is_new', 'stale_ids'}
+    written_ids = []  # 全チャンクを書き込めた会話（関連する会話のグラフの更新用）
+    related_totals = {}  # chat_id -> [タイトル, チャンクの単位ベクトルの合計]（ChromaDBから読み直さないため）
+    pending = []  # collection.upsert待ちのチャンク
+    migrating = []  # 保存形式を書き直す（collection.update待ちの）変更のない会話
+
+    def document(record):
+        return record['document'] if store_format == STORE_FORMAT_VERSION else record['text']
+
+    def link_duplicate(conversation):
+        # 近い重複なら代表の会話IDを返す。前回と内容が同じなら前回の判定をそのまま使う
+        nonlocal duplicates_changed
+        registered = duplicate_index.lookup(conversation['id'])
+        if registered is not None and registered[0] == conversation['content_hash']:
+            return registered[1]
+        with metrics.timer('minhash'):
+            signature = minhash(conversation['full_text'])
+        if signature is None:
+            return None
+        duplicates_changed = True
+        canonical_id = duplicate_index.register(conversation['id'], conversation['title'],
+                                                conversation['content_hash'], signature)
+        if canonical_id is None:
+            changed_canonicals.append(conversation['id'])
+        return canonical_id
+
+    def extracted():
+        for idx, conv in enumerate(conversations):
+            # 前回のインポートで完了済みの会話は抽出もせずに飛ばす
+            if checkpoint is not None and checkpoint.is_done(conv.id):
+                seen_ids.add(conv.id)
+                stats.resumed_count += 1
+                stats.processed = idx + 1
+                continue
+            if conv.error is None:
+                with metrics.timer('extract'):
+                    conversation, skip_reason = extract_conversation(conv, idx, chunk_max_tokens, chunk_overlap_tokens,
+                                                                     store_format)
+            else:
+                stats.error_count += 1
+                stats.error_logs.append(f"会話{idx}: ID={conv.id[:20]} - {conv.error[:150]}")
+                # 読めなかった会話は保存済みのデータを消さずに残す
+                seen_ids.add(conv.id)
+                conversation, skip_reason = None, None
+            stats.processed = idx + 1
+            if on_progress and stats.processed % 100 == 0:
+                stats.tick()
+                on_progress(stats.processed, total, stats)
+            if skip_reason:
+                stats.skipped_count += 1
+                stats.error_logs.append(skip_reason)
+                if checkpoint is not None:
+                    checkpoint.mark(conv.id, idx)
+            if conversation is None:
+                continue
+            chat_id = conversation['id']
+            if chat_id in seen_ids:
+                stats.error_count += 1
+                stats.error_logs.append(f"会話{idx}: {conversation['title'][:30]} - 重複ID {chat_id[:20]}")
+                continue
+            seen_ids.add(chat_id)
+            old = existing.get(chat_id)
+            # 全文を置けないときは重複も読み飛ばさない（代表が消えたときにEmbeddingし直せないため）
+            skip_duplicates = duplicate_index is not None and document_store is not None
+            canonical_id = link_duplicate(conversation) if skip_duplicates else None
+
+            # 前回インポート時から変わっていなければEmbeddingしない
+            if old and old['complete'] and old['hash'] == conversation['content_hash']:
+                stats.unchanged_count += 1
+                if old['format'] != store_format:
+                    migrating.append(conversation)
+                    if sum(len(c['records']) for c in migrating) >= add_batch_size:
+                        migrate()
+                if checkpoint is not None:
+                    checkpoint.mark(chat_id, idx)
+                continue
+
+            # 保存済みでない近い重複はEmbeddingせず、全文だけ置いておく
+            if canonical_id is not None and old is None:
+                stats.duplicate_count += 1
+                try:
+                    with metrics.timer('docstore_put'):
+                        document_store.put_many([(chat_id, conversation['body'])])
+                except Exception as e:
+                    stats.error_logs.append(f"全文の保存失敗 ({chat_id[:20]}): {str(e)[:150]}")
+                if checkpoint is not None:
+                    checkpoint.mark(chat_id, idx)
+                continue
+
+            records = conversation['records']
+            new_ids = {r['id'] for r in records}
+            in_progress[chat_id] = {
+                'idx': idx,
+                'remaining': len(records),
+                'failed': False,
+                'is_new': old is None,
+                'body': conversation['body'],
+                # チャンク数が減った場合などに残る古いレコード
+                'stale_ids': [i for i in old['ids'] if i not in new_ids] if old else [],
+            }
+            yield from records
+
+    def relinked():
+        # エクスポートを読み終えてから（seen_ids が揃ってから）動く。代表が消えた・内容が変わった重複の
+        # 代表を選び直し、Embeddingしていなかった会話が代表になったら document_store の全文からEmbeddingする
+        nonlocal duplicates_changed
+        if duplicate_index is None:
+            return
+        targets = duplicate_index.members(changed_canonicals)
+        if delete_missing:
+            removed_signatures, orphaned = duplicate_index.retain(seen_ids)
+            dropped.extend(removed_signatures)
+            targets.extend(orphaned)
+        if document_store is None:
+            return
+        # Embedding済み・Embedding中の会話は選び直すだけでよい
+        embedded = set(existing) | set(written_ids) | set(in_progress)
+        for chat_id in dict.fromkeys(targets):
+            duplicates_changed = True
+            if duplicate_index.relink(chat_id) is not None or chat_id in embedded:
+                continue
+            body = document_store.get(chat_id)
+            if body is None:
+                stats.error_logs.append(f"重複の代表の選び直し失敗 ({chat_id[:20]}): 全文がありません")
+                continue
+            conv = Conversation(chat_id, body['title'], body['created_at'], body['updated_at'],
+                                [tuple(message) for message in body['messages']])
+            conversation, skip_reason = extract_conversation(conv, -1, chunk_max_tokens, chunk_overlap_tokens,
+                                                             store_format)
+            if conversation is None:
+                stats.error_logs.append(skip_reason)
+                continue
+            stats.relinked_count += 1
+            in_progress[chat_id] = {
+                'idx': None,
+                'remaining': len(conversation['records']),
+                'failed': False,
+                'is_new': True,
+                'body': conversation['body'],
+                'stale_ids': [],
+            }
+            yield from conversation['records']
+
+    def migrate():
+        # 内容は同じなのでEmbeddingはそのまま。ChromaDBのドキュメント・メタデータと全文だけ書き直す
+        if not migrating:
+            return
+        records = [r for conversation in migrating for r in conversation['records']]
+        ids = [r['id'] for r in records]
+        try:
+            with metrics.timer('chroma_update'):
+                # ベクトルを渡さないとコレクションの embedding_function で作り直されるので、保存済みのものを渡す
+                page = collection.get(ids=ids, include=['embeddings'])
+                embeddings = dict(zip(page['ids'], page['embeddings']))
+                collection.update(ids=ids, embeddings=[embeddings[i] for i in ids],
+                                  documents=[document(r) for r in records],
+                                  metadatas=[r['metadata'] for r in records])
+            if document_store is not None:
+                with metrics.timer('docstore_put'):
+                    document_store.put_many([(c['id'], c['body']) for c in migrating])
+            if on_write:
+                on_write()
+            stats.migrated_count += len(migrating)
+        except Exception as e:
+            stats.error_logs.append(f"保存形式の書き直し失敗 ({len(migrating)}件): {str(e)[:150]}")
+        migrating.clear()
+
+    def embed_batch(batch):
+        # ワーカースレッドで実行される。statsには触らない
+        rate_limiter.acquire(tokens=sum(r['tokens'] for r in batch))
+        with metrics.timer('embed'):
+            result = call_with_retry(embed_fn, [r['text'] for r in batch])
+        metrics.inc('embedded_chunks', len(batch))
+        return result
+
+    def finish(records, ok):
+        # チャンクの書き込み結果を会話単位に集計する
+        stale_ids = []
+        bodies = []
+        for record in records:
+            state = in_progress[record['chat_id']]
+            state['failed'] = state['failed'] or not ok
+            state['remaining'] -= 1
+            if state['remaining'] > 0:
+                continue
+            del in_progress[record['chat_id']]
+            if state['failed']:
+                stats.error_count += 1
+                continue
+            stats.success_count += 1
+            written_ids.append(record['chat_id'])
+            bodies.append((record['chat_id'], state['body']))
+            if checkpoint is not None and state['idx'] is not None:
+                checkpoint.mark(record['chat_id'], state['idx'])
+            if state['is_new']:
+                stats.new_count += 1
+            else:
+                stats.updated_count += 1
+            stale_ids.extend(state['stale_ids'])
+        if bodies and document_store is not None:
+            try:
+                with metrics.timer('docstore_put'):
+                    document_store.put_many(bodies)
+            except Exception as e:
+                stats.error_logs.append(f"全文の保存失敗 ({len(bodies)}件): {str(e)[:150]}")
+        if stale_ids:
+            try:
+                collection.delete(ids=stale_ids)
+                if keyword_index is not None:
+                    keyword_index.delete(stale_ids)
+                if vector_index is not None:
+                    vector_index.delete(stale_ids)
+                if on_write:
+                    on_write()
+            except Exception as e:
+                stats.error_logs.append(f"古いチャンクの削除失敗 ({len(stale_ids)}件): {str(e)[:150]}")
+
+    def flush():
+        if not pending:
+            return
+        try:
+            with metrics.timer('chroma_upsert'):
+                collection.upsert(
+                    ids=[r['id'] for r in pending],
+                    documents=[document(r) for r in pending],
+                    embeddings=[r['embedding'] for r in pending],
+                    metadatas=[r['metadata'] for r in pending],
+                )
+            metrics.inc('upserted_chunks', len(pending))
+            if keyword_index is not None:
+                with metrics.timer('keyword_index_add'):
+                    keyword_index.add((r['id'], r['chat_id'], r['text'], r['metadata']) for r in pending)
+            if vector_index is not None:
+                with metrics.timer('flat_upsert'):
+                    vector_index.upsert([r['id'] for r in pending], [r['embedding'] for r in pending],
+                                        [r['metadata'] for r in pending])
+            if related_index is not None:
+                with metrics.timer('related_vectors'):
+                    add_chunks(related_totals, [r['id'] for r in pending], [r['embedding'] for r in pending],
+                               [r['metadata'] for r in pending])
+            if on_write:
+                on_write()
+            stats.chunks += len(pending)
+            finish(pending, True)
+            if checkpoint is not None:
+                checkpoint.flush()
+        except Exception as e:
+            stats.error_logs.append(f"collection.upsert失敗 ({len(pending)}チャンク): {str(e)[:150]}")
+            finish(pending, False)
+        pending.clear()
+
+    def collect(futures):
+        for future in futures:
+            batch = in_flight.pop(future)
+            try:
+                embeddings, retries = future.result()
+                stats.requests += 1
+                stats.retries += retries
+                stats.tokens += sum(r['tokens'] for r in batch)
+                for record, embedding in zip(batch, embeddings):
+                    record['embedding'] = embedding
+                pending.extend(batch)
+            except Exception as e:
+                stats.error_logs.append(f"Embedding失敗 ({len(batch)}チャンク, 先頭={batch[0]['metadata']['title'][:30]}): {str(e)[:150]}")
+                finish(batch, False)
+
+        if len(pending) >= add_batch_size:
+            flush()
+
+        stats.tick()
+        if on_progress:
+            on_progress(stats.processed, total, stats)
+
+    in_flight = {}  # future -> batch
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for batch in iter_request_batches(chain(extracted(), relinked()), max_items, max_tokens):
+            # 同時実行数が上限に達していたら、どれかが終わるまで待つ
+            if len(in_flight) >= concurrency:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[pool.submit(embed_batch, batch)] = batch
+        while in_flight:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            collect(done)
+
+    flush()
+    migrate()
+
+    # エクスポートから消えた会話（または空になった会話）を削除する
+    removed = []
+    if delete_missing:
+        removed = [chat_id for chat_id in existing if chat_id not in seen_ids]
+        removed_ids = [record_id for chat_id in removed for record_id in existing[chat_id]['ids']]
+        for start in range(0, len(removed_ids), GET_BATCH_SIZE):
+            part = removed_ids[start:start + GET_BATCH_SIZE]
+            try:
+                collection.delete(ids=part)
+                if keyword_index is not None:
+                    keyword_index.delete(part)
+                if vector_index is not None:
+                    vector_index.delete(part)
+                if on_write:
+                    on_write()
+            except Exception as e:
+                stats.error_logs.append(f"削除失敗: {str(e)[:150]}")
+        if document_store is not None and removed:
+            document_store.delete(removed)
+        stats.removed_count = len(removed)
+        # 重複として読み飛ばしていた会話はChromaDBにないので、ここで全文も消す（エクスポートにある会話は消さない）
+        dropped = [chat_id for chat_id in dropped if chat_id not in existing and chat_id not in seen_ids]
+        if document_store is not None and dropped:
+            document_store.delete(dropped)
+        duplicates_changed = duplicates_changed or bool(dropped)
+
+    if related_index is not None:
+        try:
+            # 途中で書き込みに失敗した会話は含めない（前回のベクトルのまま残る）
+            vectors = conversation_vectors({chat_id: related_totals[chat_id] for chat_id in written_ids})
+            # 中断したインポートで書き込んだ会話（再開で読み飛ばした・変更なしになった会話）がグラフになければ、
+            # ChromaDBのEmbeddingから足す
+            missing = related_index.missing(
+                chat_id for chat_id in seen_ids if chat_id in existing and chat_id not in vectors
+            )
+            if missing:
+                vectors.update(related_index.vectors_from_collection(collection, missing))
+            if vectors or removed:
+                with metrics.timer('related_update'):
+                    related_index.update(vectors, removed)
+        except Exception as e:
+            stats.error_logs.append(f"関連する会話の更新失敗: {str(e)[:150]}")
+
+    # リンクが変わったら検索結果のまとめ方も変わる
+    if duplicates_changed and on_write:
+        on_write()
+
+    # 最後まで終わったので途中経過は不要（エラーの会話は次回のインポートでハッシュ比較から再挑戦される）
+    if checkpoint is not None:
+        checkpoint.complete()
+
+    stats.tick()
+    if on_progress:
+        on_progress(stats.processed, total, stats)
+    return stats
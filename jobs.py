@@ -0,0 +1,148 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# 同時に走らせるジョブ数（インポート同士はChromaDBへの書き込みが競合するので1つずつ）
+JOB_WORKERS = 1
+
+# 画面に残しておく終了済みジョブの数
+JOB_HISTORY = 20
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """バックグラウンドで動くジョブ1件の状態。UIスレッドからはポーリングで読む"""
+
+    def __init__(self, job_id, name, total=None, key=None, owner=None):
+        self.id = job_id
+        self.name = name
+        self.key = key
+        self.owner = owner
+        self.status = QUEUED
+        self.total = total
+        self.processed = 0
+        self.stats = None
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+
+    def update(self, processed, total=None, stats=None):
+        """ジョブの中から進捗を報告する。キャンセルされていたら JobCancelled を送出する"""
+        self.processed = processed
+        if total is not None:
+            self.total = total
+        if stats is not None:
+            self.stats = stats
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rate(self):
+        """1秒あたりの処理件数"""
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """残り秒数の見込み（分からなければNone）"""
+        if not self.total or self.rate <= 0:
+            return None
+        return max(0.0, (self.total - self.processed) / self.rate)
+
+    @property
+    def fraction(self):
+        if not self.total:
+            return 0.0
+        return min(1.0, self.processed / self.total)
+
+
+class JobManager:
+    """ジョブをスレッドプールで実行し、状態を保持する
+
+    Streamlitでは st.cache_resource でプロセスに1つだけ作り、画面からは jobs() をポーリングする。
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, history=JOB_HISTORY):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.history = history
+
+    def submit(self, name, fn, total=None, key=None, owner=None):
+        """fn(job) をバックグラウンドで実行する。fn の戻り値は job.result に入る
+
+        key は同じ入力のジョブを見分けるためのもの（find_active で二重投入を防ぐ）。
+        owner はジョブを投入したテナント（ほかのユーザーのジョブは見せない）。
+        """
+        job = Job(next(self._ids), name, total, key, owner)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = fn(job)
+            job.status = DONE
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def jobs(self, owner=None):
+        """新しい順（owner を指定するとそのテナントのジョブだけ）"""
+        with self._lock:
+            jobs = list(reversed(self._jobs.values()))
+        return jobs if owner is None else [job for job in jobs if job.owner == owner]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def find_active(self, key, owner=None):
+        """key が同じで待機中・実行中のジョブ（なければNone）"""
+        for job in self.jobs(owner):
+            if job.active and job.key == key:
+                return job
+        return None
+
+    def has_active(self, owner=None):
+        return any(job.active for job in self.jobs(owner))
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# チェックポイントの保存先
+JOURNAL_PATH = "./chroma_db/import_journal.sqlite"
+
+# 完了した会話をまとめて書き込む件数
+JOURNAL_FLUSH_SIZE = 500
+
+# ファイルの指紋に使う先頭・末尾のバイト数
+FINGERPRINT_BYTES = 1024 * 1024
+
+
+def fingerprint(fp):
+    """エクスポートファイルの指紋（サイズ + 先頭と末尾1MBのsha256）。読み終えたら先頭に戻す"""
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    h = hashlib.sha256(str(size).encode())
+    fp.seek(0)
+    h.update(fp.read(FINGERPRINT_BYTES))
+    if size > FINGERPRINT_BYTES:
+        fp.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+        h.update(fp.read(FINGERPRINT_BYTES))
+    fp.seek(0)
+    return h.hexdigest()
+
+
+class ImportJournal:
+    """インポートの進み具合を記録する追記型のジャーナル（SQLite）
+
+    同じファイルのインポートが途中で止まっても、次回は完了済みの会話を飛ばして再開できる。
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                source TEXT,
+                total INTEGER,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS done (
+                job_key TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                PRIMARY KEY (job_key, chat_id)
+            ) WITHOUT ROWID;
+        """)
+        self._conn.commit()
+
+    def open(self, job_key, source=None, total=None):
+        """チェックポイントを開く。前回の途中経過があればそこから再開する"""
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO jobs (job_key, source, total, started_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(job_key) DO UPDATE SET updated_at = excluded.updated_at
+            """, (job_key, source, total, time.time(), time.time()))
+            self._conn.commit()
+            rows = self._conn.execute("SELECT chat_id, idx FROM done WHERE job_key = ?", (job_key,)).fetchall()
+        return Checkpoint(self, job_key, {chat_id: idx for chat_id, idx in rows})
+
+    def progress(self, job_key):
+        """途中まで進んでいる場合は完了済みの件数を返す（なければ0）"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM done WHERE job_key = ?", (job_key,)).fetchone()[0]
+
+    def _append(self, job_key, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO done (job_key, chat_id, idx) VALUES (?, ?, ?)",
+                [(job_key, chat_id, idx) for chat_id, idx in items],
+            )
+            self._conn.execute("UPDATE jobs SET updated_at = ? WHERE job_key = ?", (time.time(), job_key))
+            self._conn.commit()
+
+    def _finish(self, job_key):
+        with self._lock:
+            self._conn.execute("DELETE FROM done WHERE job_key = ?", (job_key,))
+            self._conn.execute("DELETE FROM jobs WHERE job_key = ?", (job_key,))
+            self._conn.commit()
+
+    def discard(self, job_key):
+        """途中経過を捨てて最初からやり直す"""
+        self._finish(job_key)
+
+
+class Checkpoint:
+    """1回のインポートの途中経過。run_import から使う"""
+
+    def __init__(self, journal, job_key, done):
+        self.journal = journal
+        self.job_key = job_key
+        self.done = done  # chat_id -> 会話の通し番号
+        self.resumed = len(done)
+        self._buffer = []
+
+    def is_done(self, chat_id):
+        return chat_id in self.done
+
+    def mark(self, chat_id, idx):
+        self.done[chat_id] = idx
+        self._buffer.append((chat_id, idx))
+        if len(self._buffer) >= JOURNAL_FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.journal._append(self.job_key, self._buffer)
+            self._buffer = []
+
+    def complete(self):
+        """最後まで終わったら途中経過を消す"""
+        self._buffer = []
+        self.journal._finish(self.job_key)
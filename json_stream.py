@@ -0,0 +1,124 @@
+import codecs
+import json
+
+# 1回に読み込むバイト数
+READ_SIZE = 1024 * 1024
+
+_WHITESPACE = ' \t\n\r'
+# 数値の途中に現れる文字（"1." や "1e" で切れていても、先頭の "1" だけでデコードできてしまう）
+_NUMBER_CHARS = '0123456789.eE+-'
+
+
+class _Reader:
+    """ファイルを少しずつ読み、消費済みの部分を捨てながらJSON値を1つずつ取り出す"""
+
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._started = False
+        self._decoder = json.JSONDecoder()
+        # バイナリ(アップロードファイル)でもテキストでも読めるようにする
+        self._utf8 = codecs.getincrementaldecoder('utf-8-sig')()
+
+    def _fill(self, size):
+        if self.eof:
+            return False
+        data = self.fp.read(size)
+        if not data:
+            self.eof = True
+            if isinstance(self.buf, str):
+                self.buf += self._utf8.decode(b'', final=True)
+            return False
+        if isinstance(data, bytes):
+            data = self._utf8.decode(data)
+        elif not self._started:
+            # テキストで開いたファイルではBOMが残るので、先頭の1文字だけ捨てる
+            data = data[1:] if data.startswith('\ufeff') else data
+        self._started = True
+        # 読み終えた部分は捨ててメモリを増やさない
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """空白を飛ばして次の1文字を返す（終端ならNone）"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.read_size):
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSONの形式が不正です: '{char}' が必要な位置 (残り: {self.buf[self.pos:self.pos + 20]!r})")
+        self.pos += 1
+
+    def value(self):
+        """次のJSON値を1つデコードして返す"""
+        self.peek()
+        size = self.read_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                # 数値は途中で切れていてもデコードできてしまうので、数値の続きでない文字まで読めているか確認する
+                cut = isinstance(value, (int, float)) and end < len(self.buf) and self.buf[end] in _NUMBER_CHARS
+                if (end < len(self.buf) and not cut) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # 値が途中で切れている。読み込み量を倍々に増やして再挑戦する（再デコードの総コストを線形に抑える）
+            self._fill(size)
+            size *= 2
+
+
+def _iter_array(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        char = reader.peek()
+        if char == ',':
+            reader.pos += 1
+        elif char == ']':
+            reader.pos += 1
+            return
+        else:
+            raise ValueError("JSONの形式が不正です: 配列が閉じていません")
+
+
+def iter_array(fp, key=None, read_size=READ_SIZE):
+    """トップレベルの配列（key指定時は {key: [...]} の配列）の要素を1つずつ返すジェネレータ
+
+    ファイル全体を読み込まないので、メモリ使用量は一番大きい要素1つぶん程度に収まる。
+    """
+    reader = _Reader(fp, read_size)
+    if key is None:
+        yield from _iter_array(reader)
+        return
+
+    reader.expect('{')
+    while reader.peek() != '}':
+        name = reader.value()
+        reader.expect(':')
+        if name == key:
+            yield from _iter_array(reader)
+            return
+        reader.value()  # 関係ない値は読み飛ばす
+        if reader.peek() == ',':
+            reader.pos += 1
+    raise KeyError(key)
+
+
+def open_array(path, key=None, read_size=READ_SIZE):
+    """ファイルパスから iter_array する"""
+    with open(path, 'rb') as fp:
+        yield from iter_array(fp, key, read_size)
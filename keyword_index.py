@@ -0,0 +1,216 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+from docstore import message_range_text
+
+# インデックスの保存先
+KEYWORD_INDEX_PATH = "./chroma_db/keyword_index.sqlite"
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 文書の半分以上に出てくる語は、他に語があるなら検索に使わない（「して」「です」など）
+MAX_DF_RATIO = 0.5
+
+# 英数字の単語 / 日本語（ひらがな・カタカナ・漢字）の連続
+_TOKEN_RE = re.compile(r"[0-9a-z_]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆]+")
+
+
+def tokenize(text):
+    """日本語は文字bigram、英数字は単語単位に分ける（NFKCで全角/半角・大文字/小文字を揃える）"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        run = match.group()
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class KeywordIndex:
+    """チャンク単位のBM25転置インデックス（SQLiteに保存）
+
+    文書IDはChromaDBのレコードID（"{chat_id}#{チャンク番号}"）と同じものを使う。
+    チャンクのメタデータ（タイトル・作成日時・メッセージ数など）も持つので、キーワード検索はChromaDBを読まずに済む。
+    複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, path=KEYWORD_INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id TEXT PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                metadata TEXT
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc_id);
+        """)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(docs)")]
+        if 'metadata' not in columns:
+            # メタデータを持つ前に作ったインデックス（store.open_keyword_index が作り直す）
+            self._conn.execute("ALTER TABLE docs ADD COLUMN metadata TEXT")
+        self._conn.commit()
+        self._refresh_stats()
+
+    def _refresh_stats(self):
+        count, avg = self._conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        self.doc_count = count
+        self.avg_length = avg or 0.0
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh_if_changed(self):
+        # ほかのプロセス（CLIのインポートなど）が書き込んだら data_version が変わるので、件数・平均長を読み直す
+        if self._conn.execute("PRAGMA data_version").fetchone()[0] != self._data_version:
+            self._refresh_stats()
+
+    def _delete(self, doc_ids):
+        for start in range(0, len(doc_ids), 500):
+            part = doc_ids[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            self._conn.execute(f"DELETE FROM postings WHERE doc_id IN ({placeholders})", part)
+            self._conn.execute(f"DELETE FROM docs WHERE doc_id IN ({placeholders})", part)
+
+    def add(self, docs):
+        """docs: (doc_id, chat_id, text) か (doc_id, chat_id, text, ChromaDBのメタデータ) のリスト。同じIDがあれば置き換える"""
+        docs = list(docs)
+        if not docs:
+            return
+        doc_rows = []
+        posting_rows = []
+        for doc in docs:
+            doc_id, chat_id, text = doc[:3]
+            metadata = json.dumps(doc[3], ensure_ascii=False) if len(doc) > 3 and doc[3] is not None else None
+            counts = Counter(tokenize(text))
+            doc_rows.append((doc_id, chat_id, sum(counts.values()), metadata))
+            posting_rows.extend((term, doc_id, tf) for term, tf in counts.items())
+        with self._lock:
+            self._delete([d[0] for d in docs])
+            self._conn.executemany("INSERT INTO docs (doc_id, chat_id, length, metadata) VALUES (?, ?, ?, ?)",
+                                   doc_rows)
+            self._conn.executemany("INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)", posting_rows)
+            self._conn.commit()
+            self._refresh_stats()
+
+    def delete(self, doc_ids):
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return
+        with self._lock:
+            self._delete(doc_ids)
+            self._conn.commit()
+            self._refresh_stats()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM docs")
+            self._conn.commit()
+            self._refresh_stats()
+
+    def search(self, query, n_results=20, chat_ids=None):
+        """BM25スコアの高い順に (doc_id, chat_id, score) を返す
+
+        chat_ids（集合）を渡すと、その会話のチャンクだけを対象にする（絞り込み検索用）。
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            self._refresh_if_changed()
+            if self.doc_count == 0:
+                return []
+            n = self.doc_count
+            avg_length = self.avg_length or 1.0
+            dfs = {}
+            for term in terms:
+                dfs[term] = self._conn.execute("SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()[0]
+            usable = [t for t in terms if 0 < dfs[t] <= n * MAX_DF_RATIO]
+            if not usable:
+                usable = [t for t in terms if dfs[t] > 0]
+
+            scores = {}
+            doc_chat_ids = {}
+            for term in usable:
+                df = dfs[term]
+                idf = math.log((n - df + 0.5) / (df + 0.5) + 1)
+                rows = self._conn.execute("""
+                    SELECT p.doc_id, p.tf, d.length, d.chat_id
+                    FROM postings p JOIN docs d ON d.doc_id = p.doc_id
+                    WHERE p.term = ?
+                """, (term,))
+                for doc_id, tf, length, chat_id in rows:
+                    if chat_ids is not None and chat_id not in chat_ids:
+                        continue
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+                    doc_chat_ids[doc_id] = chat_id
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:n_results]
+        return [(doc_id, doc_chat_ids[doc_id], score) for doc_id, score in ranked]
+
+    def metadatas(self, doc_ids):
+        """{doc_id: メタデータ}（メタデータを持っていない文書は含めない）"""
+        doc_ids = list(doc_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(doc_ids), 500):
+                part = doc_ids[start:start + 500]
+                for doc_id, metadata in self._conn.execute(
+                    f"SELECT doc_id, metadata FROM docs WHERE doc_id IN ({','.join('?' * len(part))}) "
+                    "AND metadata IS NOT NULL", part
+                ):
+                    found[doc_id] = json.loads(metadata)
+        return found
+
+    def needs_metadata(self):
+        """メタデータを持っていない文書があるか（メタデータを持つ前に作ったインデックス）"""
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM docs WHERE metadata IS NULL LIMIT 1").fetchone() is not None
+
+    def rebuild_from_collection(self, collection, batch_size=1000, document_store=None):
+        """ChromaDBに保存済みのチャンクからインデックスを作り直す（インデックス導入前のデータ用）
+
+        ChromaDBにスニペットしか置いていない場合は、document_store(DocumentStore) の全文から
+        チャンクのメッセージ範囲のテキストを取り出して使う。
+        """
+        self.clear()
+        offset = 0
+        while True:
+            page = collection.get(include=['documents', 'metadatas'], limit=batch_size, offset=offset)
+            ids = page['ids']
+            bodies = {}
+            docs = []
+            for record_id, doc, metadata in zip(ids, page['documents'], page['metadatas']):
+                metadata = metadata or {}
+                chat_id = metadata.get('chat_id', record_id)
+                if document_store is not None and metadata.get('msg_start') is not None:
+                    if chat_id not in bodies:
+                        bodies[chat_id] = document_store.get(chat_id)
+                    if bodies[chat_id] is not None:
+                        doc = message_range_text(bodies[chat_id], metadata['msg_start'], metadata['msg_end'])
+                docs.append((record_id, chat_id, doc or '', metadata))
+            self.add(docs)
+            if len(ids) < batch_size:
+                return
+            offset += len(ids)
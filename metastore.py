@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import threading
+
+# ストア全体の付随情報（コレクションのバージョンなど）の保存先
+META_PATH = "./chroma_db/meta.sqlite"
+
+
+class MetaStore:
+    """コレクションに付随する小さなキー・バリューをSQLiteに保存する
+
+    別プロセス（CLIからのインポートなど）の更新も見えるよう、値は毎回SQLiteから読む。
+    """
+
+    def __init__(self, path=META_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+            self._conn.commit()
+
+    def collection_version(self):
+        return int(self.get('collection_version', 0))
+
+    def bump_version(self):
+        """コレクションが書き換わったら呼ぶ（検索結果キャッシュの無効化に使う）"""
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO meta (key, value) VALUES ('collection_version', '1')
+                ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            """)
+            self._conn.commit()
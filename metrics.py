@@ -0,0 +1,191 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムの区切り（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prometheusのメトリクス名の接頭辞
+METRICS_PREFIX = "memory_layer"
+
+# 今のリクエストの内訳（スレッド・コンテキストごと）
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """処理時間（タイマー）と件数（カウンター）をプロセス全体で集計する。複数スレッドから呼んでよい"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._timers.get(name)
+            if histogram is None:
+                histogram = self._timers[name] = Histogram()
+            histogram.observe(seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """with metrics.timer('chroma_query'): ... の処理時間を記録する（実行中のトレースにも足す）"""
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.enter(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if trace is not None:
+                trace.depth -= 1
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timers': {
+                    name: {
+                        'count': h.count,
+                        'sum_sec': round(h.sum, 6),
+                        'mean_ms': round(h.sum / h.count * 1000, 3) if h.count else 0.0,
+                        'max_ms': round(h.max * 1000, 3),
+                    }
+                    for name, h in self._timers.items()
+                },
+            }
+
+    def to_prometheus(self, prefix=METRICS_PREFIX):
+        """Prometheusのテキスト形式にする"""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                metric = f"{prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+            for name, h in sorted(self._timers.items()):
+                metric = f"{prefix}_{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+                lines.append(f"{metric}_sum {h.sum:.6f}")
+                lines.append(f"{metric}_count {h.count}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+
+class Trace:
+    """1リクエストの中で計った処理時間の内訳"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.total = 0.0
+        self.spans = {}  # 処理名 -> [回数, 秒, 入れ子の深さ]（始めた順）
+        self.depth = 0
+        self.attrs = {}
+
+    def enter(self, name):
+        self.spans.setdefault(name, [0, 0.0, self.depth])
+        self.depth += 1
+
+    def add(self, name, seconds):
+        span = self.spans.setdefault(name, [0, 0.0, self.depth])
+        span[0] += 1
+        span[1] += seconds
+
+    def breakdown(self):
+        """[(処理名, 回数, ミリ秒)]。どのタイマーにも入らなかった時間は 'other' にまとめる
+
+        入れ子のタイマー（embed_query の中の embed_api など）は外側の時間に含まれる。
+        """
+        rows = [(name, count, seconds * 1000) for name, (count, seconds, _) in self.spans.items()]
+        outer = sum(seconds for _, seconds, depth in self.spans.values() if depth == 0)
+        other = (self.total - outer) * 1000
+        if other > 0:
+            rows.append(('other', 1, other))
+        return rows
+
+    def to_dict(self):
+        return {
+            'trace': self.name,
+            'ts': round(self.started_at, 3),
+            'total_ms': round(self.total * 1000, 3),
+            'spans': {name: round(seconds * 1000, 3) for name, (_, seconds, _) in self.spans.items()},
+            **self.attrs,
+        }
+
+
+class JsonLinesLog:
+    """トレースを1行1JSONで追記する"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+# プロセス全体で1つの集計
+metrics = Metrics()
+
+
+@contextmanager
+def trace(name, log=None, registry=metrics):
+    """with trace('search') as t: の中で計ったタイマーを t に集める。終わったら全体の時間も記録する
+
+    log(JsonLinesLog) を渡すと、終わったときにトレースを1行書き出す。
+    """
+    current = Trace(name)
+    token = _current_trace.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        current.total = time.perf_counter() - started
+        registry.observe(f"{name}_request", current.total)
+        registry.inc(f"{name}_requests")
+        if log is not None:
+            log.write(current.to_dict())
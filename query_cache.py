@@ -0,0 +1,81 @@
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# キャッシュしておく検索結果の件数
+QUERY_CACHE_SIZE = 256
+
+
+def normalize_query(query):
+    """全角/半角・大文字/小文字・連続した空白の違いを吸収する"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', query)).strip().casefold()
+
+
+def make_key(query, n_results, mode, filters, version, rerank=None):
+    return (
+        normalize_query(query),
+        n_results,
+        mode,
+        json.dumps(filters, sort_keys=True, ensure_ascii=False) if filters else '',
+        version,
+        json.dumps(rerank, sort_keys=True) if rerank else '',
+    )
+
+
+class QueryCache:
+    """検索結果のLRUキャッシュ
+
+    キーにコレクションのバージョンを含めるので、インポートやリセットでバージョンが上がれば
+    古い結果には二度とヒットしない（古いものはLRUで押し出される）。
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, 計算にかかった秒数)
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def get_or_compute(self, key, compute):
+        """キャッシュにあればそれを、なければ compute() の結果を保存して返す。(値, ヒットしたか) を返す"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry[1]
+                return entry[0], True
+
+        started = time.perf_counter()
+        value = compute()
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (value, elapsed)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate, 3),
+            'saved_seconds': round(self.saved_seconds, 3),
+        }
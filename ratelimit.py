@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+
+# リトライ設定（429/5xx/通信エラーのみ対象）
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class TokenBucket:
+    """1分あたりのリクエスト数(RPM)とトークン数(TPM)の両方を守るトークンバケット
+
+    acquire() は両方のバケットに残量ができるまでブロックする。複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # 起動直後のバーストは1秒分に抑える
+        self._requests = min(requests_per_minute, max(1.0, requests_per_minute / 60))
+        self._tokens = min(tokens_per_minute, max(1.0, tokens_per_minute / 60))
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._last
+        self._last = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens=0):
+        # バケット容量を超える要求は容量まで切り詰める（永久に待たないように）
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait_requests = (1 - self._requests) * 60 / self.rpm if self._requests < 1 else 0
+                wait_tokens = (tokens - self._tokens) * 60 / self.tpm if self._tokens < tokens else 0
+            self._sleep(max(wait_requests, wait_tokens, 0.01))
+
+
+class NoLimit:
+    """レート制限なし（ローカルで推論する場合など）"""
+
+    def acquire(self, tokens=0):
+        pass
+
+
+def _status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        response = getattr(error, 'response', None)
+        status = getattr(response, 'status_code', None)
+    return status
+
+
+def is_retryable(error):
+    """429・5xx・接続エラー/タイムアウトならリトライ対象"""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # openai.APIConnectionError / APITimeoutError はstatus_codeを持たない
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """指数バックオフ + full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def call_with_retry(fn, *args, max_retries=MAX_RETRIES, sleep=time.sleep):
+    """fn(*args) を実行し、リトライ対象のエラーならバックオフして再試行する
+
+    (戻り値, リトライ回数) を返す。リトライ対象外のエラーや回数超過はそのまま送出する。
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn(*args), attempt
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt)
+            retry_after = _retry_after(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            sleep(delay)
+            attempt += 1
@@ -0,0 +1,290 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from metrics import metrics
+
+# 関連する会話のグラフの保存先
+RELATED_PATH = "./chroma_db/related.sqlite"
+
+# 1つの会話に持っておく関連する会話の数（k近傍）
+RELATED_K = 5
+
+# 表示する関連の下限（会話ベクトルのコサイン類似度）。保存はせず読むときに絞るので、変えても作り直し不要
+RELATED_MIN_SCORE = 0.3
+
+# 類似度行列を何行ずつ計算するか（BLOCK_ROWS × 会話数 の float32 をメモリに置く）
+BLOCK_ROWS = 512
+
+# ChromaDBから1回に読むチャンク数（作り直し）と会話数（where={'chat_id': {'$in': ...}}）
+GET_BATCH_SIZE = 1000
+CHAT_BATCH_SIZE = 100
+
+
+def add_chunks(totals, ids, embeddings, metadatas):
+    """チャンクのEmbeddingを単位ベクトルにして、会話ごとの合計 totals {chat_id: [タイトル, 合計]} に足す"""
+    if not len(ids):
+        return totals
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    chat_ids = [(metadata or {}).get('chat_id', record_id) for record_id, metadata in zip(ids, metadatas)]
+    unique_ids, first, inverse = np.unique(chat_ids, return_index=True, return_inverse=True)
+    sums = np.zeros((len(unique_ids), matrix.shape[1]), dtype=np.float32)
+    np.add.at(sums, inverse, matrix)
+    for row, chat_id in enumerate(unique_ids.tolist()):
+        entry = totals.get(chat_id)
+        if entry is None:
+            totals[chat_id] = [(metadatas[first[row]] or {}).get('title') or '', sums[row]]
+        else:
+            entry[1] = entry[1] + sums[row]
+    return totals
+
+
+def conversation_vectors(totals):
+    """add_chunks の合計を単位ベクトルにする（会話ベクトル＝チャンクの単位ベクトルの平均の向き）
+
+    {chat_id: (タイトル, ベクトル)} を返す。
+    """
+    vectors = {}
+    for chat_id, (title, total) in totals.items():
+        norm = np.linalg.norm(total)
+        vectors[chat_id] = (title, (total / norm if norm > 0 else total).astype(np.float32))
+    return vectors
+
+
+def top_k(scores, k):
+    """各行の上位 k 件の (列の添字, スコア)。スコアの高い順（同点は列の添字の順）"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64), np.empty((len(scores), 0), dtype=np.float32)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part.sort(axis=1)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+class RelatedIndex:
+    """会話どうしのk近傍グラフ（関連する会話）をSQLiteに保存する
+
+    会話ベクトル（チャンクのEmbeddingの平均）もここに持つので、追加のときにEmbedding APIもChromaDBも呼ばない。
+    インポートのあとに update() で変わった会話の分だけ更新し（ベクトルは書き込んだEmbeddingから作る）、
+    検索結果の表示では related() でページの会話の分を1回で読む。複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, path=RELATED_PATH, k=RELATED_K):
+        self.path = path
+        self.k = k
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                chat_id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                vector BLOB NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS neighbors (
+                chat_id TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                neighbor_id TEXT NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (chat_id, rank)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS neighbors_neighbor ON neighbors (neighbor_id);
+        """)
+        self._conn.commit()
+
+    # --- 内部 ---
+
+    def _load_vectors(self):
+        rows = self._conn.execute("SELECT chat_id, vector FROM vectors ORDER BY chat_id").fetchall()
+        if not rows:
+            return [], None
+        matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        return [chat_id for chat_id, _ in rows], matrix
+
+    def _select_in(self, sql, values, params=()):
+        # IN (...) の値が多いときは500件ずつに分ける（params はそのあとに続くプレースホルダの値）
+        values = list(values)
+        for start in range(0, len(values), 500):
+            part = values[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            yield from self._conn.execute(sql.format(placeholders=placeholders), part + list(params))
+
+    def _delete_in(self, table, column, values):
+        values = list(values)
+        for start in range(0, len(values), 500):
+            part = values[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            self._conn.execute(f"DELETE FROM {table} WHERE {column} IN ({placeholders})", part)
+
+    def _write_neighbors(self, lists):
+        """{chat_id: [(neighbor_id, score)]} で近傍を置き換える"""
+        self._delete_in('neighbors', 'chat_id', lists)
+        self._conn.executemany(
+            "INSERT INTO neighbors (chat_id, rank, neighbor_id, score) VALUES (?, ?, ?, ?)",
+            [(chat_id, rank, neighbor_id, score)
+             for chat_id, neighbors in lists.items() for rank, (neighbor_id, score) in enumerate(neighbors)],
+        )
+
+    def _recompute(self, ids, matrix, rows):
+        """rows（matrix の行の添字）の近傍を、全会話との類似度から計算し直す（BLOCK_ROWS 行ずつ）"""
+        lists = {}
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            scores = matrix[block] @ matrix.T
+            # 自分自身は関連に入れない
+            scores[np.arange(len(block)), block] = -np.inf
+            columns, values = top_k(scores, self.k)
+            for row, cols, vals in zip(block, columns, values):
+                neighbors = [(ids[col], round(float(val), 4)) for col, val in zip(cols, vals) if np.isfinite(val)]
+                # _merge と同じ順（丸めたスコアの高い順、同点は会話IDの順）
+                lists[ids[row]] = sorted(neighbors, key=lambda item: (-item[1], item[0]))
+        return lists
+
+    def _merge(self, ids, matrix, rows, candidates):
+        """rows の近傍に、新しく入った candidates（matrix の行の添字）のうち今の k 番目より近いものを加える"""
+        current = {}
+        for chat_id, neighbor_id, score in self._select_in(
+            "SELECT chat_id, neighbor_id, score FROM neighbors WHERE chat_id IN ({placeholders}) ORDER BY chat_id, rank",
+            [ids[row] for row in rows],
+        ):
+            current.setdefault(chat_id, []).append((neighbor_id, score))
+        kth = np.array([
+            current[ids[row]][-1][1] if len(current.get(ids[row], ())) >= self.k else -np.inf for row in rows
+        ], dtype=np.float32)
+        rows = np.asarray(rows, dtype=np.int64)
+        candidate_matrix = matrix[candidates]
+        lists = {}
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            scores = matrix[block] @ candidate_matrix.T
+            # 今の k 番目より近い候補がない会話はそのまま（ほとんどの会話はここで終わる）
+            for offset in np.flatnonzero((scores > kth[start:start + len(block), None]).any(axis=1)):
+                chat_id = ids[block[offset]]
+                merged = dict(current.get(chat_id, ()))
+                for col, score in zip(candidates, scores[offset]):
+                    merged[ids[col]] = round(float(score), 4)
+                lists[chat_id] = sorted(merged.items(), key=lambda item: (-item[1], item[0]))[:self.k]
+        return lists
+
+    # --- 公開 ---
+
+    def missing(self, chat_ids):
+        """chat_ids のうち、まだグラフにない会話ID"""
+        chat_ids = list(dict.fromkeys(chat_ids))
+        with self._lock:
+            present = {chat_id for (chat_id,) in self._select_in(
+                "SELECT chat_id FROM vectors WHERE chat_id IN ({placeholders})", chat_ids
+            )}
+        return [chat_id for chat_id in chat_ids if chat_id not in present]
+
+    def vectors_from_collection(self, collection, chat_ids):
+        """chat_ids の会話ベクトルを、ChromaDBに保存済みのEmbeddingから作る（中断したインポートの分を補うとき用）"""
+        chat_ids = list(dict.fromkeys(chat_ids))
+        totals = {}
+        for start in range(0, len(chat_ids), CHAT_BATCH_SIZE):
+            part = chat_ids[start:start + CHAT_BATCH_SIZE]
+            with metrics.timer('chroma_get'):
+                records = collection.get(where={'chat_id': {'$in': part}}, include=['embeddings', 'metadatas'])
+            add_chunks(totals, records['ids'], records['embeddings'], records['metadatas'])
+        return conversation_vectors(totals)
+
+    def update(self, vectors, removed=()):
+        """追加・更新した会話のベクトル vectors {chat_id: (タイトル, ベクトル)} と、削除した会話 removed をグラフに反映する
+
+        追加・更新した会話と、近傍にそれらや削除した会話を含んでいた会話は全会話と比べ直し、
+        ほかの会話には新しい会話が今の k 番目より近いときだけ加える。
+        """
+        gone = set(removed) - set(vectors)
+        with self._lock:
+            dimension = self._conn.execute("SELECT length(vector) FROM vectors LIMIT 1").fetchone()
+            if dimension and vectors and dimension[0] != next(iter(vectors.values()))[1].nbytes:
+                # Embeddingの次元が変わった（モデルを変えて入れ直した）ら、保存済みのベクトルは比べられない
+                self._conn.execute("DELETE FROM vectors")
+                self._conn.execute("DELETE FROM neighbors")
+            touched = gone | set(vectors)
+            stale = {chat_id for (chat_id,) in self._select_in(
+                "SELECT DISTINCT chat_id FROM neighbors WHERE neighbor_id IN ({placeholders})", touched
+            )}
+            self._delete_in('vectors', 'chat_id', gone)
+            self._delete_in('neighbors', 'chat_id', gone)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (chat_id, title, vector) VALUES (?, ?, ?)",
+                [(chat_id, title, vector.tobytes()) for chat_id, (title, vector) in vectors.items()],
+            )
+            ids, matrix = self._load_vectors()
+            if matrix is not None:
+                position = {chat_id: row for row, chat_id in enumerate(ids)}
+                recompute = sorted(position[chat_id] for chat_id in (stale - gone) | set(vectors))
+                lists = self._recompute(ids, matrix, recompute)
+                if vectors:
+                    skip = set(recompute)
+                    rest = [row for row in range(len(ids)) if row not in skip]
+                    lists.update(self._merge(ids, matrix, rest, sorted(position[chat_id] for chat_id in vectors)))
+                self._write_neighbors(lists)
+            self._conn.commit()
+
+    def rebuild_from_collection(self, collection, batch_size=GET_BATCH_SIZE):
+        """ChromaDBに保存済みのEmbeddingから作り直す（導入前のデータ用）
+
+        チャンクは会話ごとに続いて保存されているとは限らないので、会話ごとの合計を全ページ分足してから比べる。
+        """
+        totals = {}
+        offset = 0
+        while True:
+            with metrics.timer('chroma_get'):
+                page = collection.get(include=['embeddings', 'metadatas'], limit=batch_size, offset=offset)
+            add_chunks(totals, page['ids'], page['embeddings'], page['metadatas'])
+            if len(page['ids']) < batch_size:
+                break
+            offset += len(page['ids'])
+        vectors = conversation_vectors(totals)
+        with self._lock:
+            self._conn.execute("DELETE FROM vectors")
+            self._conn.execute("DELETE FROM neighbors")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (chat_id, title, vector) VALUES (?, ?, ?)",
+                [(chat_id, title, vector.tobytes()) for chat_id, (title, vector) in vectors.items()],
+            )
+            ids, matrix = self._load_vectors()
+            if matrix is not None:
+                self._write_neighbors(self._recompute(ids, matrix, list(range(len(ids)))))
+            self._conn.commit()
+
+    def related(self, chat_ids, min_score=RELATED_MIN_SCORE):
+        """chat_ids それぞれの関連する会話 {chat_id: [(会話ID, タイトル, 類似度)]}（近い順。なければ入れない）"""
+        result = {}
+        with self._lock:
+            for chat_id, neighbor_id, title, score in self._select_in(
+                "SELECT n.chat_id, n.neighbor_id, v.title, n.score FROM neighbors n "
+                "JOIN vectors v ON v.chat_id = n.neighbor_id "
+                "WHERE n.chat_id IN ({placeholders}) AND n.score >= ? ORDER BY n.chat_id, n.rank",
+                dict.fromkeys(chat_ids), (min_score,),
+            ):
+                result.setdefault(chat_id, []).append((neighbor_id, title, score))
+        return result
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM vectors")
+            self._conn.execute("DELETE FROM neighbors")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            conversations, edges = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM vectors), (SELECT COUNT(*) FROM neighbors)"
+            ).fetchone()
+        return {'conversations': conversations, 'edges': edges}
@@ -0,0 +1,132 @@
+import numpy as np
+
+from metrics import metrics
+
+# 並べ替える候補の会話数（上位この件数の中で順位を入れ替え、それより下は元の順のまま）
+# search.RANK_DEPTH_STEP と同じにして、1ページ目のために余分なチャンクを取らないようにする
+# （ChromaDBのqueryは取る件数に比例して遅くなる。100件にするとqueryの時間がほぼ倍になる）
+RERANK_CANDIDATES = 50
+
+# 既定の多様性（アプリ・CLIの初期値）と新しさの強さ
+DEFAULT_DIVERSITY = 0.3
+DEFAULT_RECENCY = 0.0
+
+# 新しさのブーストの半減期（候補の中で一番新しい会話からの日数）
+RECENCY_HALF_LIFE_DAYS = 90
+
+SECONDS_PER_DAY = 86400
+
+
+def make_rerank(diversity=0.0, recency=0.0):
+    """並べ替えの設定（0のものは入れない。どちらも0なら空＝並べ替えない）
+
+    diversity: MMRで似た会話を後ろに回す強さ（0〜1。1 - λ）
+    recency: 新しい会話を前に出す強さ（0〜1。関連度との重み付き平均）
+    """
+    options = {}
+    if diversity:
+        options['diversity'] = float(diversity)
+    if recency:
+        options['recency'] = float(recency)
+    return options
+
+
+def relevance_scores(hits):
+    """ヒットの関連度を0〜1に揃える（ベクトルは類似度、キーワード・ハイブリッドはスコアを最小-最大で正規化）"""
+    values = np.array([
+        hit['score'] if hit.get('score') is not None else (hit.get('similarity') or 0.0)
+        for hit in hits
+    ], dtype=np.float64)
+    low, high = values.min(), values.max()
+    if high - low <= 0:
+        return np.ones(len(values))
+    return (values - low) / (high - low)
+
+
+def recency_scores(hits, half_life_days=RECENCY_HALF_LIFE_DAYS):
+    """作成日時の新しさ（候補の中で一番新しい会話が1、半減期ごとに半分。日時がなければ0）
+
+    基準を現在時刻ではなく候補の中の最新にするので、同じ候補なら同じ結果になる（検索結果キャッシュと矛盾しない）。
+    """
+    ts = np.array([hit.get('created_ts') or np.nan for hit in hits], dtype=np.float64)
+    if np.all(np.isnan(ts)):
+        return np.zeros(len(hits))
+    age_days = (np.nanmax(ts) - ts) / SECONDS_PER_DAY
+    return np.nan_to_num(np.exp2(-age_days / half_life_days), nan=0.0)
+
+
+def mmr_order(relevance, embeddings, diversity):
+    """Maximal Marginal Relevance で選ぶ順番（候補の添字）を返す
+
+    各ステップで λ·関連度 − (1−λ)·(選んだものとの最大コサイン類似度) が最大の候補を選ぶ（λ = 1 − diversity）。
+    候補どうしの類似度は最初に行列積1回で求め、各ステップはベクトル演算だけで更新する。
+    同点は元の順位が上の候補を選ぶ。
+    """
+    n = len(relevance)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    unit = embeddings / norms
+    similarity = unit @ unit.T
+    weight = 1.0 - diversity
+    max_similarity = np.zeros(n)
+    available = np.ones(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    for step in range(n):
+        scores = weight * relevance - diversity * max_similarity
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        order[step] = pick
+        available[pick] = False
+        np.maximum(max_similarity, similarity[pick], out=max_similarity)
+    return order
+
+
+def embeddings_by_id(collection, chunk_ids):
+    """チャンクID -> Embedding（ChromaDBから1回で取る。同じIDは1回だけ）"""
+    ids = list(dict.fromkeys(chunk_ids))
+    if not ids:
+        return {}
+    with metrics.timer('chroma_get'):
+        records = collection.get(ids=ids, include=['embeddings'])
+    return dict(zip(records['ids'], records['embeddings']))
+
+
+def fetch_embeddings(collection, hits, known=None):
+    """代表チャンクのEmbedding（ヒットの順。見つからなければゼロベクトル）
+
+    known（embeddings_by_id で先にまとめて取ったもの）を渡すと、ChromaDBには取りに行かない。
+    """
+    ids = [hit['chunk_id'] for hit in hits]
+    by_id = known if known is not None else embeddings_by_id(collection, ids)
+    dimension = next((len(by_id[i]) for i in ids if by_id.get(i) is not None), 1)
+    matrix = np.zeros((len(ids), dimension), dtype=np.float32)
+    for row, chunk_id in enumerate(ids):
+        embedding = by_id.get(chunk_id)
+        if embedding is not None:
+            matrix[row] = embedding
+    return matrix
+
+
+def rerank(collection, ranked, options, candidates=RERANK_CANDIDATES, known=None):
+    """上位 candidates 件の会話を、新しさのブーストとMMRで並べ替える（それより下は元の順のまま）
+
+    options は make_rerank の辞書。並べ替えたヒットには rerank_score（ブースト後の関連度）を付ける。
+    known は fetch_embeddings に渡す（複数のクエリの分をまとめて取ったEmbedding）。
+    """
+    if not options or len(ranked) < 2:
+        return ranked
+    head, tail = ranked[:candidates], ranked[candidates:]
+    diversity = options.get('diversity', 0.0)
+    recency = options.get('recency', 0.0)
+    embeddings = fetch_embeddings(collection, head, known) if diversity else None
+    with metrics.timer('rerank'):
+        relevance = relevance_scores(head)
+        if recency:
+            relevance = (1.0 - recency) * relevance + recency * recency_scores(head)
+        if diversity:
+            order = mmr_order(relevance, embeddings, diversity)
+        else:
+            # 安定ソート：同点は元の順位のまま
+            order = np.argsort(-relevance, kind='stable')
+        reranked = [dict(head[i], rerank_score=round(float(relevance[i]), 4)) for i in order]
+    return reranked + tail
@@ -0,0 +1,330 @@
+from filters import NoMatch, build_where
+from ingest import GET_BATCH_SIZE
+from metrics import metrics
+from ratelimit import call_with_retry
+from rerank import RERANK_CANDIDATES, embeddings_by_id, rerank as rerank_hits
+
+# 1会話から複数チャンクがヒットするので、表示件数の何倍のチャンクを取ってくるか
+CHUNK_OVERFETCH = 4
+
+# 2ページ目以降・並べ替えるときに順位を付けておく会話数の刻み（この単位で深く取り直す）
+# 並べ替えない1ページ目は表示する分だけ取る（上位数件のためにチャンクを数百件取らない）
+RANK_DEPTH_STEP = 50
+
+# Reciprocal Rank Fusion の定数（大きいほど下位の順位も効く）
+RRF_K = 60
+
+# search_batch で1回にまとめるクエリ数の上限（EmbeddingのAPIの1リクエストあたりの入力数より小さく）
+MAX_BATCH_QUERIES = 256
+
+# クエリのEmbeddingが429/5xxで失敗したときのリトライ回数（検索は待たせられないので少なめ。Retry-Afterがなければ待つのは最大で約3秒）
+QUERY_EMBED_RETRIES = 2
+
+# 検索モード
+MODE_HYBRID = 'hybrid'
+MODE_VECTOR = 'vector'
+MODE_KEYWORD = 'keyword'
+
+
+def group_by_conversation(chunks, n_results=None):
+    """チャンク単位のヒット（良い順）を会話単位にまとめる。一番良いチャンクを代表にする
+
+    chunks は {'id', 'document', 'metadata', 'distance', 'score'} のリスト（document はなくてもよい）。
+    """
+    hits = {}
+    for chunk in chunks:
+        metadata = chunk['metadata'] or {}
+        chat_id = metadata.get('chat_id', chunk['id'])
+        hit = hits.get(chat_id)
+        if hit is not None:
+            hit['matched_chunks'] += 1
+            continue
+        distance = chunk.get('distance')
+        hits[chat_id] = {
+            'chat_id': chat_id,
+            'title': metadata.get('title', '(無題)'),
+            'created_at': metadata.get('created_at', ''),
+            'created_ts': metadata.get('created_ts'),
+            'message_count': metadata.get('message_count'),
+            'distance': distance,
+            'similarity': 1 - distance if distance is not None else None,
+            'score': chunk.get('score'),
+            'chunk_id': chunk['id'],
+            'document': chunk.get('document'),
+            'chunk_index': metadata.get('chunk_index'),
+            'chunk_count': metadata.get('chunk_count'),
+            'msg_start': metadata.get('msg_start'),
+            'msg_end': metadata.get('msg_end'),
+            'matched_chunks': 1,
+        }
+    ranked = list(hits.values())
+    return ranked[:n_results] if n_results is not None else ranked
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """会話単位の複数のランキングをRRFで1つにまとめる（先に渡したランキングの代表チャンクを優先）"""
+    fused = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking):
+            entry = fused.get(hit['chat_id'])
+            if entry is None:
+                entry = fused[hit['chat_id']] = dict(hit, score=0.0)
+            else:
+                entry['matched_chunks'] = max(entry['matched_chunks'], hit['matched_chunks'])
+            entry['score'] += 1 / (k + rank + 1)
+    return sorted(fused.values(), key=lambda h: (-h['score'], h['chat_id']))
+
+
+def collapse_duplicates(ranked, duplicate_index):
+    """近い重複のまとまり（dedup.DuplicateIndex）を、一番順位の高い1件にまとめる
+
+    残したヒットには similar（同じまとまりのほかの会話の [(会話ID, タイトル)]）を付ける。
+    """
+    if duplicate_index is None or not ranked:
+        return ranked
+    with metrics.timer('collapse_duplicates'):
+        canonical, members = duplicate_index.clusters(hit['chat_id'] for hit in ranked)
+        collapsed = []
+        shown = set()
+        for hit in ranked:
+            head = canonical.get(hit['chat_id'])
+            if head is None:
+                collapsed.append(hit)
+                continue
+            if head in shown:
+                continue
+            shown.add(head)
+            similar = [(chat_id, title) for chat_id, title in members[head] if chat_id != hit['chat_id']]
+            collapsed.append(dict(hit, similar=similar))
+    return collapsed
+
+
+def vector_chunks(collection, embed_fn, queries, n_chunks, where=None, vector_index=None, chat_ids=None):
+    """複数のクエリをまとめてベクトル化し、チャンクを距離の近い順に取ってくる（where で絞り込みはChromaDB側で行う）
+
+    Embeddingはリクエスト1回、ChromaDBの query も複数ベクトルで1回だけ呼ぶ。
+    vector_index(flat_index.FlatIndex) を渡すと、ChromaDBのHNSWの代わりにそちらで総当たりする
+    （where に当てはまる会話 chat_ids を渡す。なければここでChromaDBで絞る）。
+    本文は取らない（表示するページの分だけ fetch_documents で取る）。
+    クエリごとの (チャンクのリスト, 生の結果) のリストを返す。
+    """
+    with metrics.timer('embed_query'):
+        # OpenAIクライアントの自動リトライは切ってあるので、ここでバックオフして再試行する
+        query_embeddings, _ = call_with_retry(embed_fn, queries, max_retries=QUERY_EMBED_RETRIES)
+    if vector_index is not None:
+        if chat_ids is None and where:
+            chat_ids = filtered_chat_ids(collection, where)
+        with metrics.timer('flat_query'):
+            results = vector_index.query(query_embeddings, n_chunks, chat_ids=chat_ids)
+    else:
+        with metrics.timer('chroma_query'):
+            results = collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_chunks,
+                where=where,
+                include=['metadatas', 'distances'],
+            )
+    batch = []
+    for ids, metadatas, distances in zip(results['ids'], results['metadatas'], results['distances']):
+        chunks = [
+            {'id': record_id, 'metadata': metadata, 'distance': distance, 'score': None}
+            for record_id, metadata, distance in zip(ids, metadatas, distances)
+        ]
+        # 距離が同じならIDの順にしてページをまたいでも順位が変わらないようにする
+        chunks.sort(key=lambda c: (c['distance'], c['id']))
+        batch.append((chunks, {'ids': [ids], 'metadatas': [metadatas], 'distances': [distances]}))
+    return batch
+
+
+def filtered_chat_ids(collection, where, batch_size=GET_BATCH_SIZE):
+    """where に当てはまる会話IDの集合（レコードIDは "{chat_id}#{チャンク番号}"）"""
+    chat_ids = set()
+    offset = 0
+    while True:
+        with metrics.timer('chroma_filter'):
+            page = collection.get(where=where, include=[], limit=batch_size, offset=offset)
+        chat_ids.update(record_id.rsplit('#', 1)[0] for record_id in page['ids'])
+        if len(page['ids']) < batch_size:
+            return chat_ids
+        offset += len(page['ids'])
+
+
+def keyword_chunks(collection, keyword_index, queries, n_chunks, chat_ids=None):
+    """クエリごとにBM25でチャンクを取ってくる（Embedding APIは呼ばない）
+
+    chat_ids（where に当てはまる会話）を渡すと、その会話だけにBM25をかける。
+    チャンクのメタデータはBM25インデックスから取る（持っていない分だけ、全クエリの分をChromaDBから1回で取る）。
+    クエリごとの (チャンクのリスト, 生の結果) のリストを返す。
+    """
+    empty = ([], {'ids': [], 'scores': []})
+    if chat_ids is not None and not chat_ids:
+        return [empty for _ in queries]
+    with metrics.timer('keyword_search'):
+        rankings = [keyword_index.search(query, n_chunks, chat_ids=chat_ids) for query in queries]
+    ids = list(dict.fromkeys(doc_id for ranked in rankings for doc_id, _, _ in ranked))
+    if not ids:
+        return [empty for _ in queries]
+    with metrics.timer('keyword_metadata'):
+        by_id = keyword_index.metadatas(ids)
+    missing = [doc_id for doc_id in ids if doc_id not in by_id]
+    if missing:
+        with metrics.timer('chroma_get'):
+            records = collection.get(ids=missing, include=['metadatas'])
+        by_id.update(zip(records['ids'], records['metadatas']))
+    batch = []
+    for ranked in rankings:
+        chunks = [
+            {'id': doc_id, 'metadata': by_id[doc_id], 'distance': None, 'score': score}
+            for doc_id, _, score in ranked
+            if doc_id in by_id
+        ]
+        batch.append((chunks, {'ids': [doc_id for doc_id, _, _ in ranked], 'scores': [score for _, _, score in ranked]}))
+    return batch
+
+
+def rank_depth(offset, limit, rerank=None):
+    """offset から limit 件を表示するのに順位を付けておく会話数（次のページがあるか分かるよう1件多く）
+
+    並べ替えない1ページ目はそのまま、2ページ目以降と並べ替えるときは刻みで切り上げる
+    （ページ送りで少しずつ深くなるたびに検索し直さないように）。
+    """
+    needed = offset + limit + 1
+    if offset == 0 and not rerank:
+        return needed
+    return -(-needed // RANK_DEPTH_STEP) * RANK_DEPTH_STEP
+
+
+def rank_conversations(collection, embed_fn, query, depth, mode=MODE_VECTOR, keyword_index=None,
+                       filters=None, catalog=None, duplicates=None, rerank=None, vector_index=None):
+    """上位 depth 件までの会話の順位を付ける（本文は取らない）
+
+    同じ条件なら何度呼んでも同じ順位になる（同点は会話ID/チャンクIDの順）。
+    duplicates(dedup.DuplicateIndex) を渡すと、近い重複は1件にまとめる（collapse_duplicates）。
+    rerank（rerank.make_rerank の辞書）を渡すと、上位 RERANK_CANDIDATES 件をMMR・新しさで並べ替える。
+    並べ替える範囲は depth によらず同じなので、ページ送りしても順位は変わらない。
+    vector_index(flat_index.FlatIndex) を渡すと、ベクトル検索はHNSWではなくそちらで行う。
+    (会話単位のヒットのリスト, デバッグ用の生の結果) を返す。
+    """
+    return rank_conversations_batch(collection, embed_fn, [query], depth, mode, keyword_index, filters, catalog,
+                                    duplicates, rerank, vector_index)[0]
+
+
+def rank_conversations_batch(collection, embed_fn, queries, depth, mode=MODE_VECTOR, keyword_index=None,
+                             filters=None, catalog=None, duplicates=None, rerank=None, vector_index=None):
+    """複数のクエリの順位をまとめて付ける（クエリごとの rank_conversations の結果のリスト）
+
+    クエリの数によらず、Embeddingのリクエスト・ChromaDBの query・絞り込み・チャンクの取得はそれぞれ1回。
+    """
+    queries = list(queries)
+    if not queries:
+        return []
+    # 並べ替えるときは、depth が小さくても候補を RERANK_CANDIDATES 件は取る
+    n_chunks = (max(depth, RERANK_CANDIDATES) if rerank else depth) * CHUNK_OVERFETCH
+    if mode != MODE_VECTOR and keyword_index is None:
+        raise ValueError("キーワード検索にはkeyword_indexが必要です")
+    try:
+        where = build_where(filters, catalog, collection)
+    except NoMatch:
+        return [([], {'where': None}) for _ in queries]
+
+    # where に当てはまる会話（BM25と総当たりの索引で使う。HNSWはChromaDBが where で絞る）
+    chat_ids = None
+    if where and (mode != MODE_VECTOR or vector_index is not None):
+        chat_ids = filtered_chat_ids(collection, where)
+    vector = None
+    if mode != MODE_KEYWORD:
+        vector = vector_chunks(collection, embed_fn, queries, n_chunks, where, vector_index, chat_ids)
+    keyword = None
+    if mode != MODE_VECTOR:
+        keyword = keyword_chunks(collection, keyword_index, queries, n_chunks, chat_ids)
+
+    fused = []
+    raws = []
+    for i in range(len(queries)):
+        if mode == MODE_KEYWORD:
+            chunks, kw_raw = keyword[i]
+            fused.append(group_by_conversation(chunks))
+            raws.append({'keyword': kw_raw, 'where': where})
+        elif mode == MODE_VECTOR:
+            chunks, raw = vector[i]
+            fused.append(group_by_conversation(chunks))
+            raws.append({'vector': raw, 'where': where})
+        else:
+            (chunks, raw), (kw_chunks, kw_raw) = vector[i], keyword[i]
+            fused.append(reciprocal_rank_fusion(group_by_conversation(chunks), group_by_conversation(kw_chunks)))
+            raws.append({'vector': raw, 'keyword': kw_raw, 'where': where})
+    collapsed = [collapse_duplicates(ranked, duplicates) for ranked in fused]
+    # MMRに使う代表チャンクのEmbeddingは、全クエリの候補の分を1回で取る
+    known = None
+    if rerank and rerank.get('diversity'):
+        known = embeddings_by_id(collection, [hit['chunk_id'] for ranked in collapsed for hit in ranked[:RERANK_CANDIDATES]])
+    return [
+        (rerank_hits(collection, ranked, rerank, known=known)[:depth], raw)
+        for ranked, raw in zip(collapsed, raws)
+    ]
+
+
+def fetch_documents(collection, hits):
+    """表示するヒットの代表チャンクの本文だけを取ってくる（元のヒットは書き換えずにコピーを返す）"""
+    if not hits:
+        return []
+    with metrics.timer('chroma_get'):
+        records = collection.get(ids=list(dict.fromkeys(hit['chunk_id'] for hit in hits)), include=['documents'])
+    documents = dict(zip(records['ids'], records['documents']))
+    return [dict(hit, document=documents.get(hit['chunk_id']) or '') for hit in hits]
+
+
+def attach_related(hits, related_index):
+    """ヒットに related（関連する会話の [(会話ID, タイトル, 類似度)]）を付ける（元のヒットは書き換えずにコピーを返す）
+
+    インポートのときに作っておいたグラフ（related.RelatedIndex）をページ分まとめて1回読むだけで、
+    Embeddingも検索もしない。similar（近い重複）に出ている会話は除く。
+    """
+    if not hits or related_index is None:
+        return hits
+    with metrics.timer('related_get'):
+        related = related_index.related(hit['chat_id'] for hit in hits)
+    attached = []
+    for hit in hits:
+        shown = {hit['chat_id']} | {chat_id for chat_id, _ in hit.get('similar') or ()}
+        attached.append(dict(hit, related=[item for item in related.get(hit['chat_id'], ()) if item[0] not in shown]))
+    return attached
+
+
+def search(collection, embed_fn, query, n_results=5, mode=MODE_VECTOR, keyword_index=None,
+           filters=None, catalog=None, offset=0, duplicates=None, rerank=None, vector_index=None):
+    """会話単位の検索結果を返す
+
+    mode は 'vector'（ベクトルのみ）/ 'keyword'（BM25のみ、API呼び出しなし）/ 'hybrid'（RRFで融合）。
+    filters（filters.make_filters の辞書）で日付・タイトル・メッセージ数を絞り込む。
+    タイトルで絞り込むときは catalog(filters.TitleCatalog) が必要。
+    duplicates(dedup.DuplicateIndex) を渡すと、近い重複は1件にまとめて similar を付ける。
+    rerank（rerank.make_rerank の辞書）で似た会話を後ろに回し（MMR）、新しい会話を前に出す。
+    vector_index(flat_index.FlatIndex) を渡すと、ベクトル検索はHNSWではなくそちらで行う。
+    offset 件目から n_results 件を本文付きで返す。
+    (会話単位のヒットのリスト, デバッグ用の生の結果) を返す。
+    """
+    ranked, raw = rank_conversations(collection, embed_fn, query, rank_depth(offset, n_results, rerank), mode,
+                                     keyword_index, filters, catalog, duplicates, rerank, vector_index)
+    return fetch_documents(collection, ranked[offset:offset + n_results]), raw
+
+
+def search_batch(collection, embed_fn, queries, n_results=5, mode=MODE_VECTOR, keyword_index=None,
+                 filters=None, catalog=None, duplicates=None, rerank=None, vector_index=None):
+    """複数のクエリで検索して、クエリごとの上位 n_results 件（本文付き）のリストを返す
+
+    条件は search と同じ。MAX_BATCH_QUERIES 件ずつ、Embeddingのリクエスト・ChromaDBの query・本文の取得を
+    1回にまとめる（N件のクエリでも往復はクエリ数によらない）。評価用のクエリ集や、会話ごとの関連検索向け。
+    """
+    queries = list(queries)
+    results = []
+    for start in range(0, len(queries), MAX_BATCH_QUERIES):
+        part = queries[start:start + MAX_BATCH_QUERIES]
+        ranked = rank_conversations_batch(collection, embed_fn, part, rank_depth(0, n_results, rerank), mode, keyword_index,
+                                          filters, catalog, duplicates, rerank, vector_index)
+        pages = [hits[:n_results] for hits, _ in ranked]
+        documents = fetch_documents(collection, [hit for page in pages for hit in page])
+        for page in pages:
+            results.append(documents[:len(page)])
+            documents = documents[len(page):]
+    return results
@@ -0,0 +1,289 @@
+"""検索・まとめて検索・会話の全文・インポートのHTTP API（ほかのプログラム・エージェントから使う）
+
+    pip install fastapi uvicorn
+    python server.py --port 8765
+
+設定は cli.py と同じ（環境変数か .streamlit/secrets.toml）。プロセスの間、コレクション・索引・Embedderの
+クライアントを開いたままにするので、2回目以降の検索はStreamlitのセッションを作るより安い。
+"""
+import argparse
+import os
+import shutil
+import sys
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import List, Optional
+
+try:
+    import uvicorn
+    from fastapi import Depends, FastAPI, HTTPException, Request
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import PlainTextResponse
+    from pydantic import BaseModel, Field
+except ImportError:
+    raise RuntimeError("HTTP APIには fastapi と uvicorn が必要です（pip install fastapi uvicorn）")
+
+from cli import load_api_key, load_setting
+from embedders import BACKEND_OPENAI
+from filters import make_filters
+from flat_index import DTYPE_INT8
+from formats import iter_conversations
+from ingest import run_import
+from jobs import JobManager
+from journal import fingerprint
+from metrics import JsonLinesLog, metrics, trace
+from query_cache import make_key
+from rerank import DEFAULT_DIVERSITY, DEFAULT_RECENCY, make_rerank
+from search import (MAX_BATCH_QUERIES, MODE_HYBRID, MODE_KEYWORD, MODE_VECTOR, attach_related, fetch_documents,
+                    rank_conversations, rank_depth, search_batch)
+from store import VECTOR_ENGINE_CHROMA, EmbedderMismatch, bind_embedder, load_full_text, make_embedder
+from tenants import DEFAULT_MEMORY_BUDGET_MB, DEFAULT_TENANT, MAX_OPEN_TENANTS, TenantPool, tenant_id
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# 1回の検索で返せる会話数の上限
+MAX_RESULTS = 100
+
+# アップロードを書き出す単位
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+SEARCH_MODES = (MODE_HYBRID, MODE_VECTOR, MODE_KEYWORD)
+
+
+class SearchOptions(BaseModel):
+    n: int = Field(5, ge=1, le=MAX_RESULTS)
+    mode: str = MODE_HYBRID
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    title: Optional[str] = None
+    min_messages: Optional[int] = None
+    max_messages: Optional[int] = None
+    diversity: float = Field(DEFAULT_DIVERSITY, ge=0.0, le=1.0)
+    recency: float = Field(DEFAULT_RECENCY, ge=0.0, le=1.0)
+
+
+class SearchRequest(SearchOptions):
+    query: str
+    offset: int = Field(0, ge=0)
+
+
+class BatchSearchRequest(SearchOptions):
+    queries: List[str] = Field(..., max_length=MAX_BATCH_QUERIES * 4)
+
+
+def warm_up(tenant):
+    """HNSW（または総当たりの索引）をメモリに読み込んでおく
+
+    Embedding APIは呼ばず、保存済みのベクトルを1本使って1回検索する。
+    """
+    sample = tenant.collection.get(limit=1, include=['embeddings'])
+    if not len(sample['ids']):
+        return
+    embedding = sample['embeddings'][0]
+    with metrics.timer('warm_up'):
+        if tenant.vector_index is not None:
+            tenant.vector_index.query([embedding], 1)
+        else:
+            tenant.collection.query(query_embeddings=[embedding], n_results=1, include=[])
+
+
+def job_to_dict(job):
+    return {
+        'job_id': job.id,
+        'name': job.name,
+        'status': job.status,
+        'processed': job.processed,
+        'total': job.total,
+        'elapsed_sec': round(job.elapsed, 3),
+        'error': job.error,
+        'result': job.result.to_dict() if job.result is not None else None,
+    }
+
+
+def create_app(pool, embed_fn, job_manager=None, tenant_header=None, metrics_log=None, warm=True):
+    """FastAPIのアプリを作る
+
+    pool(tenants.TenantPool) と embed_fn はプロセスに1つを全リクエストで共有する
+    （索引はメモリに載ったまま、EmbeddingのHTTPクライアントは接続を使い回す）。
+    tenant_header を指定すると、そのヘッダー（認証プロキシが付けるユーザー名）でユーザーごとのデータを使う。
+    ChromaDB・SQLiteの呼び出しはブロックするので、エンドポイントはスレッドプールで動かす
+    （インポートの受け取りだけはasyncで、ファイルの読み書きをスレッドプールに回す）。
+    """
+    job_manager = job_manager or JobManager()
+
+    @asynccontextmanager
+    async def lifespan(app):
+        # ユーザーを分けないときは、最初の検索を待たずに索引を読み込んでおく
+        if warm and not tenant_header:
+            warm_up(pool.get(DEFAULT_TENANT))
+        yield
+
+    app = FastAPI(title="Memory Layer", lifespan=lifespan)
+
+    def current_tenant(request: Request):
+        if not tenant_header:
+            return pool.get(DEFAULT_TENANT)
+        user = request.headers.get(tenant_header)
+        if not user:
+            raise HTTPException(401, f"{tenant_header} ヘッダーがありません")
+        return pool.get(tenant_id(user))
+
+    def check_options(tenant, options):
+        if options.mode not in SEARCH_MODES:
+            raise HTTPException(400, f"不明な検索モード: {options.mode}（{', '.join(SEARCH_MODES)}）")
+        if options.mode != MODE_KEYWORD:
+            try:
+                bind_embedder(tenant.meta, tenant.collection, embed_fn)
+            except EmbedderMismatch as e:
+                raise HTTPException(409, str(e))
+        filters = make_filters(options.date_from, options.date_to, options.title,
+                               options.min_messages, options.max_messages)
+        return filters, make_rerank(options.diversity, options.recency)
+
+    @app.get('/health')
+    def health():
+        return {'status': 'ok', 'tenants': pool.stats()}
+
+    @app.post('/search')
+    def search_endpoint(request: SearchRequest, tenant=Depends(current_tenant)):
+        """会話単位の検索（アプリと同じく、順位は検索結果キャッシュに載せてページ送りでは検索し直さない）"""
+        filters, rerank = check_options(tenant, request)
+        with trace('search', log=metrics_log) as current:
+            depth = rank_depth(request.offset, request.n, rerank)
+            cache_key = make_key(request.query, depth, request.mode, filters, tenant.meta.collection_version(), rerank)
+            (ranked, _), cache_hit = tenant.query_cache.get_or_compute(
+                cache_key,
+                lambda: rank_conversations(tenant.collection, embed_fn, request.query, depth, mode=request.mode,
+                                           keyword_index=tenant.keyword_index, filters=filters,
+                                           catalog=tenant.title_catalog, duplicates=tenant.duplicate_index,
+                                           rerank=rerank, vector_index=tenant.vector_index)
+            )
+            hits = attach_related(fetch_documents(tenant.collection, ranked[request.offset:request.offset + request.n]),
+                                  tenant.related_index)
+            current.attrs.update(mode=request.mode, cache_hit=cache_hit, offset=request.offset, results=len(hits))
+        return {
+            'results': hits,
+            'has_next': len(ranked) > request.offset + request.n,
+            'cache_hit': cache_hit,
+            'took_ms': round(current.total * 1000, 3),
+        }
+
+    @app.post('/search/batch')
+    def batch_search_endpoint(request: BatchSearchRequest, tenant=Depends(current_tenant)):
+        """クエリごとの上位 n 件（Embeddingのリクエストと検索はまとめて1回）"""
+        filters, rerank = check_options(tenant, request)
+        with trace('batch_search', log=metrics_log) as current:
+            results = search_batch(tenant.collection, embed_fn, request.queries, n_results=request.n,
+                                   mode=request.mode, keyword_index=tenant.keyword_index, filters=filters,
+                                   catalog=tenant.title_catalog, duplicates=tenant.duplicate_index,
+                                   rerank=rerank, vector_index=tenant.vector_index)
+            current.attrs.update(mode=request.mode, queries=len(request.queries))
+        return {
+            'results': [{'query': query, 'results': hits} for query, hits in zip(request.queries, results)],
+            'took_ms': round(current.total * 1000, 3),
+        }
+
+    @app.get('/conversations/{chat_id}')
+    def conversation_endpoint(chat_id: str, tenant=Depends(current_tenant)):
+        text = load_full_text(tenant.collection, tenant.document_store, chat_id)
+        if not text:
+            raise HTTPException(404, f"会話が見つかりません: {chat_id}")
+        return {'chat_id': chat_id, 'text': text}
+
+    @app.post('/import', status_code=202)
+    async def import_endpoint(request: Request, delete_missing: bool = True, name: str = "conversations.json",
+                              tenant=Depends(current_tenant)):
+        """リクエストの本文（エクスポートのJSON）をバックグラウンドでインポートする。進み具合は /jobs/{job_id}
+
+        ファイルの書き込みと指紋の計算はスレッドプールで行い、イベントループ（ほかの検索）を止めない。
+        二重投入の確認と投入はイベントループ上で続けて行い、ファイルの移動とジャーナルを開くのはジョブの中で行う。
+        """
+        await run_in_threadpool(os.makedirs, tenant.upload_dir, exist_ok=True)
+        temp_path = os.path.join(tenant.upload_dir, f"upload-{os.getpid()}-{id(request)}.part")
+        f = await run_in_threadpool(open, temp_path, 'wb')
+        try:
+            buffer = bytearray()
+            async for chunk in request.stream():
+                buffer += chunk
+                if len(buffer) >= UPLOAD_CHUNK_BYTES:
+                    await run_in_threadpool(f.write, bytes(buffer))
+                    buffer.clear()
+            await run_in_threadpool(f.write, bytes(buffer))
+        finally:
+            await run_in_threadpool(f.close)
+        job_key = await run_in_threadpool(file_fingerprint, temp_path)
+        if job_manager.find_active(job_key, owner=tenant.id) is not None:
+            await run_in_threadpool(os.remove, temp_path)
+            raise HTTPException(409, "同じファイルのインポートが実行中です")
+        job = job_manager.submit(name, lambda job: import_job(job, temp_path, job_key, name, delete_missing),
+                                 key=job_key, owner=tenant.id)
+        return job_to_dict(job)
+
+    def file_fingerprint(path):
+        with open(path, 'rb') as fp:
+            return fingerprint(fp)
+
+    def import_job(job, temp_path, job_key, name, delete_missing):
+        path = os.path.join(os.path.dirname(temp_path), f"{job_key}.json")
+        shutil.move(temp_path, path)
+        try:
+            with pool.lease(job.owner) as target, open(path, 'rb') as fp:
+                checkpoint = target.journal.open(job_key, name)
+                bind_embedder(target.meta, target.collection, embed_fn)
+                return run_import(iter_conversations(fp), target.collection, embed_fn,
+                                  on_progress=lambda done, total, stats: job.update(done, total, stats),
+                                  delete_missing=delete_missing,
+                                  keyword_index=target.keyword_index, on_write=target.meta.bump_version,
+                                  checkpoint=checkpoint, document_store=target.document_store,
+                                  duplicate_index=target.duplicate_index, vector_index=target.vector_index,
+                                  related_index=target.related_index, **embed_fn.import_options())
+        finally:
+            os.remove(path)
+
+    @app.get('/jobs/{job_id}')
+    def job_endpoint(job_id: int, tenant=Depends(current_tenant)):
+        job = job_manager.get(job_id)
+        if job is None or job.owner != tenant.id:
+            raise HTTPException(404, f"ジョブが見つかりません: {job_id}")
+        return job_to_dict(job)
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    def metrics_endpoint():
+        return metrics.to_prometheus()
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="会話履歴の検索・インポートのHTTP API")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="待ち受けるアドレス（既定はこのマシンからだけ）")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    backend = load_setting("EMBEDDER", BACKEND_OPENAI)
+    threads = load_setting("EMBEDDING_THREADS")
+    embed_fn = make_embedder(
+        load_api_key() if backend == BACKEND_OPENAI else None,
+        backend=backend,
+        model=load_setting("EMBEDDING_MODEL"),
+        threads=int(threads) if threads else None,
+        runtime=load_setting("EMBEDDING_RUNTIME", "torch"),
+    )
+    dimensions = load_setting("VECTOR_DIMENSIONS")
+    pool = TenantPool(
+        memory_budget_bytes=int(load_setting("MEMORY_BUDGET_MB", DEFAULT_MEMORY_BUDGET_MB)) * 1024 * 1024,
+        max_open=int(load_setting("MAX_OPEN_TENANTS", MAX_OPEN_TENANTS)),
+        vector_engine=load_setting("VECTOR_ENGINE", VECTOR_ENGINE_CHROMA),
+        vector_dtype=load_setting("VECTOR_DTYPE", DTYPE_INT8),
+        vector_dimensions=int(dimensions) if dimensions else None,
+    )
+    metrics_log_path = load_setting("METRICS_LOG")
+    app = create_app(pool, embed_fn, tenant_header=load_setting("TENANT_HEADER"),
+                     metrics_log=JsonLinesLog(metrics_log_path) if metrics_log_path else None)
+    uvicorn.run(app, host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
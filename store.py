@@ -0,0 +1,175 @@
+import threading
+
+import chromadb
+from chromadb.config import Settings
+
+from chunking import join_chunks
+from docstore import format_conversation
+from embedders import BACKEND_OPENAI, create_embedder
+from embedding_cache import CachedEmbedder, EmbeddingCache
+from flat_index import DTYPE_INT8, FLAT_INDEX_PATH, FlatIndex
+from formats import to_epoch
+from ingest import EMBEDDING_MODEL, GET_BATCH_SIZE
+from keyword_index import KEYWORD_INDEX_PATH, KeywordIndex
+from metrics import metrics
+from related import RELATED_PATH, RelatedIndex
+
+# ChromaDBの保存先とコレクション名（Streamlitアプリ・CLIで共通）
+CHROMA_PATH = "./chroma_db"
+COLLECTION_NAME = "conversations"
+
+# ベクトル検索のエンジン: ChromaDBのHNSW か、量子化した総当たりの flat_index.FlatIndex
+VECTOR_ENGINE_CHROMA = 'chroma'
+VECTOR_ENGINE_FLAT = 'flat'
+VECTOR_ENGINES = (VECTOR_ENGINE_CHROMA, VECTOR_ENGINE_FLAT)
+
+
+# 保存先ごとのChromaDBのクライアント（ChromaDBは同じ保存先を違う設定で2回開くとエラーにする）
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def open_client(path=CHROMA_PATH, memory_limit_bytes=None):
+    """ChromaDBのクライアントを開く（同じ保存先なら最初に開いたものを返す）
+
+    memory_limit_bytes を指定すると、コレクションのHNSWは最初に検索したときに読み込み、
+    合計がその大きさを超えたら使われていない順に（LRU）メモリから追い出す。
+    """
+    with _clients_lock:
+        client = _clients.get(path)
+        if client is None:
+            if memory_limit_bytes:
+                settings = Settings(chroma_segment_cache_policy="LRU", chroma_memory_limit_bytes=int(memory_limit_bytes))
+                client = chromadb.PersistentClient(path=path, settings=settings)
+            else:
+                client = chromadb.PersistentClient(path=path)
+            _clients[path] = client
+        return client
+
+
+def open_collection(path=CHROMA_PATH, name=COLLECTION_NAME, memory_limit_bytes=None):
+    """コレクションを開く（なければ作る）。既存のデータはそのまま使う"""
+    chroma_client = open_client(path, memory_limit_bytes)
+    return chroma_client.get_or_create_collection(
+        name=name,
+        metadata={"hnsw:space": "cosine"}
+    )
+
+
+def open_keyword_index(collection, document_store=None, path=KEYWORD_INDEX_PATH):
+    """BM25インデックスを開く（インデックス導入前のデータ・メタデータを持つ前のインデックスなら作り直す）"""
+    keyword_index = KeywordIndex(path)
+    if (keyword_index.doc_count == 0 and collection.count() > 0) or keyword_index.needs_metadata():
+        keyword_index.rebuild_from_collection(collection, document_store=document_store)
+    return keyword_index
+
+
+def open_vector_index(collection, engine=VECTOR_ENGINE_CHROMA, dtype=DTYPE_INT8, dimensions=None, path=FLAT_INDEX_PATH):
+    """engine='flat' なら FlatIndex を開く（空ならChromaDBのベクトルから作る）。'chroma' ならNone（HNSWを使う）"""
+    if engine == VECTOR_ENGINE_CHROMA:
+        return None
+    if engine != VECTOR_ENGINE_FLAT:
+        raise ValueError(f"不明なベクトル検索エンジン: {engine}（{', '.join(VECTOR_ENGINES)}）")
+    vector_index = FlatIndex(path, dtype=dtype, dimensions=dimensions)
+    if vector_index.count() == 0 and collection.count() > 0:
+        vector_index.rebuild_from_collection(collection)
+    return vector_index
+
+
+def open_related_index(collection, path=RELATED_PATH):
+    """関連する会話のグラフを開く（グラフ導入前のデータがあれば保存済みのEmbeddingから作る）"""
+    related_index = RelatedIndex(path)
+    if related_index.count() == 0 and collection.count() > 0:
+        with metrics.timer('related_rebuild'):
+            related_index.rebuild_from_collection(collection)
+    return related_index
+
+
+class EmbedderMismatch(Exception):
+    pass
+
+
+def make_embedder(api_key=None, backend=BACKEND_OPENAI, model=None, threads=None, runtime='torch'):
+    """Embedder（OpenAI または ローカル） + ディスクキャッシュの embed_fn を作る"""
+    embedder = create_embedder(backend, api_key=api_key, model=model, threads=threads, runtime=runtime)
+    return CachedEmbedder(embedder, EmbeddingCache(), embedder.model_id)
+
+
+def bind_embedder(meta, collection, embed_fn):
+    """コレクションを作ったEmbeddingモデル・次元数と embed_fn が一致するか確かめる
+
+    空のコレクションなら embed_fn のモデルを記録する。違うモデルのベクトルが混ざると
+    検索結果が無意味になるので、一致しなければ EmbedderMismatch を送出する（リセットすれば切り替えられる）。
+    """
+    model_id = embed_fn.model
+    if collection.count() == 0:
+        if meta.get('embedding_model') != model_id:
+            meta.set('embedding_model', model_id)
+            meta.set('embedding_dimension', embed_fn.dimension)
+        return
+    # 記録がないのはモデルを記録するようになる前のデータ（OpenAIの既定モデルで作られている）
+    recorded = meta.get('embedding_model', EMBEDDING_MODEL)
+    dimension = meta.get('embedding_dimension')
+    if recorded != model_id or (dimension is not None and int(dimension) != embed_fn.dimension):
+        raise EmbedderMismatch(
+            f"このデータベースは {recorded}（{dimension or '?'}次元）で作られています。"
+            f"{model_id}（{embed_fn.dimension}次元）で使うにはデータベースをリセットして再インポートしてください"
+        )
+
+
+def backfill_created_ts(collection, meta, batch_size=GET_BATCH_SIZE):
+    """日付での絞り込みを入れる前に保存したチャンクに created_ts（UNIX秒）を付ける（1回だけ）"""
+    if meta.get('created_ts_backfilled'):
+        return 0
+    updated = 0
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=batch_size, offset=offset)
+        ids = []
+        metadatas = []
+        for record_id, metadata in zip(page['ids'], page['metadatas']):
+            metadata = metadata or {}
+            created_ts = to_epoch(metadata.get('created_at'))
+            if 'created_ts' not in metadata and created_ts is not None:
+                ids.append(record_id)
+                metadatas.append({'created_ts': created_ts})
+        if ids:
+            # update はメタデータの既存のキーを残したまま追加する
+            collection.update(ids=ids, metadatas=metadatas)
+            updated += len(ids)
+        if len(page['ids']) < batch_size:
+            break
+        offset += len(page['ids'])
+    meta.set('created_ts_backfilled', 1)
+    return updated
+
+
+def load_full_text(collection, document_store, chat_id):
+    """会話の全文を返す。全文を別に保存する前に取り込んだ会話は、ChromaDBのチャンクをつなげて返す"""
+    with metrics.timer('docstore_get'):
+        body = document_store.get(chat_id)
+    if body is not None:
+        return format_conversation(body)
+    records = collection.get(where={'chat_id': chat_id}, include=['documents', 'metadatas'])
+    chunks = sorted(zip(records['metadatas'], records['documents']), key=lambda c: (c[0] or {}).get('chunk_index', 0))
+    # チャンクは前のチャンクの末尾のメッセージを重ねて持つので、重なりを除いてつなげる
+    return join_chunks([((m or {}).get('msg_start'), (m or {}).get('msg_end'), doc) for m, doc in chunks])
+
+
+def reset_store(collection, keyword_index, meta, document_store=None, duplicate_index=None, vector_index=None,
+                related_index=None):
+    """保存済みの会話をすべて削除する"""
+    # 全レコードのIDを取って消す（where={} は新しいChromaDBでは使えない）
+    all_ids = collection.get(include=[])['ids']
+    for start in range(0, len(all_ids), 5000):
+        collection.delete(ids=all_ids[start:start + 5000])
+    keyword_index.clear()
+    if document_store is not None:
+        document_store.clear()
+    if duplicate_index is not None:
+        duplicate_index.clear()
+    if vector_index is not None:
+        vector_index.clear()
+    if related_index is not None:
+        related_index.clear()
+    meta.bump_version()
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from dedup import DUPLICATES_PATH, DuplicateIndex
+from docstore import DOCSTORE_PATH, DocumentStore
+from filters import TitleCatalog
+from flat_index import DTYPE_INT8, FLAT_INDEX_PATH
+from journal import JOURNAL_PATH, ImportJournal
+from keyword_index import KEYWORD_INDEX_PATH
+from metastore import META_PATH, MetaStore
+from metrics import metrics
+from query_cache import QueryCache
+from related import RELATED_PATH
+from store import (CHROMA_PATH, COLLECTION_NAME, VECTOR_ENGINE_CHROMA, backfill_created_ts, open_client,
+                   open_collection, open_keyword_index, open_related_index, open_vector_index)
+
+# ユーザーを分けないとき（ひとりで使うとき）のテナント。今までどおり ./chroma_db 直下のストアを使う
+DEFAULT_TENANT = "default"
+
+# ユーザーごとのストア（BM25・全文・重複・メタなど）を置くディレクトリ（./chroma_db の下）
+# ChromaDBのコレクションは ./chroma_db のクライアントに "conversations__{テナントID}" として作る
+TENANTS_DIR = "tenants"
+
+# テナントIDに残す読める部分の長さ（コレクション名は63文字まで）
+TENANT_SLUG_LENGTH = 24
+
+# 同時に開いておくテナント数の上限と、メモリの予算の既定値
+MAX_OPEN_TENANTS = 64
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+def tenant_id(name):
+    """ユーザー名・メールアドレスなどから、ディレクトリ名・コレクション名に使えるテナントIDを作る
+
+    読める部分（英数字）に名前のハッシュを付けるので、記号だけ違う名前も別のテナントになる。
+    name がなければ DEFAULT_TENANT（ユーザーを分けない）。
+    """
+    if not name:
+        return DEFAULT_TENANT
+    slug = re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')[:TENANT_SLUG_LENGTH]
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:12]
+    return f"{slug}-{digest}" if slug else digest
+
+
+class Tenant:
+    """1ユーザー（ワークスペース）分のストア一式
+
+    コレクション・BM25・全文・近い重複・関連する会話・メタ・ジャーナル・検索結果キャッシュを、テナントのディレクトリに持つ。
+    DEFAULT_TENANT は今までと同じ場所（./chroma_db 直下、コレクション "conversations"）を使う。
+    root を変えると ./chroma_db の代わりにそこを使う（ベンチマーク用）。
+    """
+
+    def __init__(self, tenant_id=DEFAULT_TENANT, root=CHROMA_PATH, memory_limit_bytes=None,
+                 vector_engine=VECTOR_ENGINE_CHROMA, vector_dtype=DTYPE_INT8, vector_dimensions=None):
+        self.id = tenant_id
+        if tenant_id == DEFAULT_TENANT:
+            self.path = root
+            collection_name = COLLECTION_NAME
+        else:
+            self.path = os.path.join(root, TENANTS_DIR, tenant_id)
+            collection_name = f"{COLLECTION_NAME}__{tenant_id}"
+        os.makedirs(self.path, exist_ok=True)
+        self.upload_dir = os.path.join(self.path, "uploads")
+        with metrics.timer('tenant_open'):
+            self.collection = open_collection(root, collection_name, memory_limit_bytes)
+            self.document_store = DocumentStore(self._file(DOCSTORE_PATH))
+            self.duplicate_index = DuplicateIndex(self._file(DUPLICATES_PATH))
+            self.meta = MetaStore(self._file(META_PATH))
+            # 日付で絞り込めるよう、古いデータに created_ts を付ける（1回だけ）。
+            # BM25・総当たりの索引はメタデータの写しを持つので、作り直す前に付けておく
+            backfill_created_ts(self.collection, self.meta)
+            self.keyword_index = open_keyword_index(self.collection, self.document_store,
+                                                    path=self._file(KEYWORD_INDEX_PATH))
+            self.vector_index = open_vector_index(self.collection, vector_engine, vector_dtype, vector_dimensions,
+                                                  path=self._file(FLAT_INDEX_PATH))
+            self.related_index = open_related_index(self.collection, path=self._file(RELATED_PATH))
+            self.journal = ImportJournal(self._file(JOURNAL_PATH))
+        self.query_cache = QueryCache()
+        self.title_catalog = TitleCatalog(self.meta)
+
+    def _file(self, default_path):
+        """既定の保存先（./chroma_db/xxx）と同じ名前で、テナントのディレクトリに置く"""
+        return os.path.join(self.path, os.path.basename(default_path))
+
+    def resident_bytes(self):
+        """このテナントがプロセスのメモリに持っているもののおおよその大きさ（HNSWはChromaDBが別に数える）"""
+        total = self.duplicate_index.resident_bytes()
+        if self.vector_index is not None:
+            total += self.vector_index.stats()['vector_bytes']
+        return total
+
+
+class TenantPool:
+    """テナントを最初に使われたときに開き、使われていない順（LRU）に手放す
+
+    開いているテナントの resident_bytes の合計が memory_budget_bytes を超えるか、数が max_open を超えたら、
+    一番長く使われていないものから手放す（インポート中で lease しているものは手放さない）。
+    手放したテナントも参照している間（表示中の検索など）はそのまま使え、次に使われたときに開き直す。
+    HNSWのセグメントは、同じ予算でChromaDBがLRUに読み込み・追い出しする（store.open_client）。
+    複数スレッドから呼んでよい。
+    """
+
+    def __init__(self, memory_budget_bytes=DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024, max_open=MAX_OPEN_TENANTS,
+                 root=CHROMA_PATH, **tenant_options):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_open = max_open
+        self.root = root
+        self.tenant_options = tenant_options
+        # 全テナントで1つのクライアントを共有する（コレクションごとの読み込み・追い出しはChromaDBに任せる）
+        open_client(root, memory_limit_bytes=memory_budget_bytes)
+        self._lock = threading.Lock()
+        self._tenants = OrderedDict()  # テナントID -> Tenant（使われた順）
+        self._opening = {}  # テナントID -> 開いている最中のロック
+        self._leases = {}  # テナントID -> lease の数
+        self.opens = 0
+        self.evictions = 0
+
+    def get(self, tenant_id):
+        """テナントを返す（開いていなければ開く）"""
+        with self._lock:
+            tenant = self._tenants.get(tenant_id)
+            if tenant is not None:
+                self._tenants.move_to_end(tenant_id)
+                return tenant
+            opening = self._opening.setdefault(tenant_id, threading.Lock())
+        # 開くのは時間がかかることがある（BM25の作り直しなど）ので、ほかのテナントは待たせない
+        with opening:
+            with self._lock:
+                tenant = self._tenants.get(tenant_id)
+            if tenant is None:
+                tenant = Tenant(tenant_id, self.root, self.memory_budget_bytes, **self.tenant_options)
+                with self._lock:
+                    self._tenants[tenant_id] = tenant
+                    self._opening.pop(tenant_id, None)
+                    self.opens += 1
+                metrics.inc('tenant_opens')
+                self._evict(keep=tenant_id)
+        return tenant
+
+    @contextmanager
+    def lease(self, tenant_id):
+        """with pool.lease(tenant_id) as tenant: の間はそのテナントを手放さない（インポートのジョブ用）"""
+        with self._lock:
+            self._leases[tenant_id] = self._leases.get(tenant_id, 0) + 1
+        try:
+            yield self.get(tenant_id)
+        finally:
+            with self._lock:
+                self._leases[tenant_id] -= 1
+                if not self._leases[tenant_id]:
+                    del self._leases[tenant_id]
+
+    def _evict(self, keep):
+        with self._lock:
+            sizes = {tid: tenant.resident_bytes() for tid, tenant in self._tenants.items()}
+            total = sum(sizes.values())
+            for tid in list(self._tenants):
+                if total <= self.memory_budget_bytes and len(self._tenants) <= self.max_open:
+                    break
+                if tid == keep or tid in self._leases:
+                    continue
+                del self._tenants[tid]
+                total -= sizes[tid]
+                self.evictions += 1
+                metrics.inc('tenant_evictions')
+
+    def stats(self):
+        with self._lock:
+            tenants = list(self._tenants.values())
+            opens, evictions = self.opens, self.evictions
+        return {
+            'open': len(tenants),
+            'resident_bytes': sum(tenant.resident_bytes() for tenant in tenants),
+            'budget_bytes': self.memory_budget_bytes,
+            'opens': opens,
+            'evictions': evictions,
+        }
@@ -0,0 +1,64 @@
+import os
+import random
+import sys
+
+import pytest
+
+# モジュールはリポジトリ直下に平たく置いてある
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedders import HashingEmbedder  # noqa: E402
+from formats import Conversation  # noqa: E402
+from ingest import run_import  # noqa: E402
+from ratelimit import NoLimit  # noqa: E402
+from tenants import Tenant  # noqa: E402
+
+WORDS = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa "
+         "quebec romeo sierra tango uniform victor whiskey xray yankee zulu").split()
+
+
+def make_text(seed, length=80):
+    """seed ごとに違う、決まった語の並び（近い重複の判定に十分な長さ）"""
+    rng = random.Random(seed)
+    return ' '.join(f"{rng.choice(WORDS)}{rng.randrange(10)}" for _ in range(length))
+
+
+def make_conversation(chat_id, text, title=None, updated_at='2024-01-01T00:00:00'):
+    return Conversation(chat_id, title or chat_id, '2024-01-01T00:00:00', updated_at,
+                        [('human', text, None), ('assistant', f"answer {text[:200]}", None)])
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(conversations, n):
+    # n 件読んだところで止まるエクスポート（インポートの中断の代わり）
+    for i, conversation in enumerate(conversations):
+        if i == n:
+            raise Interrupted()
+        yield conversation
+
+
+@pytest.fixture
+def tenant(tmp_path):
+    return Tenant(root=str(tmp_path / 'chroma_db'))
+
+
+@pytest.fixture
+def embed_fn():
+    return HashingEmbedder(dimension=64)
+
+
+def import_conversations(tenant, embed_fn, conversations, **options):
+    """アプリ・CLIと同じストア一式でインポートする"""
+    options.setdefault('rate_limiter', NoLimit())
+    return run_import(conversations, tenant.collection, embed_fn,
+                      keyword_index=tenant.keyword_index, on_write=tenant.meta.bump_version,
+                      document_store=tenant.document_store, duplicate_index=tenant.duplicate_index,
+                      vector_index=tenant.vector_index, related_index=tenant.related_index, **options)
+
+
+def stored_chat_ids(tenant):
+    metadatas = tenant.collection.get(include=['metadatas'])['metadatas']
+    return {metadata['chat_id'] for metadata in metadatas}
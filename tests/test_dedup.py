@@ -0,0 +1,72 @@
+from conftest import import_conversations, make_conversation, make_text, stored_chat_ids
+
+from dedup import DUPLICATE_THRESHOLD, DuplicateIndex, minhash, similarity
+
+
+def fork(text):
+    # 末尾の数語だけ違う会話（フォーク・再生成）
+    words = text.split()
+    return ' '.join(words[:-3] + ['fork1', 'fork2', 'fork3'])
+
+
+def test_minhash_similarity_of_fork():
+    text = make_text(1)
+    assert similarity(minhash(text), minhash(fork(text))) >= DUPLICATE_THRESHOLD
+    assert similarity(minhash(text), minhash(make_text(2))) < DUPLICATE_THRESHOLD
+    assert minhash('too short') is None
+
+
+def test_retain_keeps_orphaned_members(tmp_path):
+    index = DuplicateIndex(str(tmp_path / 'duplicates.sqlite'))
+    text = make_text(1)
+    assert index.register('a', 'A', 'h1', minhash(text)) is None
+    assert index.register('b', 'B', 'h2', minhash(fork(text))) == 'a'
+
+    removed, orphaned = index.retain(['b'])
+    assert removed == ['a']
+    assert orphaned == ['b']
+    # 代表が消えたので、選び直すと b が代表になる
+    assert index.relink('b') is None
+    assert index.lookup('b') == ('h2', None)
+
+
+def test_import_links_near_duplicates(tenant, embed_fn):
+    text = make_text(1)
+    conversations = [make_conversation('a', text), make_conversation('b', fork(text)),
+                     make_conversation('c', make_text(2))]
+    stats = import_conversations(tenant, embed_fn, conversations)
+    assert stats.duplicate_count == 1
+    assert stored_chat_ids(tenant) == {'a', 'c'}
+    assert tenant.document_store.get('b') is not None
+
+
+def test_deleting_canonical_promotes_duplicate(tenant, embed_fn):
+    text = make_text(1)
+    a, b, c = make_conversation('a', text), make_conversation('b', fork(text)), make_conversation('c', make_text(2))
+    import_conversations(tenant, embed_fn, [a, b, c])
+
+    stats = import_conversations(tenant, embed_fn, [b, c])
+    assert stats.relinked_count == 1
+    assert stored_chat_ids(tenant) == {'b', 'c'}
+    assert {chat_id for _, chat_id, _ in tenant.keyword_index.search('fork1 fork2')} == {'b'}
+    assert tenant.document_store.get('b') is not None
+    assert tenant.duplicate_index.lookup('b')[1] is None
+
+    # 次のインポートでは変更なし（選び直した会話のハッシュも揃っている）
+    stats = import_conversations(tenant, embed_fn, [b, c])
+    assert stats.unchanged_count == 2
+    assert stats.new_count == 0
+
+
+def test_changed_canonical_rechecks_duplicates(tenant, embed_fn):
+    text = make_text(1)
+    a, b = make_conversation('a', text), make_conversation('b', fork(text))
+    import_conversations(tenant, embed_fn, [a, b])
+    assert stored_chat_ids(tenant) == {'a'}
+
+    # 代表の内容がまったく変わったら、重複だった b は代表になってEmbeddingされる
+    changed = make_conversation('a', make_text(3), updated_at='2024-02-01T00:00:00')
+    stats = import_conversations(tenant, embed_fn, [b, changed])
+    assert stats.relinked_count == 1
+    assert stored_chat_ids(tenant) == {'a', 'b'}
+    assert tenant.duplicate_index.lookup('b')[1] is None
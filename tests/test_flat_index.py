@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from flat_index import DTYPE_FLOAT16, DTYPE_INT8, INITIAL_CAPACITY, FlatIndex
+
+
+def random_vectors(count, dimension=64, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dimension)).astype(np.float32)
+
+
+def upsert(index, vectors, prefix='c'):
+    ids = [f"{prefix}{i}#0" for i in range(len(vectors))]
+    index.upsert(ids, vectors.tolist(), [{'chat_id': f"{prefix}{i}"} for i in range(len(vectors))])
+    return ids
+
+
+def exact_top(vectors, query, k):
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return list(np.argsort(-(normalized @ (query / np.linalg.norm(query))))[:k])
+
+
+@pytest.mark.parametrize('dtype', [DTYPE_INT8, DTYPE_FLOAT16])
+def test_quantized_scores_match_float32(tmp_path, dtype):
+    vectors = random_vectors(300)
+    index = FlatIndex(str(tmp_path / 'flat'), dtype=dtype)
+    ids = upsert(index, vectors)
+    queries = random_vectors(5, seed=1)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ normalized.T
+    assert np.abs(index.scores(queries) - expected).max() < 0.02
+
+    result = index.query(queries[:1], n_results=10)
+    assert result['ids'][0][0] == ids[exact_top(vectors, queries[0], 1)[0]]
+    assert result['distances'][0] == sorted(result['distances'][0])
+    # 自分自身を引けば距離はほぼ0
+    assert index.query(vectors[7:8], n_results=1)['ids'][0] == [ids[7]]
+
+
+def test_truncated_dimensions_and_filter(tmp_path):
+    vectors = random_vectors(50)
+    index = FlatIndex(str(tmp_path / 'flat'), dimensions=16)
+    upsert(index, vectors)
+    assert index.dimension == 16
+    assert index.stats()['float32_bytes'] == 50 * 64 * 4
+    result = index.query(vectors[:1], n_results=5, chat_ids=['c3', 'c4'])
+    assert sorted(result['ids'][0]) == ['c3#0', 'c4#0']
+
+
+def test_delete_reuses_rows_and_grows(tmp_path):
+    index = FlatIndex(str(tmp_path / 'flat'))
+    vectors = random_vectors(INITIAL_CAPACITY + 10)
+    ids = upsert(index, vectors)
+    index.delete(ids[:5])
+    assert index.count() == len(ids) - 5
+    assert ids[0] not in index.query(vectors[:1], n_results=3)['ids'][0]
+    upsert(index, random_vectors(5, seed=2), prefix='n')
+    assert index.count() == len(ids)
+    assert index._size == len(ids)
+
+
+def test_settings_change_clears(tmp_path):
+    path = str(tmp_path / 'flat')
+    upsert(FlatIndex(path, dtype=DTYPE_INT8), random_vectors(10))
+    assert FlatIndex(path, dtype=DTYPE_FLOAT16).count() == 0
+
+
+def test_sees_writes_from_another_process(tmp_path):
+    path = str(tmp_path / 'flat')
+    # アプリ・サーバーが開いたままの索引と、CLIのインポートが書き込む索引
+    reader = FlatIndex(path)
+    writer = FlatIndex(path)
+    vectors = random_vectors(20)
+    ids = upsert(writer, vectors)
+    assert reader.count() == 20
+    assert reader.query(vectors[3:4], n_results=1)['ids'][0] == [ids[3]]
+
+    writer.delete(ids[:10])
+    assert reader.count() == 10
+    assert ids[3] not in reader.query(vectors[3:4], n_results=5)['ids'][0]
+
+
+def test_two_writers_do_not_share_rows(tmp_path):
+    path = str(tmp_path / 'flat')
+    first = FlatIndex(path)
+    second = FlatIndex(path)
+    a = random_vectors(10, seed=1)
+    b = random_vectors(10, seed=2)
+    a_ids = upsert(first, a, prefix='a')
+    # second は first の書き込みの前に開いたまま。古い行の対応で同じ行を上書きしてはいけない
+    b_ids = upsert(second, b, prefix='b')
+    upsert(first, a[:2], prefix='x')
+
+    reopened = FlatIndex(path)
+    assert reopened.count() == 22
+    assert reopened.query(a[4:5], n_results=1)['ids'][0] == [a_ids[4]]
+    assert reopened.query(b[4:5], n_results=1)['ids'][0] == [b_ids[4]]
@@ -0,0 +1,117 @@
+import io
+import json
+
+import pytest
+from conftest import Interrupted, import_conversations, interrupt_after, make_conversation, make_text, stored_chat_ids
+
+from docstore import format_conversation
+from formats import Conversation, iter_conversations, to_epoch
+from ingest import LEGACY_STORE_FORMAT, SNIPPET_CHARS, STORE_FORMAT_VERSION, run_import
+from journal import FINGERPRINT_BYTES, fingerprint
+from ratelimit import NoLimit
+from store import load_full_text
+
+
+class Counting:
+    """Embeddingした入力の数を数える"""
+
+    def __init__(self, embed_fn):
+        self.embed_fn = embed_fn
+        self.texts = 0
+
+    def __call__(self, texts):
+        self.texts += len(texts)
+        return self.embed_fn(texts)
+
+
+def store_formats(tenant):
+    return {metadata['store_format'] for metadata in tenant.collection.get(include=['metadatas'])['metadatas']}
+
+
+def test_store_format_change_migrates_without_embedding(tenant, embed_fn):
+    conversations = [make_conversation(f"c{i:02d}", make_text(i, 300)) for i in range(6)]
+    # 全文をChromaDBに置く古い形式で入れておく
+    run_import(conversations, tenant.collection, embed_fn, rate_limiter=NoLimit(),
+               keyword_index=tenant.keyword_index)
+    assert store_formats(tenant) == {LEGACY_STORE_FORMAT}
+    before = tenant.collection.get(ids=['c02#0'], include=['embeddings'])['embeddings'][0]
+
+    counting = Counting(embed_fn)
+    stats = import_conversations(tenant, counting, conversations)
+    assert counting.texts == 0
+    assert stats.unchanged_count == 6
+    assert stats.migrated_count == 6
+    assert store_formats(tenant) == {STORE_FORMAT_VERSION}
+    after = tenant.collection.get(ids=['c02#0'], include=['embeddings'])['embeddings'][0]
+    assert list(after) == list(before)
+    documents = tenant.collection.get(include=['documents'])['documents']
+    assert max(len(document) for document in documents) <= SNIPPET_CHARS
+    assert tenant.document_store.get('c03')['messages'][0][1] == make_text(3, 300)
+
+    stats = import_conversations(tenant, counting, conversations)
+    assert stats.migrated_count == 0
+    assert counting.texts == 0
+
+
+def test_full_text_of_legacy_chunks_drops_overlap(tenant, embed_fn):
+    # 複数行のメッセージや、1つで上限を超えるメッセージも混ぜる
+    messages = [('human' if i % 2 else 'assistant', make_text(i, 40).replace(' ', '\n', i % 3), None)
+                for i in range(30)]
+    messages[12] = ('human', make_text(99, 400), None)
+    conv = Conversation('c1', 'c1', '2024-01-01T00:00:00', '2024-01-01T00:00:00', messages)
+    run_import([conv], tenant.collection, embed_fn, rate_limiter=NoLimit(), keyword_index=tenant.keyword_index,
+               chunk_max_tokens=200, chunk_overlap_tokens=60)
+    metadatas = sorted(tenant.collection.get(include=['metadatas'])['metadatas'], key=lambda m: m['chunk_index'])
+    assert any(b['msg_start'] <= a['msg_end'] for a, b in zip(metadatas, metadatas[1:]))
+    assert tenant.document_store.get('c1') is None
+    body = {'messages': messages}
+    assert load_full_text(tenant.collection, tenant.document_store, 'c1') == format_conversation(body)
+
+
+def test_interrupted_import_resumes_from_checkpoint(tenant, embed_fn):
+    conversations = [make_conversation(f"c{i:02d}", make_text(i)) for i in range(20)]
+    options = {'max_items': 1, 'add_batch_size': 1, 'concurrency': 1}
+    checkpoint = tenant.journal.open('job', 'conversations.json', len(conversations))
+    with pytest.raises(Interrupted):
+        import_conversations(tenant, embed_fn, interrupt_after(conversations, 8), checkpoint=checkpoint, **options)
+    done = tenant.journal.progress('job')
+    assert 0 < done <= 8
+
+    counting = Counting(embed_fn)
+    checkpoint = tenant.journal.open('job', 'conversations.json', len(conversations))
+    assert checkpoint.resumed == done
+    stats = import_conversations(tenant, counting, conversations, checkpoint=checkpoint, **options)
+    # 完了済みの会話は抽出もEmbeddingもしない。エクスポートにあるので消しもしない
+    assert stats.resumed_count == done
+    assert counting.texts <= len(conversations) - done
+    assert stored_chat_ids(tenant) == {c.id for c in conversations}
+    # 最後まで終わったら途中経過は消える
+    assert tenant.journal.progress('job') == 0
+
+
+def test_fingerprint_uses_size_head_and_tail():
+    data = b'x' * (FINGERPRINT_BYTES * 3)
+    fp = io.BytesIO(data)
+    key = fingerprint(fp)
+    assert fp.tell() == 0
+    assert fingerprint(io.BytesIO(data)) == key
+    assert fingerprint(io.BytesIO(data[:-1] + b'y')) != key
+    assert fingerprint(io.BytesIO(data + b'x')) != key
+
+
+def test_imports_conversations_with_non_string_dates(tenant, embed_fn):
+    export = [{'uuid': f"c{i}", 'name': f"c{i}", 'created_at': created_at, 'updated_at': created_at,
+               'chat_messages': [{'sender': 'human', 'text': make_text(i)}]}
+              for i, created_at in enumerate([1700000000, 1.5, None, ['2024-01-01'], {'at': 1}, True])]
+    conversations = list(iter_conversations(io.BytesIO(json.dumps(export).encode())))
+    assert [c.error for c in conversations] == [None] * 6
+    # アダプタを通さない数値の日時は、to_epoch で日付なしとして扱う
+    conversations.append(make_conversation('c6', make_text(6)))
+    conversations[-1].created_at = 1700000000
+    stats = import_conversations(tenant, embed_fn, conversations)
+    assert stats.error_count == 0
+    assert stored_chat_ids(tenant) == {f"c{i}" for i in range(7)}
+    created = {m['chat_id']: m.get('created_ts') for m in tenant.collection.get(include=['metadatas'])['metadatas']}
+    assert created['c0'] == 1700000000
+    assert created['c2'] is None and created['c3'] is None and created['c6'] is None
+    assert to_epoch(1700000000) is None and to_epoch(['2024-01-01']) is None
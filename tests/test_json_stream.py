@@ -0,0 +1,73 @@
+import io
+import json
+
+import pytest
+
+from formats import iter_conversations
+from json_stream import iter_array
+
+ITEMS = [
+    {'id': 1, 'text': "マイクロ波の実験 🔬", 'nested': {'list': [1, 2.5, None, True], 'empty': {}}},
+    {'id': 2, 'text': 'escaped "quotes" and \\ backslash\n', 'big': 12345678901234567890},
+    [],
+    -0.125,
+    "文字列だけ",
+]
+
+
+@pytest.mark.parametrize('read_size', [1, 3, 7, 64, 1024 * 1024])
+def test_iter_array_matches_json_loads(read_size):
+    # 読み込み単位が小さいと、値やUTF-8の1文字が読み込みの境目で切れる
+    data = json.dumps(ITEMS, ensure_ascii=False, indent=1).encode('utf-8')
+    assert list(iter_array(io.BytesIO(data), read_size=read_size)) == ITEMS
+
+
+def test_numbers_cut_at_read_boundary():
+    # "1." や "2e" で読み込みが切れても、続きを読んでから数値にする
+    for pad in range(8):
+        data = (' ' * pad + '[1.5, 2e3, -0.25E-2, 10]').encode()
+        for read_size in range(1, 9):
+            assert list(iter_array(io.BytesIO(data), read_size=read_size)) == [1.5, 2e3, -0.25E-2, 10]
+
+
+@pytest.mark.parametrize('read_size', [1, 5, 1024])
+def test_iter_array_under_key(read_size):
+    data = '\ufeff' + json.dumps({'meta': {'skip': [1, {'a': ']'}]}, 'conversations': ITEMS, 'after': 1})
+    assert list(iter_array(io.BytesIO(data.encode('utf-8')), 'conversations', read_size)) == ITEMS
+    # テキストのファイルでも読める
+    assert list(iter_array(io.StringIO(data), 'conversations', read_size)) == ITEMS
+
+
+def test_iter_array_empty_and_errors():
+    assert list(iter_array(io.BytesIO(b' [ ] '))) == []
+    with pytest.raises(KeyError):
+        list(iter_array(io.BytesIO(b'{"other": []}'), 'conversations'))
+    with pytest.raises(ValueError):
+        list(iter_array(io.BytesIO(b'[1, 2')))
+    with pytest.raises(ValueError):
+        list(iter_array(io.BytesIO(b'{"a": 1}')))
+
+
+def test_iter_conversations_detects_formats():
+    claude = [{'uuid': 'c1', 'name': 'Claude', 'created_at': '2024-01-01', 'updated_at': '2024-01-02',
+               'chat_messages': [{'sender': 'human', 'content': [{'type': 'text', 'text': ' こんにちは '},
+                                                                 {'type': 'tool_use', 'text': 'x'}]}]}]
+    conversations = list(iter_conversations(io.BytesIO(json.dumps(claude).encode())))
+    assert [(c.id, c.title) for c in conversations] == [('c1', 'Claude')]
+    assert conversations[0].messages[0][:2] == ('human', 'こんにちは')
+
+    chatgpt = [{'id': 'g1', 'title': 'GPT', 'create_time': 0, 'current_node': 'b', 'mapping': {
+        'a': {'parent': None, 'message': {'author': {'role': 'user'}, 'content': {'parts': ['hi']}}},
+        'b': {'parent': 'a', 'message': {'author': {'role': 'assistant'}, 'content': {'parts': ['hello']}}},
+        'c': {'parent': 'a', 'message': {'author': {'role': 'assistant'}, 'content': {'parts': ['other']}}},
+    }}]
+    conversation, = iter_conversations(io.BytesIO(json.dumps(chatgpt).encode()))
+    assert [text for _, text, _ in conversation.messages] == ['hi', 'hello']
+    assert conversation.created_at.startswith('1970-01-01')
+
+    simple = {'conversations': [{'id': 's1', 'title': 'Simple', 'messages': [{'role': 'user', 'content': 'yo'}]},
+                                {'id': 's2', 'messages': 'broken'}]}
+    first, second = iter_conversations(io.BytesIO(json.dumps(simple).encode()))
+    assert (first.id, first.messages[0][1], first.error) == ('s1', 'yo', None)
+    # 読めない会話は error 付きで返し、ほかの会話の読み込みは続ける
+    assert second.id == 's2' and second.error
@@ -0,0 +1,96 @@
+import sqlite3
+
+from conftest import import_conversations, make_conversation, make_text
+
+from keyword_index import KeywordIndex, tokenize
+from search import MODE_KEYWORD, rank_conversations
+from store import open_keyword_index
+
+
+def test_search_ranks_by_bm25(tmp_path):
+    index = KeywordIndex(str(tmp_path / 'keyword_index.sqlite'))
+    index.add([
+        ('a#0', 'a', 'python python numpy'),
+        ('b#0', 'b', 'python cooking recipe'),
+        ('c#0', 'c', 'cooking recipe soup'),
+        ('d#0', 'd', 'travel plan kyoto'),
+        ('e#0', 'e', 'garden tomato soil'),
+    ])
+    assert [chat_id for _, chat_id, _ in index.search('python numpy')] == ['a', 'b']
+    assert [chat_id for _, chat_id, _ in index.search('python', chat_ids={'b'})] == ['b']
+    assert [chat_id for _, chat_id, _ in index.search('recipe soup')] == ['c', 'b']
+    index.delete(['a#0'])
+    assert [chat_id for _, chat_id, _ in index.search('numpy')] == []
+
+
+def test_sees_writes_from_another_connection(tmp_path):
+    path = str(tmp_path / 'keyword_index.sqlite')
+    # アプリ・サーバーが開いたままのインデックスと、CLIのインポートが書き込むインデックス
+    reader = KeywordIndex(path)
+    writer = KeywordIndex(path)
+    writer.add([('a#0', 'a', 'microwave experiment'), ('b#0', 'b', 'cooking recipe')])
+    assert [chat_id for _, chat_id, _ in reader.search('microwave')] == ['a']
+    assert reader.doc_count == 2
+
+    writer.delete(['a#0'])
+    assert reader.search('microwave') == []
+    assert reader.doc_count == 1
+
+
+def test_tokenize_splits_japanese_and_lowercases():
+    tokens = tokenize("Python で マイクロ波 実験")
+    assert 'python' in tokens
+    assert all(token == token.lower() for token in tokens)
+
+
+class CountingGets:
+    """ChromaDBのコレクションの get の回数を数える"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.gets = 0
+
+    def get(self, *args, **kwargs):
+        self.gets += 1
+        return self.collection.get(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def test_keyword_search_reads_metadata_from_the_index(tenant, embed_fn):
+    import_conversations(tenant, embed_fn, [make_conversation(f"c{i:02d}", make_text(i)) for i in range(5)])
+    collection = CountingGets(tenant.collection)
+    ranked, _ = rank_conversations(collection, embed_fn, make_text(2, 10), 3, mode=MODE_KEYWORD,
+                                   keyword_index=tenant.keyword_index)
+    assert collection.gets == 0
+    assert ranked[0]['chat_id'] == 'c02'
+    assert ranked[0]['title'] == 'c02'
+    assert ranked[0]['message_count'] == 2
+
+
+def test_index_without_metadata_is_rebuilt(tenant, embed_fn):
+    import_conversations(tenant, embed_fn, [make_conversation('a', make_text(1))])
+    path = tenant.keyword_index.path
+    # メタデータを持つ前に作ったインデックス
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE docs SET metadata = NULL")
+    conn.commit()
+    conn.close()
+    keyword_index = open_keyword_index(tenant.collection, tenant.document_store, path=path)
+    assert not keyword_index.needs_metadata()
+    assert keyword_index.metadatas(['a#0'])['a#0']['title'] == 'a'
+
+
+def test_opens_index_from_before_metadata(tmp_path):
+    path = str(tmp_path / 'keyword_index.sqlite')
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE docs (doc_id TEXT PRIMARY KEY, chat_id TEXT NOT NULL, length INTEGER NOT NULL);
+        INSERT INTO docs VALUES ('a#0', 'a', 1);
+    """)
+    conn.close()
+    index = KeywordIndex(path)
+    assert index.needs_metadata()
+    index.add([('a#0', 'a', 'microwave', {'title': 'A'})])
+    assert index.metadatas(['a#0']) == {'a#0': {'title': 'A'}}
@@ -0,0 +1,85 @@
+import pytest
+
+import ratelimit
+from ratelimit import TokenBucket, call_with_retry, is_retryable
+
+
+class FakeClock:
+    """sleep すると進む時計"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ApiError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.response = type('Response', (), {'headers': {'retry-after': retry_after} if retry_after else {}})()
+
+
+def test_bucket_keeps_requests_per_minute():
+    clock = FakeClock()
+    bucket = TokenBucket(120, 10 ** 9, clock=clock, sleep=clock.sleep)
+    # 最初は1秒分（2回）だけすぐ通り、あとは0.5秒に1回
+    for _ in range(2):
+        bucket.acquire()
+    assert clock.now == 0
+    for _ in range(120):
+        bucket.acquire()
+    assert clock.now == pytest.approx(60.0, abs=0.05)
+
+
+def test_bucket_keeps_tokens_per_minute():
+    clock = FakeClock()
+    bucket = TokenBucket(10 ** 6, 6000, clock=clock, sleep=clock.sleep)
+    # 最初の1秒分（100トークン）はすぐ通る
+    bucket.acquire(tokens=100)
+    assert clock.now == 0
+    for _ in range(10):
+        bucket.acquire(tokens=600)
+    # 1分で6000トークン = 600トークンは6秒
+    assert clock.now == pytest.approx(60.0, abs=0.05)
+    # 容量を超える要求は容量まで切り詰めて、いつかは通す
+    bucket.acquire(tokens=10 ** 6)
+
+
+def test_call_with_retry_backs_off_and_honors_retry_after(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'backoff_delay', lambda attempt: 0.5)
+    errors = [ApiError(429, retry_after='3'), ApiError(503)]
+    sleeps = []
+
+    def flaky():
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+
+    assert call_with_retry(flaky, sleep=sleeps.append) == ('ok', 2)
+    assert sleeps == [3.0, 0.5]
+
+
+def test_call_with_retry_raises_non_retryable():
+    calls = []
+
+    def bad_request():
+        calls.append(1)
+        raise ApiError(400)
+
+    with pytest.raises(ApiError):
+        call_with_retry(bad_request, sleep=lambda seconds: None)
+    assert len(calls) == 1
+
+
+def test_is_retryable():
+    assert is_retryable(ApiError(429))
+    assert is_retryable(ApiError(500))
+    assert not is_retryable(ApiError(401))
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(ValueError())
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from conftest import Interrupted, import_conversations, interrupt_after, make_conversation, make_text
+
+from related import RelatedIndex
+
+
+def edges(related_index):
+    return set(related_index._conn.execute("SELECT chat_id, neighbor_id FROM neighbors"))
+
+
+def test_incremental_update_matches_rebuild(tenant, embed_fn, tmp_path):
+    conversations = [make_conversation(f"c{i:02d}", make_text(i)) for i in range(30)]
+    import_conversations(tenant, embed_fn, conversations[:12])
+    import_conversations(tenant, embed_fn, conversations)
+    import_conversations(tenant, embed_fn, conversations[5:])
+
+    rebuilt = RelatedIndex(str(tmp_path / 'rebuilt.sqlite'))
+    rebuilt.rebuild_from_collection(tenant.collection)
+    assert tenant.related_index.count() == 25
+    assert edges(tenant.related_index) == edges(rebuilt)
+
+
+def test_related_excludes_self_and_is_sorted(tenant, embed_fn):
+    conversations = [make_conversation(f"c{i:02d}", make_text(i)) for i in range(10)]
+    import_conversations(tenant, embed_fn, conversations)
+    related = tenant.related_index.related(['c00'], min_score=-1.0)['c00']
+    assert len(related) == tenant.related_index.k
+    assert 'c00' not in [chat_id for chat_id, _, _ in related]
+    scores = [score for _, _, score in related]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_resumed_import_fills_the_graph(tenant, embed_fn):
+    conversations = [make_conversation(f"c{i:02d}", make_text(i)) for i in range(40)]
+    checkpoint = tenant.journal.open('job', 'conversations.json', len(conversations))
+    # 1件ずつ書き込んでチェックポイントに記録する設定で、10件目で止める
+    options = {'max_items': 1, 'add_batch_size': 1, 'concurrency': 1}
+    with pytest.raises(Interrupted):
+        import_conversations(tenant, embed_fn, interrupt_after(conversations, 10), checkpoint=checkpoint, **options)
+    assert tenant.related_index.count() == 0
+
+    checkpoint = tenant.journal.open('job', 'conversations.json', len(conversations))
+    assert checkpoint.resumed > 0
+    stats = import_conversations(tenant, embed_fn, conversations, checkpoint=checkpoint, **options)
+    assert stats.resumed_count == checkpoint.resumed
+    assert tenant.related_index.count() == 40
+
+
+def test_dimension_change_resets_vectors(tmp_path):
+    index = RelatedIndex(str(tmp_path / 'related.sqlite'))
+    rng = np.random.default_rng(0)
+    index.update({f"a{i}": ('a', rng.standard_normal(8).astype(np.float32)) for i in range(4)})
+    index.update({f"b{i}": ('b', rng.standard_normal(16).astype(np.float32)) for i in range(3)})
+    assert index.stats() == {'conversations': 3, 'edges': 6}
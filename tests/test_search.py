@@ -0,0 +1,78 @@
+import pytest
+from conftest import import_conversations, make_conversation, make_text
+
+import ratelimit
+from search import (MODE_HYBRID, MODE_KEYWORD, MODE_VECTOR, QUERY_EMBED_RETRIES, RANK_DEPTH_STEP, rank_conversations,
+                    rank_depth, search, search_batch)
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class Flaky:
+    """最初の failures 回は429を返すEmbedding"""
+
+    def __init__(self, embed_fn, failures):
+        self.embed_fn = embed_fn
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, texts):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RateLimited()
+        return self.embed_fn(texts)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'backoff_delay', lambda attempt: 0.0)
+
+
+@pytest.fixture
+def imported(tenant, embed_fn):
+    conversations = [make_conversation(f"c{i:02d}", make_text(i)) for i in range(8)]
+    import_conversations(tenant, embed_fn, conversations)
+    return conversations
+
+
+def test_query_embedding_retries_rate_limit(tenant, embed_fn, imported, no_backoff):
+    flaky = Flaky(embed_fn, failures=QUERY_EMBED_RETRIES)
+    hits, _ = search(tenant.collection, flaky, make_text(3), n_results=3, mode=MODE_VECTOR)
+    assert hits[0]['chat_id'] == 'c03'
+    assert flaky.calls == QUERY_EMBED_RETRIES + 1
+
+
+def test_query_embedding_gives_up_after_budget(tenant, embed_fn, imported, no_backoff):
+    flaky = Flaky(embed_fn, failures=QUERY_EMBED_RETRIES + 1)
+    with pytest.raises(RateLimited):
+        search(tenant.collection, flaky, make_text(3), n_results=3, mode=MODE_VECTOR)
+
+
+@pytest.mark.parametrize('mode', [MODE_VECTOR, MODE_KEYWORD, MODE_HYBRID])
+def test_batch_search_matches_single_search(tenant, embed_fn, imported, mode):
+    queries = [make_text(1, 20), make_text(5, 20)]
+    batch = search_batch(tenant.collection, embed_fn, queries, n_results=3, mode=mode,
+                         keyword_index=tenant.keyword_index)
+    for query, hits in zip(queries, batch):
+        single, _ = search(tenant.collection, embed_fn, query, n_results=3, mode=mode,
+                           keyword_index=tenant.keyword_index)
+        assert [hit['chat_id'] for hit in hits] == [hit['chat_id'] for hit in single]
+
+
+def test_rank_depth_sizes_first_page_to_the_page():
+    assert rank_depth(0, 5) == 6
+    assert rank_depth(0, 5, {'diversity': 0.3}) == RANK_DEPTH_STEP
+    assert rank_depth(5, 5) == RANK_DEPTH_STEP
+    assert rank_depth(RANK_DEPTH_STEP, 5) == 2 * RANK_DEPTH_STEP
+
+
+@pytest.mark.parametrize('mode', [MODE_VECTOR, MODE_KEYWORD])
+def test_first_page_matches_deeper_ranking(tenant, embed_fn, imported, mode):
+    query = make_text(2, 20)
+    options = dict(mode=mode, keyword_index=tenant.keyword_index)
+    shallow, _ = rank_conversations(tenant.collection, embed_fn, query, rank_depth(0, 3), **options)
+    deep, _ = rank_conversations(tenant.collection, embed_fn, query, RANK_DEPTH_STEP, **options)
+    assert len(shallow) == 4
+    assert [hit['chat_id'] for hit in shallow] == [hit['chat_id'] for hit in deep[:4]]
@@ -0,0 +1,57 @@
+import json
+import os
+import time
+
+import pytest
+
+pytest.importorskip('fastapi')
+pytest.importorskip('httpx')
+
+from conftest import make_text  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from embedders import HashingEmbedder  # noqa: E402
+from server import UPLOAD_CHUNK_BYTES, create_app  # noqa: E402
+from tenants import DEFAULT_TENANT, TenantPool  # noqa: E402
+
+
+def export_body(count, length=80):
+    conversations = [
+        {'id': f"c{i:02d}", 'title': f"c{i:02d}",
+         'messages': [{'role': 'user', 'content': make_text(i, length)},
+                      {'role': 'assistant', 'content': f"answer {make_text(i, 20)}"}]}
+        for i in range(count)
+    ]
+    return json.dumps({'conversations': conversations}).encode()
+
+
+def wait_for(client, job):
+    while job['status'] in ('queued', 'running'):
+        time.sleep(0.05)
+        job = client.get(f"/jobs/{job['job_id']}").json()
+    return job
+
+
+@pytest.fixture
+def client(tmp_path):
+    pool = TenantPool(root=str(tmp_path / 'chroma_db'))
+    with TestClient(create_app(pool, HashingEmbedder(dimension=64), warm=False)) as client:
+        yield client, pool
+
+
+def test_import_streams_upload_and_searches(client):
+    client, pool = client
+    # 書き出す単位より大きい本文（何回かに分けてスレッドプールで書く）
+    body = export_body(30, length=UPLOAD_CHUNK_BYTES // 30 // 6)
+    assert len(body) > UPLOAD_CHUNK_BYTES
+    job = wait_for(client, client.post('/import', content=body).json())
+    assert job['status'] == 'done', job
+    assert os.listdir(pool.get(DEFAULT_TENANT).upload_dir) == []
+
+    response = client.post('/search', json={'query': make_text(4, 20), 'n': 3, 'mode': 'keyword'}).json()
+    assert response['results'][0]['chat_id'] == 'c04'
+
+    # 同じファイルをもう一度送っても、変更なしで終わる
+    job = wait_for(client, client.post('/import', content=body).json())
+    assert job['status'] == 'done'
+    assert job['result']['unchanged'] == 30
@@ -0,0 +1,58 @@
+from conftest import import_conversations, make_conversation, make_text, stored_chat_ids
+
+from tenants import DEFAULT_TENANT, Tenant, TenantPool, tenant_id
+
+
+def test_tenant_id():
+    assert tenant_id(None) == DEFAULT_TENANT
+    assert tenant_id('Alice@Example.com').startswith('alice-example-com-')
+    # 記号だけ違う名前も別のテナント
+    assert tenant_id('a.b@example.com') != tenant_id('a-b@example.com')
+
+
+def test_evicts_least_recently_used(tmp_path):
+    pool = TenantPool(max_open=2, root=str(tmp_path / 'chroma_db'))
+    a = pool.get('a')
+    pool.get('b')
+    assert pool.get('a') is a
+    pool.get('c')
+    assert pool.stats()['open'] == 2
+    assert pool.evictions == 1
+    # b が一番長く使われていなかった
+    assert pool.get('a') is a
+    assert pool.opens == 3
+    pool.get('b')
+    assert pool.opens == 4
+
+
+def test_leased_tenant_is_not_evicted(tmp_path):
+    pool = TenantPool(max_open=1, root=str(tmp_path / 'chroma_db'))
+    with pool.lease('a') as a:
+        pool.get('b')
+        pool.get('c')
+        assert pool.get('a') is a
+    pool.get('b')
+    assert pool.get('a') is not a
+
+
+def test_evicts_over_memory_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(Tenant, 'resident_bytes', lambda self: 1024 * 1024)
+    pool = TenantPool(memory_budget_bytes=int(2.5 * 1024 * 1024), root=str(tmp_path / 'chroma_db'))
+    for name in ('a', 'b', 'c'):
+        pool.get(name)
+    stats = pool.stats()
+    assert stats['open'] == 2
+    assert stats['resident_bytes'] <= stats['budget_bytes']
+
+
+def test_tenants_keep_data_apart_and_across_eviction(tmp_path, embed_fn):
+    pool = TenantPool(max_open=1, root=str(tmp_path / 'chroma_db'))
+    import_conversations(pool.get('a'), embed_fn, [make_conversation('a1', make_text(1))])
+    import_conversations(pool.get('b'), embed_fn, [make_conversation('b1', make_text(2))])
+    assert pool.evictions == 1
+    assert stored_chat_ids(pool.get('b')) == {'b1'}
+    # 手放したテナントは開き直すと同じデータが見える
+    reopened = pool.get('a')
+    assert stored_chat_ids(reopened) == {'a1'}
+    assert reopened.document_store.get('a1') is not None
+    assert reopened.keyword_index.search(make_text(1, 10))[0][1] == 'a1'